@@ -12,8 +12,14 @@ from charmhelpers.core.hookenv import action_fail, action_set
 from charms.layer import status
 from charms.reactive import is_flag_set, set_flag
 
+from routing_profiler import profile
+
+import routing_spawns
+
 from routing_validator import RoutingConfigValidatorError
 
+routing_spawns.install()
+
 try:
     advanced_routing = AdvancedRoutingHelper()
 except PolicyRoutingExists:
@@ -37,16 +43,21 @@ def apply_config():
 
 def action():
     """Run action flow."""
+    try:
+        with profile("apply-changes"):
+            apply_changes()
+    finally:
+        advanced_routing.record_run()
+
+
+def apply_changes():
+    """Apply the configured routes, then remove the obsolete ones."""
     if not advanced_routing.is_advanced_routing_enabled:
         # Juju status is already set by the reactive script
         action_fail("Charm is not enabled.")
         sys.exit(0)
 
     initialized = is_flag_set("advanced-routing.installed")
-    if initialized:
-        status.maintenance("Removing routes")
-        advanced_routing.remove_routes()
-
     if not apply_config():
         # Juju status is already set by apply_config()
         action_fail("Routing changes could not be applied.")
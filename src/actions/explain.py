@@ -0,0 +1,63 @@
+#!/usr/local/sbin/charm-env python3
+"""explain action."""
+
+import json
+import sys
+
+from advanced_routing_helper import AdvancedRoutingHelper, PolicyRoutingExists
+
+from charmhelpers.core.hookenv import action_fail, action_get, action_set
+
+import routing_spawns
+
+from routing_validator import RoutingConfigValidatorError
+
+routing_spawns.install()
+
+try:
+    advanced_routing = AdvancedRoutingHelper()
+except PolicyRoutingExists:
+    action_fail("Disable charm-policy-routing and run again the action.")
+    sys.exit(0)
+
+PACKET_PARAMS = ("src", "dst", "iif", "oif", "fwmark", "proto", "sport", "dport")
+
+
+def packets():
+    """Return the packets described by the action parameters."""
+    if action_get("packets"):
+        return json.loads(action_get("packets"))
+    packet = {}
+    for name in PACKET_PARAMS:
+        value = action_get(name)
+        if value not in (None, "", -1):
+            packet[name] = value
+    return [packet]
+
+
+def action():
+    """Run action flow."""
+    try:
+        descs = packets()
+        if not isinstance(descs, list):
+            raise ValueError("a list of packets is expected")
+        results = advanced_routing.explain(descs)
+    except ValueError as error:
+        action_fail("Invalid packets: {}".format(error))
+        return
+    except RoutingConfigValidatorError as error:
+        action_fail("Routing config validation failed: {}".format(error))
+        return
+    finally:
+        advanced_routing.record_run()
+
+    action_set(
+        {
+            "count": len(results),
+            "results": json.dumps(results, separators=(",", ":")),
+        }
+    )
+
+
+if __name__ == "__main__":
+    action()
@@ -0,0 +1,47 @@
+#!/usr/local/sbin/charm-env python3
+"""plan action."""
+
+import json
+import subprocess
+import sys
+
+from advanced_routing_helper import AdvancedRoutingHelper, PolicyRoutingExists
+
+from charmhelpers.core.hookenv import action_fail, action_get, action_set
+
+import routing_spawns
+
+from routing_validator import RoutingConfigValidatorError
+
+routing_spawns.install()
+
+try:
+    advanced_routing = AdvancedRoutingHelper()
+except PolicyRoutingExists:
+    action_fail("Disable charm-policy-routing and run again the action.")
+    sys.exit(0)
+
+
+def action():
+    """Run action flow."""
+    try:
+        plan = advanced_routing.plan()
+    except RoutingConfigValidatorError as error:
+        action_fail("Routing config validation failed: {}".format(error))
+        return
+    except (OSError, ValueError, subprocess.CalledProcessError) as error:
+        action_fail("Cannot dump the routing state: {}".format(error))
+        return
+    finally:
+        advanced_routing.record_run()
+
+    limit = action_get("limit")
+    result = plan.counts()
+    result["drift"] = plan.drift
+    result["changes"] = json.dumps(plan.listing(limit), sort_keys=True)
+    result["truncated"] = limit is not None and len(plan.changes) > limit
+    action_set(result)
+
+
+if __name__ == "__main__":
+    action()
@@ -0,0 +1,24 @@
+#!/usr/local/sbin/charm-env python3
+"""show-apply-history action."""
+
+import json
+
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import action_get, action_set
+
+from routing_metrics import metrics
+
+
+def action():
+    """Return the recorded timing spans, newest first."""
+    history = metrics.load_history(unitdata.kv(), action_get("limit"))
+    action_set(
+        {
+            "count": len(history),
+            "history": json.dumps(history, sort_keys=True),
+        }
+    )
+
+
+if __name__ == "__main__":
+    action()
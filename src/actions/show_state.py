@@ -0,0 +1,57 @@
+#!/usr/local/sbin/charm-env python3
+"""show-state action."""
+
+import ipaddress
+import json
+import subprocess
+import sys
+
+from advanced_routing_helper import AdvancedRoutingHelper, PolicyRoutingExists
+
+from charmhelpers.core.hookenv import action_fail, action_get, action_set
+
+import routing_spawns
+
+routing_spawns.install()
+
+try:
+    advanced_routing = AdvancedRoutingHelper()
+except PolicyRoutingExists:
+    action_fail("Disable charm-policy-routing and run again the action.")
+    sys.exit(0)
+
+
+def action():
+    """Return the charm-managed routing state grouped by table."""
+    limit = action_get("limit")
+    prefix = action_get("prefix") or None
+    try:
+        if prefix:
+            prefix = ipaddress.ip_network(prefix, strict=False)
+    except ValueError as error:
+        action_fail("Invalid prefix: {}".format(error))
+        return
+    try:
+        groups, matches = advanced_routing.show_state(
+            table=action_get("table") or None,
+            prefix=prefix,
+            device=action_get("device") or None,
+            limit=limit,
+        )
+    except (OSError, ValueError, subprocess.CalledProcessError) as error:
+        action_fail("Cannot dump the routing state: {}".format(error))
+        return
+    finally:
+        advanced_routing.record_run()
+
+    action_set(
+        {
+            "count": min(matches, limit),
+            "truncated": matches > limit,
+            "state": json.dumps(groups, separators=(",", ":")),
+        }
+    )
+
+
+if __name__ == "__main__":
+    action()
@@ -1,15 +1,56 @@
 """Routing module."""
 import errno
+import json
 import os
 import pathlib
+import shutil
 import subprocess
 
-from charmhelpers.core import hookenv
+from charmhelpers.core import hookenv, host, unitdata
 from charmhelpers.core.host import CompareHostReleases, lsb_release
 
-from routing_entry import RoutingEntryType
+import netifaces
 
-from routing_validator import RoutingConfigValidator
+from routing_apply import AsyncApplier
+
+from routing_entry import (
+    RoutingEntryRoute,
+    RoutingEntryRule,
+    RoutingEntryTable,
+    RoutingEntryType,
+    RoutingModel,
+)
+
+from routing_explain import PacketExplainer
+
+from routing_metrics import metrics
+
+from routing_networkd import (
+    DROPIN_NAME,
+    NetworkdRenderError,
+    group_by_device,
+    network_file,
+    render_dropin,
+    table_id,
+)
+
+from routing_optimizer import aggregate_routes, log_reduction, minimize_rules
+
+from routing_state import (
+    KernelState,
+    RoutingPlan,
+    conf_families,
+    is_tagged,
+    kernel_rule_del_cmd,
+    route_event_key,
+    rule_event_key,
+)
+
+from routing_validator import (
+    RULE_SELECTORS,
+    RoutingConfigValidator,
+    RoutingConfigValidatorError,
+)
 
 
 class PolicyRoutingExists(Exception):
@@ -27,9 +68,31 @@ class AdvancedRoutingHelper:
     netplan_up_dir_path = pathlib.Path("/etc/networkd-dispatcher/routable.d")
     policy_routing_service_dir_path = pathlib.Path("/etc/systemd/system")
     table_name_path = pathlib.Path("/etc/iproute2/rt_tables.d/juju-managed.conf")
+    protocol_name_path = pathlib.Path("/etc/iproute2/rt_protos.d/juju-managed.conf")
     networkd_conf_path = pathlib.Path(
         "/usr/lib/systemd/networkd.conf.d/95-juju-networkd.conf"
     )
+    networkd_network_dir_path = pathlib.Path("/etc/systemd/network")
+    persistence_modes = ("networkd-dispatcher", "networkd")
+    applied_key = "advanced-routing.applied"
+    deferred_key = "advanced-routing.deferred"
+    state_version_key = "advanced-routing.state-version"
+    state_version = 1  # format of the applied entries kept in the unit state
+    # the up script runs once per interface event, overlapping runs coalesce
+    ifup_lock_path = pathlib.Path("/run/lock/juju-advanced-routing.lock")
+    ifup_pending_path = pathlib.Path("/run/lock/juju-advanced-routing.pending")
+    gateway_monitor_service = "juju-advanced-routing-gateway-monitor"
+    gateway_monitor_unit_path = pathlib.Path(
+        "/etc/systemd/system/juju-advanced-routing-gateway-monitor.service"
+    )
+    event_watcher_service = "juju-advanced-routing-event-watcher"
+    event_watcher_unit_path = pathlib.Path(
+        "/etc/systemd/system/juju-advanced-routing-event-watcher.service"
+    )
+    boot_restore_service = "juju-advanced-routing-restore"
+    boot_restore_unit_path = pathlib.Path(
+        "/etc/systemd/system/juju-advanced-routing-restore.service"
+    )
 
     def __init__(self):
         """Init function."""
@@ -41,6 +104,7 @@ class AdvancedRoutingHelper:
             self.common_location / "cleanup" / self.routing_script_name
         )
         self.charm_config = hookenv.config()
+        self.model = RoutingModel()  # validated entries of this run
         self.pre_setup()
 
     @property
@@ -53,6 +117,11 @@ class AdvancedRoutingHelper:
         """Return boolean according to Juju config input."""
         return self.charm_config["action-managed-update"]
 
+    @property
+    def is_networkd_persistence(self):
+        """Return True if networkd itself installs the entries at link-up."""
+        return self.charm_config.get("persistence") == "networkd"
+
     def pre_setup(self):
         """Create folder path for the ifup/cleanup scripts."""
         for script_path in [self.common_ifup_path, self.common_cleanup_path]:
@@ -75,51 +144,776 @@ class AdvancedRoutingHelper:
             raise PolicyRoutingExists("Please disable charm-policy-routing")
 
     def post_setup(self):
-        """Symlinks the up script from the if.up or routable.d location."""
+        """Persist the entries with networkd or with the up script.
+
+        The up script is symlinked from the if.up or routable.d location.
+        """
+        if self.is_networkd_persistence:
+            # keep the up script until the drop-ins replacing it are written
+            self.render_networkd()
+            self.remove_file(self.etc_ifup_path)
+            return
+
+        self.remove_networkd_dropins()
         hookenv.log(
             "Symlinking into distro specific network manager", level=hookenv.INFO
         )
         self.symlink_force(str(self.common_ifup_path), str(self.etc_ifup_path))
 
+    def render_networkd(self):
+        """Write the entries into drop-ins of the networkd .network files."""
+        confs = self.model.configs()
+        table_ids = self.model.table_ids
+        written = set()
+        for device, device_confs in group_by_device(confs).items():
+            dropin_dir = self.networkd_network_dir_path / (network_file(device) + ".d")
+            dropin_path = dropin_dir / DROPIN_NAME
+            hookenv.log("Writing {}".format(dropin_path), level=hookenv.INFO)
+            dropin_dir.mkdir(parents=True, exist_ok=True)
+            with open(str(dropin_path), "w") as dropin_file:
+                dropin_file.write(
+                    render_dropin(device_confs, table_ids, RoutingEntryType.protocol_id)
+                )
+            written.add(dropin_path)
+        self.remove_networkd_dropins(keep=written)
+
+    def remove_networkd_dropins(self, keep=()):
+        """Remove the networkd drop-ins written by the charm, but the kept ones."""
+        removed = False
+        for dropin_path in self.networkd_network_dir_path.glob("*.d/" + DROPIN_NAME):
+            if dropin_path in keep:
+                continue
+            hookenv.log("Removing {}".format(dropin_path), level=hookenv.INFO)
+            dropin_path.unlink()
+            removed = True
+            try:
+                dropin_path.parent.rmdir()
+            except OSError:  # the directory holds other drop-ins
+                pass
+        if keep or removed:
+            self.reload_networkd()
+
+    def reload_networkd(self):
+        """Make networkd read its configuration again.
+
+        networkd then reconfigures the links whose .network files or drop-ins
+        changed, installing their routes and rules again.
+        """
+        try:
+            subprocess.check_call(["networkctl", "reload"])
+        except (OSError, subprocess.CalledProcessError) as err:
+            hookenv.log("networkctl reload failed: {}".format(err), hookenv.WARNING)
+
+    @property
+    def metrics_textfile_path(self):
+        """Return the node-exporter textfile path, or None if disabled."""
+        return self.charm_config.get("metrics-textfile-path") or None
+
+    def record_run(self):
+        """Log the spawned processes, persist the timing spans, write the metrics."""
+        hookenv.log(metrics.spawn_summary(), level=hookenv.INFO)
+        metrics.save_history(unitdata.kv())
+        metrics.keep_last_apply(unitdata.kv())
+        self.write_metrics()
+
+    def write_metrics(self):
+        """Write the metrics collected during this run for node-exporter."""
+        if not self.metrics_textfile_path:
+            return
+        self.record_boot_restore()
+        try:
+            metrics.write(self.metrics_textfile_path)
+        except OSError as error:
+            hookenv.log(
+                "Could not write metrics to {}: {}".format(
+                    self.metrics_textfile_path, error
+                ),
+                hookenv.WARNING,
+            )
+
+    def record_boot_restore(self):
+        """Export the timings of the last early-boot restore, if any."""
+        try:
+            with open(str(self.boot_restore_paths[2])) as stats_file:
+                stats = json.load(stats_file)
+        except (OSError, ValueError):
+            return
+        metrics.set_gauge("boot_restore_timestamp_seconds", stats["timestamp"])
+        metrics.set_gauge("boot_restore_wait_seconds", stats["wait_seconds"])
+        metrics.set_gauge("boot_restore_apply_seconds", stats["apply_seconds"])
+        metrics.set_gauge("boot_restore_missing_devices", len(stats["missing_devices"]))
+        metrics.set_gauge("boot_restore_failures", stats["failures"])
+
     def setup(self):
         """Modify the interfaces configurations."""
         # Validate configuration options first
+        with metrics.phase("validate"):
+            self.validate()
+        with metrics.phase("render"):
+            self.render()
+
+    @property
+    def routes_resource(self):
+        """Return the path of the attached routes resource, or None."""
+        try:
+            path = hookenv.resource_get("routes")
+        except (OSError, NotImplementedError) as err:
+            hookenv.log("Cannot get routes resource: {}".format(err), hookenv.DEBUG)
+            return None
+        if not path or not os.path.getsize(path.strip()):
+            # an empty file is used as a placeholder when no routes are attached
+            return None
+        return path.strip()
+
+    def validate(self):
+        """Read and verify the routing configuration."""
+        persistence = self.charm_config.get("persistence", "networkd-dispatcher")
+        if persistence not in self.persistence_modes:
+            raise RoutingConfigValidatorError(
+                "Unknown persistence mode {}, expected one of: {}".format(
+                    persistence, ", ".join(self.persistence_modes)
+                )
+            )
+        conf = self.charm_config["advanced-routing-config"]
         routing_validator = RoutingConfigValidator()
-        routing_validator.read_configurations(
-            self.charm_config["advanced-routing-config"]
+        routing_validator.parallel_threshold = self.charm_config.get(
+            "parallel-validation-threshold", 0
+        )
+        routing_validator.defer_missing_devices = self.charm_config.get(
+            "defer-missing-devices", True
         )
-        routing_validator.verify_config()
+        routing_validator.read_configurations(conf, self.routes_resource)
+        self.model = routing_validator.verify_config()
+        metrics.set_fingerprint(conf + (routing_validator.resource_digest or ""))
+        self.optimize()
+        metrics.count_entries(self.model)
 
+    def optimize(self):
+        """Run the optional optimization passes over the validated entries."""
+        if self.charm_config.get("aggregate-routes"):
+            entries, before, after = aggregate_routes(
+                self.model.entries, self.model.deferred_entries()
+            )
+            self.model = RoutingModel(entries, self.model.deferred)
+            log_reduction("Route aggregation", before, after)
+            metrics.set_gauge("routes_before_aggregation", before)
+            metrics.set_gauge("routes_after_aggregation", after)
+
+        if self.charm_config.get("optimize-rules"):
+            entries, before, after = minimize_rules(
+                self.model.entries, self.model.deferred_entries()
+            )
+            self.model = RoutingModel(entries, self.model.deferred)
+            log_reduction("Rule minimization", before, after)
+            metrics.set_gauge("rules_before_minimization", before)
+
+        rule_count = len([entry for entry in self.model if entry.kind == "rule"])
+        metrics.set_gauge("rules", rule_count)
+        threshold = self.charm_config.get("rule-count-warn-threshold")
+        if threshold and rule_count > threshold:
+            hookenv.log(
+                "{} policy rules are evaluated linearly for every packet, more "
+                "than the threshold of {}".format(rule_count, threshold),
+                hookenv.WARNING,
+            )
+
+    def render(self):
+        """Write the ifup/cleanup scripts and persist them."""
         hookenv.log("Writing {}".format(self.common_ifup_path), level=hookenv.INFO)
         # Modify if-up.d
         with open(str(self.common_ifup_path), "w") as ifup_file:
             ifup_file.write(
-                "#!/bin/sh\n# This file is managed by Juju.\nip route flush cache\n"
+                "#!/bin/sh\n# This file is managed by Juju.\n"
+                "apply() {\nip route flush cache\n"
             )
-            for entry in RoutingEntryType.entries:
+            for entry in self.model:
                 ifup_file.write(entry.addline)
+            # deferred entries are installed once their device exists
+            for device, entries in self.model.deferred.items():
+                ifup_file.write("if [ -e /sys/class/net/{} ]; then\n".format(device))
+                for entry in entries:
+                    ifup_file.write(entry.addline)
+                ifup_file.write("fi\n")
+            ifup_file.write("}\n")
+            ifup_file.write(self.ifup_coalesce_lines())
         os.chmod(str(self.common_ifup_path), 0o755)
 
         hookenv.log("Writing {}".format(self.common_cleanup_path), level=hookenv.INFO)
         with open(str(self.common_cleanup_path), "w") as cleanup_file:
             cleanup_file.write("#!/bin/sh\n# This file is managed by Juju.\n")
-            for entry in list(reversed(RoutingEntryType.entries)):
-                cleanup_file.write(entry.removeline)
+            # routes are tagged with the charm's protocol and flushed at once
+            for cmd in self.flush_routes_cmds:
+                cleanup_file.write(" ".join(cmd) + "\n")
+            for entry in reversed(self.model.entries + self.model.deferred_entries()):
+                if entry.kind != "route":
+                    cleanup_file.write(entry.removeline)
             cleanup_file.write("ip route flush cache\n")
         os.chmod(str(self.common_cleanup_path), 0o755)
 
         self.setup_persistent_rules()
+        self.setup_protocol_name()
         self.post_setup()
+        self.setup_boot_restore()
+
+    def ifup_coalesce_lines(self):
+        """Return the end of the up script, running apply once per burst.
+
+        Every run flags a pending apply. The run holding the lock waits for
+        the debounce window, so that the interfaces coming up together are
+        all seen, then applies for all the runs flagged meanwhile, which exit
+        at once. A run flagged while the lock is released is picked up again.
+        """
+        debounce = self.charm_config.get("ifup-debounce", 0.5)
+        return (
+            "exec 9>{lock}\n"
+            "touch {pending}\n"
+            "# the run holding the lock applies for this one\n"
+            "flock -n 9 || exit 0\n"
+            "while :; do\n"
+            "    sleep {debounce}\n"
+            "    rm -f {pending}\n"
+            "    apply\n"
+            "    [ -e {pending} ] && continue\n"
+            "    flock -u 9\n"
+            "    [ -e {pending} ] && flock -n 9 && continue\n"
+            "    break\n"
+            "done\n"
+        ).format(
+            lock=self.ifup_lock_path, pending=self.ifup_pending_path, debounce=debounce
+        )
+
+    @property
+    def flush_routes_cmds(self):
+        """Return the commands flushing all the routes tagged by the charm."""
+        return [
+            [
+                "ip",
+                family,
+                "route",
+                "flush",
+                "table",
+                "all",
+                "proto",
+                str(RoutingEntryType.protocol_id),
+            ]
+            for family in ("-4", "-6")
+        ]
 
-    def apply_config(self):
-        """Apply the new routes to the system."""
+    def setup_protocol_name(self):
+        """Name the charm's routing protocol for the iproute2 output."""
+        proto_parent = self.protocol_name_path.parent
+        if not proto_parent.exists():
+            proto_parent.mkdir(parents=True)
+        with open(str(self.protocol_name_path), "w") as proto_file:
+            proto_file.write(
+                "# This file is managed by Juju.\n{} {}\n".format(
+                    RoutingEntryType.protocol_id, RoutingEntryType.protocol_name
+                )
+            )
+
+    def apply_config(self, reconcile=False):
+        """Apply the new routes to the system, then remove the obsolete ones.
+
+        Tables, routes and rules are installed first, in this order, next to
+        whatever the previous configuration installed. Only once they are all
+        in place are the charm's rules, then routes, that are no longer
+        configured removed, so that changing a live path does not drop
+        packets.
+
+        :param reconcile: only apply the routes and rules the kernel does not
+                          have as configured, e.g. after a charm upgrade
+        """
         hookenv.log("Applying routing rules", level=hookenv.INFO)
-        for entry in RoutingEntryType.entries:
-            entry.apply()
+        concurrency = self.charm_config.get("apply-concurrency", 1)
+        entries = self.changed_entries() if reconcile else self.model.entries
+        failed = metrics.count("failed")
+        with metrics.phase("apply"):
+            if concurrency > 1:
+                AsyncApplier(entries, concurrency).apply()
+            else:
+                for entry in entries:
+                    entry.apply()
+        unitdata.kv().set(self.applied_key, self.model.configs())
+        unitdata.kv().set(self.state_version_key, self.state_version)
+        self.save_deferred()
+        # the watcher must not put back the obsolete entries removed next
+        self.setup_event_watcher(self.model.configs(), self.model.table_ids)
+
+        failed = metrics.count("failed") - failed
+        if failed:
+            hookenv.log(
+                "Keeping the obsolete routes and rules, {} entries could not "
+                "be applied".format(failed),
+                hookenv.WARNING,
+            )
+        else:
+            with metrics.phase("cleanup"):
+                self.remove_obsolete()
+        self.setup_gateway_monitor()
+        # the entries are not needed past this point of the run
+        self.model = RoutingModel()
+
+    def changed_entries(self):
+        """Return the entries to apply for the kernel to match the model.
+
+        The routes and rules already installed as configured are left out,
+        the tables are always written.
+        """
+        desired = self.model.configs()
+        previous = unitdata.kv().get(self.applied_key, [])
+        try:
+            with metrics.phase("snapshot"):
+                state = KernelState.snapshot(conf_families(desired + previous))
+        except (OSError, ValueError, subprocess.CalledProcessError) as err:
+            hookenv.log(
+                "Cannot list the routes and rules, applying all: {}".format(err),
+                hookenv.WARNING,
+            )
+            return self.model.entries
+
+        plan = RoutingPlan(desired, previous, state)
+        changed = {id(conf) for op, conf in plan.changes if op != "delete"}
+        entries = [
+            entry
+            for entry in self.model
+            if entry.kind == "table" or id(entry.config) in changed
+        ]
+        hookenv.log(
+            "Reconciling in place, {} entries unchanged".format(plan.unchanged),
+            level=hookenv.INFO,
+        )
+        metrics.set_gauge("unchanged_entries", plan.unchanged)
+        return entries
+
+    def migrate_state(self):
+        """Bring the unit state left by a previous charm version up to date.
+
+        The applied entries are stored as validated, so they are normalised
+        the way this version validates them, for the comparison with the new
+        entries to only find the actual changes.
+        """
+        kv = unitdata.kv()
+        version = kv.get(self.state_version_key, 0)
+        if version >= self.state_version:
+            return
+        hookenv.log(
+            "Migrating the unit state from version {} to {}".format(
+                version, self.state_version
+            ),
+            level=hookenv.INFO,
+        )
+        applied = kv.get(self.applied_key, [])
+        for conf in applied:
+            if conf.get("type") != "rule":
+                continue
+            # fwmarks were kept as written, and selectors without a source
+            if conf.get("fwmark"):
+                fwmark = RoutingEntryRule.fwmark_user(str(conf["fwmark"]))
+                conf["fwmark"] = fwmark or conf["fwmark"]
+            if not conf.get("from-net") and any(
+                key in conf for key in RULE_SELECTORS + ("fwmark",)
+            ):
+                conf["from-net"] = "all"
+        kv.set(self.applied_key, applied)
+        kv.set(self.deferred_key, kv.get(self.deferred_key, {}))
+        kv.set(self.state_version_key, self.state_version)
+
+    def save_deferred(self):
+        """Persist the entries waiting for their device to appear."""
+        deferred = self.model.deferred_configs()
+        for device, confs in deferred.items():
+            hookenv.log(
+                "Deferring {} entries until device {} exists".format(
+                    len(confs), device
+                ),
+                hookenv.WARNING,
+            )
+        metrics.set_gauge("deferred_entries", len(self.model.deferred_entries()))
+        unitdata.kv().set(self.deferred_key, deferred)
+
+    @property
+    def deferred_devices(self):
+        """Return the absent devices that entries are waiting for."""
+        return list(unitdata.kv().get(self.deferred_key, {}))
+
+    def apply_deferred(self):
+        """Apply the deferred entries of the devices that appeared since.
+
+        Only the entries of those devices are applied, the others stay
+        queued. Entries that fail are kept to be tried again.
+
+        :returns: the devices whose entries were applied
+        """
+        queue = unitdata.kv().get(self.deferred_key, {})
+        present = set(netifaces.interfaces())
+        ready = [device for device in queue if device in present]
+        if not ready:
+            return []
+
+        applied = unitdata.kv().get(self.applied_key, [])
+        with metrics.phase("apply"):
+            for device in ready:
+                hookenv.log(
+                    "Device {} appeared, applying its {} deferred entries".format(
+                        device, len(queue[device])
+                    ),
+                    level=hookenv.INFO,
+                )
+                failed = metrics.count("failed")
+                for conf in queue[device]:
+                    if conf["type"] == "route":
+                        RoutingEntryRoute(conf).apply()
+                    else:
+                        RoutingEntryRule(conf).apply()
+                if metrics.count("failed") == failed:
+                    applied.extend(queue.pop(device))
+        unitdata.kv().set(self.applied_key, applied)
+        unitdata.kv().set(self.deferred_key, queue)
+        self.setup_event_watcher(applied, self.managed_tables())
+        metrics.set_gauge(
+            "deferred_entries", sum(len(confs) for confs in queue.values())
+        )
+        done = [device for device in ready if device not in queue]
+        if done:
+            self.persist_applied(applied)
+        return done
+
+    def persist_applied(self, applied):
+        """Persist the applied entries again, including the deferred ones.
+
+        The up script installs the deferred entries once their device exists,
+        but the networkd drop-ins and the early-boot restore only hold the
+        entries applied when the config was rendered.
+
+        :param applied: list of the applied config entries
+        """
+        kinds = {
+            "table": RoutingEntryTable,
+            "route": RoutingEntryRoute,
+            "rule": RoutingEntryRule,
+        }
+        self.model = RoutingModel(kinds[conf["type"]](conf) for conf in applied)
+        try:
+            if self.is_networkd_persistence:
+                self.render_networkd()
+            if self.charm_config.get("boot-restore"):
+                self.write_boot_restore_config()
+        except NetworkdRenderError as err:
+            hookenv.log(
+                "Cannot persist the entries of the appeared devices: {}".format(err),
+                hookenv.ERROR,
+            )
+        finally:
+            self.model = RoutingModel()
+
+    def remove_obsolete(self):
+        """Remove the routes and rules tagged by the charm but not configured.
+
+        The deferred entries are still configured, e.g. a rule on an absent
+        input interface is kept.
+        """
+        desired = self.model.configs() + [
+            entry.config for entry in self.model.deferred_entries()
+        ]
+        try:
+            state = KernelState.snapshot((4, 6), owned=True)
+        except (OSError, ValueError, subprocess.CalledProcessError) as err:
+            hookenv.log(
+                "Cannot list the charm's routes and rules: {}".format(err),
+                hookenv.WARNING,
+            )
+            return
+
+        for cmd in state.obsolete_cmds(desired):
+            hookenv.log("Removing obsolete entry: {}".format(" ".join(cmd)))
+            try:
+                subprocess.check_call(cmd)
+            except subprocess.CalledProcessError as err:
+                hookenv.log("{} failed: {}".format(" ".join(cmd), err), hookenv.WARNING)
+
+    @property
+    def gateway_monitor_paths(self):
+        """Return the paths of the gateway monitor script and its config."""
+        return (
+            self.common_location / "gateway_monitor.py",
+            self.common_location / "gateway-monitor.json",
+        )
+
+    def gateway_monitor_config(self):
+        """Return the gateway monitor config for the applied gateway routes.
+
+        Each route lists its gateway then its backup gateways, with the
+        command installing the route through each of them.
+        """
+        routes = []
+        for entry in self.model:
+            if entry.kind != "route" or not entry.config.get("gateway"):
+                continue
+            gateways = [entry.config["gateway"]]
+            gateways.extend(entry.config.get("backup_gateways", []))
+            dst = "default" if entry.config.get("default_route") else None
+            routes.append(
+                {
+                    "name": "{} table {}".format(
+                        dst or entry.config["net"], entry.config.get("table", "main")
+                    ),
+                    "gateways": [
+                        [gateway, entry.create_line(gateway=gateway)]
+                        for gateway in gateways
+                    ],
+                }
+            )
+        return {
+            "probe": self.charm_config.get("gateway-monitor-probe", "neigh"),
+            "interval": self.charm_config.get("gateway-monitor-interval", 1.0),
+            "failures": self.charm_config.get("gateway-monitor-failures", 3),
+            "routes": routes,
+        }
+
+    def setup_gateway_monitor(self):
+        """Install and restart the gateway monitor, or remove it if disabled."""
+        if not self.charm_config.get("gateway-monitor"):
+            self.remove_gateway_monitor()
+            return
+
+        script_path, config_path = self.gateway_monitor_paths
+        shutil.copy(
+            str(pathlib.Path(__file__).parent / "gateway_monitor.py"), str(script_path)
+        )
+        with open(str(config_path), "w") as config_file:
+            json.dump(self.gateway_monitor_config(), config_file, indent=2)
+        with open(str(self.gateway_monitor_unit_path), "w") as unit_file:
+            unit_file.write(
+                "# This file is managed by Juju.\n"
+                "[Unit]\n"
+                "Description=Juju advanced-routing gateway monitor\n"
+                "After=network-online.target\n"
+                "\n"
+                "[Service]\n"
+                "ExecStart=/usr/bin/python3 {} --config {}\n"
+                "Restart=always\n"
+                "RestartSec=1\n"
+                "\n"
+                "[Install]\n"
+                "WantedBy=multi-user.target\n".format(script_path, config_path)
+            )
+        hookenv.log("Restarting the gateway monitor", level=hookenv.INFO)
+        subprocess.check_call(["systemctl", "daemon-reload"])
+        host.service_resume(self.gateway_monitor_service)
+        # the monitor starts from the gateways just installed
+        host.service_restart(self.gateway_monitor_service)
+
+    def remove_gateway_monitor(self):
+        """Stop the gateway monitor and remove its files."""
+        if not self.gateway_monitor_unit_path.exists():
+            return
+        hookenv.log("Removing the gateway monitor", level=hookenv.INFO)
+        host.service_pause(self.gateway_monitor_service)
+        for path in (self.gateway_monitor_unit_path,) + self.gateway_monitor_paths:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        subprocess.check_call(["systemctl", "daemon-reload"])
+
+    @property
+    def event_watcher_paths(self):
+        """Return the paths of the event watcher script and its config."""
+        return (
+            self.common_location / "routing_watcher.py",
+            self.common_location / "event-watcher.json",
+        )
+
+    def event_watcher_config(self, confs, table_ids):
+        """Return the event watcher config indexing the applied entries.
+
+        The routes failed over by the gateway monitor are left to it.
+
+        :param confs: list of applied config entries
+        :param table_ids: {name: number} of the charm's tables
+        """
+        monitored = self.charm_config.get("gateway-monitor")
+        entries = []
+        for conf in confs:
+            table = table_id(conf.get("table", "main"), table_ids)
+            if conf["type"] == "route":
+                if monitored and conf.get("gateway"):
+                    continue
+                entry = RoutingEntryRoute(conf)
+                key = route_event_key(conf, table)
+            elif conf["type"] == "rule":
+                entry = RoutingEntryRule(conf)
+                key = rule_event_key(conf, table)
+            else:
+                continue
+            cmd = entry.create_line()
+            entries.append(
+                {
+                    "name": " ".join(cmd[1:-2]),
+                    "kind": entry.kind,
+                    "key": key,
+                    "cmd": cmd,
+                }
+            )
+        return {
+            "rate": self.charm_config.get("event-watcher-rate", 20.0),
+            "max_repairs": self.charm_config.get("event-watcher-max-repairs", 5),
+            "window": 60.0,
+            "entries": entries,
+        }
+
+    def setup_event_watcher(self, confs, table_ids):
+        """Install and restart the event watcher, or remove it if disabled."""
+        if not self.charm_config.get("event-watcher"):
+            self.remove_event_watcher()
+            return
+
+        script_path, config_path = self.event_watcher_paths
+        shutil.copy(
+            str(pathlib.Path(__file__).parent / "routing_watcher.py"), str(script_path)
+        )
+        with open(str(config_path), "w") as config_file:
+            json.dump(self.event_watcher_config(confs, table_ids), config_file)
+        with open(str(self.event_watcher_unit_path), "w") as unit_file:
+            unit_file.write(
+                "# This file is managed by Juju.\n"
+                "[Unit]\n"
+                "Description=Juju advanced-routing event watcher\n"
+                "After=network.target\n"
+                "\n"
+                "[Service]\n"
+                "ExecStart=/usr/bin/python3 {} --config {}\n"
+                "Restart=always\n"
+                "RestartSec=1\n"
+                "\n"
+                "[Install]\n"
+                "WantedBy=multi-user.target\n".format(script_path, config_path)
+            )
+        hookenv.log("Restarting the event watcher", level=hookenv.INFO)
+        subprocess.check_call(["systemctl", "daemon-reload"])
+        host.service_resume(self.event_watcher_service)
+        # the watcher reads the entries it indexes at start
+        host.service_restart(self.event_watcher_service)
+
+    def remove_event_watcher(self):
+        """Stop the event watcher and remove its files."""
+        if not self.event_watcher_unit_path.exists():
+            return
+        hookenv.log("Removing the event watcher", level=hookenv.INFO)
+        host.service_pause(self.event_watcher_service)
+        for path in (self.event_watcher_unit_path,) + self.event_watcher_paths:
+            self.remove_file(path)
+        subprocess.check_call(["systemctl", "daemon-reload"])
+
+    @property
+    def boot_restore_paths(self):
+        """Return the paths of the restore script, its config and its stats."""
+        return (
+            self.common_location / "routing_restore.py",
+            self.common_location / "boot-restore.json",
+            self.common_location / "boot-restore-stats.json",
+        )
+
+    def boot_restore_config(self):
+        """Return the early-boot restore config for the validated entries."""
+        devices = []
+        batch = []
+        for entry in self.model:
+            if entry.kind == "table":
+                continue
+            device = entry.config.get("device")
+            if device and device not in devices:
+                devices.append(device)
+            batch.append(" ".join(entry.create_line()[1:]))
+        return {
+            "devices": devices,
+            "device_timeout": self.charm_config.get("boot-restore-device-timeout", 30),
+            "batch": batch,
+        }
+
+    def setup_boot_restore(self):
+        """Install and enable the early-boot restore, or remove it if disabled."""
+        if not self.charm_config.get("boot-restore"):
+            self.remove_boot_restore()
+            return
+
+        script_path, config_path, stats_path = self.boot_restore_paths
+        shutil.copy(
+            str(pathlib.Path(__file__).parent / "routing_restore.py"), str(script_path)
+        )
+        self.write_boot_restore_config()
+        with open(str(self.boot_restore_unit_path), "w") as unit_file:
+            unit_file.write(
+                "# This file is managed by Juju.\n"
+                "[Unit]\n"
+                "Description=Juju advanced-routing early-boot restore\n"
+                "After=network.target\n"
+                "Before=network-online.target\n"
+                "\n"
+                "[Service]\n"
+                "Type=oneshot\n"
+                "RemainAfterExit=yes\n"
+                "ExecStart=/usr/bin/python3 {} --config {} --stats {}\n"
+                "\n"
+                "[Install]\n"
+                "WantedBy=network-online.target\n".format(
+                    script_path, config_path, stats_path
+                )
+            )
+        subprocess.check_call(["systemctl", "daemon-reload"])
+        # the routes are applied by the charm now, the unit only runs at boot
+        host.service("enable", self.boot_restore_service)
+
+    def write_boot_restore_config(self):
+        """Write the early-boot restore config of the validated entries."""
+        with open(str(self.boot_restore_paths[1]), "w") as config_file:
+            json.dump(self.boot_restore_config(), config_file, indent=2)
+
+    def remove_boot_restore(self):
+        """Disable the early-boot restore and remove its files."""
+        if not self.boot_restore_unit_path.exists():
+            return
+        hookenv.log("Removing the early-boot restore", level=hookenv.INFO)
+        host.service("disable", self.boot_restore_service)
+        for path in (self.boot_restore_unit_path,) + self.boot_restore_paths:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        subprocess.check_call(["systemctl", "daemon-reload"])
+
+    def plan(self):
+        """Compare the configured entries with the kernel without changing it."""
+        with metrics.phase("validate"):
+            self.validate()
+        desired = self.model.configs()
+        previous = unitdata.kv().get(self.applied_key, [])
+        with metrics.phase("snapshot"):
+            state = KernelState.snapshot(conf_families(desired + previous))
+        plan = RoutingPlan(desired, previous, state)
+        metrics.set_gauge("drift_entries", plan.drift)
+        return plan
+
+    def explain(self, packets):
+        """Return the rule, table and route each described packet would take.
+
+        The packets go through the validated config, without the kernel.
+        """
+        with metrics.phase("validate"):
+            self.validate()
+        with metrics.phase("explain"):
+            return PacketExplainer(self.model).explain_all(packets)
 
     def remove_routes(self):
         """Cleanup job."""
         hookenv.log("Removing routing rules", level=hookenv.INFO)
+        with metrics.phase("cleanup"):
+            self._remove_routes()
+
+    def _remove_routes(self):
+        """Run the cleanup script and remove the files written by setup."""
+        # stopped first, it would install the entries again
+        self.remove_event_watcher()
         if self.common_cleanup_path.is_file():
             try:
                 subprocess.check_call(["sh", "-c", str(self.common_cleanup_path)])
@@ -131,18 +925,84 @@ class AdvancedRoutingHelper:
                     hookenv.WARNING,
                 )
 
+        self.remove_gateway_monitor()
+        self.remove_boot_restore()
+        self.remove_networkd_dropins()
+        self.flush_owned()
+        unitdata.kv().set(self.applied_key, [])
+        unitdata.kv().set(self.deferred_key, {})
+
         # remove symlinks, start/stop scripts and iproute2 table name
         filelist = [
             self.common_ifup_path,
             self.common_cleanup_path,
             self.table_name_path,
+            self.protocol_name_path,
             self.etc_ifup_path,
         ]
         for filename in filelist:
+            self.remove_file(filename)
+
+    @staticmethod
+    def remove_file(path):
+        """Remove a file written by setup, if it is there."""
+        try:
+            path.unlink()
+        except FileNotFoundError as err:
+            hookenv.log("Nothing to clean up: {}".format(err), hookenv.DEBUG)
+
+    def flush_owned(self):
+        """Remove whatever routes and rules are still tagged by the charm.
+
+        This catches entries that a stale or missing cleanup script would
+        leave behind, including routes in the main table. The system rules,
+        e.g. the local lookup, and the rules of other agents are not tagged.
+        """
+        cmds = self.flush_routes_cmds
+        try:
+            state = KernelState.snapshot((4, 6), owned=True, routes=False)
+            cmds.extend(
+                kernel_rule_del_cmd(rule, version)
+                for version, rule in state.rule_list
+                if is_tagged(rule)
+            )
+        except (OSError, ValueError, subprocess.CalledProcessError) as err:
+            hookenv.log(
+                "Cannot list the charm's rules: {}".format(err), hookenv.WARNING
+            )
+
+        for cmd in cmds:
             try:
-                filename.unlink()
-            except FileNotFoundError as err:
-                hookenv.log("Nothing to clean up: {}".format(err), hookenv.DEBUG)
+                subprocess.check_call(cmd)
+            except subprocess.CalledProcessError as err:
+                hookenv.log("{} failed: {}".format(" ".join(cmd), err), hookenv.WARNING)
+
+    def owned_state(self, families=(4,)):
+        """Return a snapshot of the routes and rules tagged by the charm."""
+        return KernelState.snapshot(families, owned=True)
+
+    def managed_tables(self):
+        """Return {name: id} of the routing tables defined by the charm."""
+        tables = {}
+        try:
+            with open(str(self.table_name_path)) as table_file:
+                for line in table_file:
+                    fields = line.split()
+                    if len(fields) == 2 and not line.startswith("#"):
+                        tables[fields[1]] = int(fields[0])
+        except FileNotFoundError:
+            pass
+        return tables
+
+    def show_state(self, table=None, prefix=None, device=None, limit=None):
+        """Return the charm's tables, routes and rules grouped by table.
+
+        Only the routes and rules tagged by the charm are dumped, the routes
+        filtered by the kernel, so that the query stays cheap on large tables.
+        """
+        with metrics.phase("snapshot"):
+            state = self.owned_state((4, 6))
+        return state.by_table(self.managed_tables(), table, prefix, device, limit)
 
     def symlink_force(self, target, link_name):
         """Ensure accurate symlink by removing any existing links."""
@@ -0,0 +1,204 @@
+"""Gateway liveness monitor.
+
+Watches the gateways of the monitored routes and moves each route to its
+first live gateway, or withdraws it while none is alive. It runs as a systemd
+service outside of the charm environment, so only the standard library is
+used.
+
+The configuration is a JSON file written by the charm:
+
+    {
+        "probe": "neigh",       # or "ping"
+        "interval": 1.0,        # seconds between probe rounds
+        "failures": 3,          # failed rounds before a gateway is dead
+        "routes": [
+            {
+                "name": "default table SF1",
+                "gateways": [
+                    ["10.0.0.1", ["ip", "route", "replace", ...]],
+                    ["10.0.0.2", ["ip", "route", "replace", ...]]
+                ]
+            }
+        ]
+    }
+
+A gateway is declared dead after "failures" consecutive failed probes, so
+that failover happens within interval * failures seconds, and alive again
+after one successful probe.
+"""
+import argparse
+import ipaddress
+import json
+import logging
+import socket
+import subprocess
+import sys
+import time
+
+CONFIG_PATH = "/usr/local/lib/juju-charm-advanced-routing/gateway-monitor.json"
+# neighbour states in which the gateway answered recently enough
+ALIVE_STATES = {"REACHABLE", "STALE", "DELAY", "PROBE", "PERMANENT", "NOARP"}
+DISCARD_PORT = 9
+
+log = logging.getLogger("gateway-monitor")
+
+
+def withdraw_cmd(cmd):
+    """Return the command deleting the route installed by a replace command."""
+    return cmd[:2] + ["del"] + cmd[3:]
+
+
+class GatewayMonitor:
+    """Probe gateways and fail routes over to their live gateways."""
+
+    def __init__(self, routes, probe="neigh", interval=1.0, failures=3):
+        """Init function.
+
+        :param routes: list of {"name": str, "gateways": [[address, cmd]]}
+        :param probe: "neigh" to watch the ARP/NDP state, "ping" to ping
+        :param interval: seconds between probe rounds
+        :param failures: consecutive failed probes before a gateway is dead
+        """
+        self.routes = routes
+        self.probe = probe
+        self.interval = interval
+        self.failures = failures
+        self.gateways = sorted(
+            {address for route in routes for address, _ in route["gateways"]}
+        )
+        self.failed = {address: 0 for address in self.gateways}
+        self.current = {route["name"]: None for route in routes}
+
+    @classmethod
+    def from_file(cls, path):
+        """Return a monitor configured from a JSON file."""
+        with open(path) as config_file:
+            config = json.load(config_file)
+        return cls(
+            config["routes"],
+            probe=config.get("probe", "neigh"),
+            interval=float(config.get("interval", 1.0)),
+            failures=int(config.get("failures", 3)),
+        )
+
+    def is_alive(self, address):
+        """Return True unless the gateway failed enough probes in a row."""
+        return self.failed[address] < self.failures
+
+    def probe_round(self):
+        """Probe all gateways once and update their failure counters."""
+        if self.probe == "ping":
+            results = self.ping_all()
+        else:
+            results = self.neigh_all()
+        for address, alive in results.items():
+            self.failed[address] = 0 if alive else self.failed[address] + 1
+
+    def neigh_all(self):
+        """Return the liveness of each gateway from the neighbour table.
+
+        A datagram is sent to each gateway first, so that the kernel keeps
+        confirming the neighbour entries instead of letting them go stale.
+        """
+        for address in self.gateways:
+            family = socket.AF_INET6 if ":" in address else socket.AF_INET
+            try:
+                with socket.socket(family, socket.SOCK_DGRAM) as sock:
+                    sock.sendto(b"", (address, DISCARD_PORT))
+            except OSError as error:
+                log.debug("Cannot send to %s: %s", address, error)
+
+        states = {}
+        for family in ("-4", "-6"):
+            output = subprocess.check_output(["ip", "-json", family, "neigh", "show"])
+            for neigh in json.loads(output.decode("utf8") or "[]"):
+                dst = str(ipaddress.ip_address(neigh["dst"]))
+                states.setdefault(dst, set()).update(neigh.get("state", []))
+        return {
+            address: bool(states.get(address, set()) & ALIVE_STATES)
+            for address in self.gateways
+        }
+
+    def ping_all(self):
+        """Return the liveness of each gateway, pinging them in parallel."""
+        timeout = str(max(1, int(self.interval)))
+        procs = {
+            address: subprocess.Popen(
+                ["ping", "-n", "-q", "-c", "1", "-W", timeout, address],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            for address in self.gateways
+        }
+        return {address: proc.wait() == 0 for address, proc in procs.items()}
+
+    def reconcile(self):
+        """Install each route through its first live gateway.
+
+        :returns: list of (route name, previous gateway, new gateway)
+        """
+        changes = []
+        for route in self.routes:
+            name = route["name"]
+            live = [
+                (address, cmd)
+                for address, cmd in route["gateways"]
+                if self.is_alive(address)
+            ]
+            previous = self.current[name]
+            if live and live[0][0] != previous:
+                address, cmd = live[0]
+                if self.run(cmd):
+                    self.current[name] = address
+                    changes.append((name, previous, address))
+            elif not live and previous is not None:
+                cmd = dict(route["gateways"])[previous]
+                self.run(withdraw_cmd(cmd))
+                self.current[name] = None
+                changes.append((name, previous, None))
+        return changes
+
+    @staticmethod
+    def run(cmd):
+        """Run an ip command, return True on success."""
+        try:
+            subprocess.check_call(cmd)
+            return True
+        except (OSError, subprocess.CalledProcessError) as error:
+            log.error("%s failed: %s", " ".join(cmd), error)
+            return False
+
+    def step(self):
+        """Run one probe round and reconcile the routes."""
+        self.probe_round()
+        for name, previous, address in self.reconcile():
+            if address is None:
+                log.warning("%s: no live gateway, route withdrawn", name)
+            else:
+                log.warning("%s: now via %s (was %s)", name, address, previous)
+
+    def run_forever(self):
+        """Probe and reconcile every interval."""
+        log.info(
+            "Monitoring %d gateways of %d routes", len(self.gateways), len(self.routes)
+        )
+        while True:
+            started = time.monotonic()
+            try:
+                self.step()
+            except (OSError, ValueError, subprocess.CalledProcessError) as error:
+                log.error("Probe round failed: %s", error)
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+
+def main(argv=None):
+    """Run the monitor."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", default=CONFIG_PATH)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    GatewayMonitor.from_file(args.config).run_forever()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
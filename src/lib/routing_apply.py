@@ -0,0 +1,131 @@
+"""AsyncApplier Class.
+
+Applies the validated routing entries with bounded concurrency. Entries are
+ordered by a dependency graph:
+
+    tables
+      -> directly connected routes, one chain per table
+        -> gateway routes, one chain per table
+          -> rules, each waiting for the routes of the table it looks up
+
+Routes of one table are applied in config order. Rules are applied
+concurrently when all of them have an explicit priority, else one after the
+other in config order, as the kernel picks the priority of a rule without one
+from the rules installed before it.
+"""
+import asyncio
+import collections
+import subprocess
+
+from charmhelpers.core import hookenv
+
+from routing_entry import RoutingEntryRule
+
+from routing_metrics import metrics
+
+
+class AsyncApplier:
+    """Apply routing entries concurrently."""
+
+    def __init__(self, entries, concurrency):
+        """Init function.
+
+        :param entries: list of validated RoutingEntryType
+        :param concurrency: maximum number of ip commands running at once
+        """
+        self.entries = entries
+        self.concurrency = max(1, concurrency)
+        self.semaphore = None
+        self.failures = []
+        self.untagged = {}  # rule -> "ip rule" line of its untagged copy
+
+    def apply(self):
+        """Apply all entries and return the list of failed commands."""
+        hookenv.log(
+            "Applying {} entries with concurrency {}".format(
+                len(self.entries), self.concurrency
+            ),
+            level=hookenv.INFO,
+        )
+        asyncio.run(self._apply())
+        for cmd, error in self.failures:
+            hookenv.log("{} failed: {}".format(" ".join(cmd), error), hookenv.ERROR)
+        return self.failures
+
+    async def _apply(self):
+        """Run the dependency graph."""
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        by_kind = collections.defaultdict(list)
+        for entry in self.entries:
+            by_kind[entry.kind].append(entry)
+
+        for entry in by_kind["table"]:
+            entry.apply()
+
+        link_routes = collections.defaultdict(list)
+        gateway_routes = collections.defaultdict(list)
+        for entry in by_kind["route"]:
+            chains = gateway_routes if entry.config.get("gateway") else link_routes
+            chains[entry.config.get("table", "main")].append(entry)
+
+        await asyncio.gather(*(self.chain(c) for c in link_routes.values()))
+        table_routes = {
+            table: asyncio.ensure_future(self.chain(chain))
+            for table, chain in gateway_routes.items()
+        }
+
+        existing_rules = RoutingEntryRule.list_rules() if by_kind["rule"] else []
+        rules = []
+        for rule in by_kind["rule"]:
+            installed = rule.find_installed(existing_rules)
+            if installed is None:
+                rules.append(rule)
+            elif rule.is_tagged(installed):
+                metrics.record("duplicate", rule.kind)
+            else:
+                # installed by hand or before the rules were tagged, tag it
+                self.untagged[rule] = installed
+                rules.append(rule)
+        if all("priority" in rule.config for rule in rules):
+            chains = [[rule] for rule in rules]
+        else:
+            # the kernel picks the priority of a rule from the rules already
+            # installed, whatever their priority, so keep the config order
+            chains = [rules] if rules else []
+        await asyncio.gather(*(self.rule_chain(c, table_routes) for c in chains))
+        await asyncio.gather(*table_routes.values())
+
+    async def chain(self, entries):
+        """Apply entries one after the other."""
+        for entry in entries:
+            await self.exec_cmd(entry)
+
+    async def rule_chain(self, rules, table_routes):
+        """Apply rules one after the other, once their tables are populated."""
+        for rule in rules:
+            routes = table_routes.get(rule.config.get("table", "main"))
+            if routes is not None:
+                await asyncio.shield(routes)
+            # the tagged copy is in place before the untagged one is deleted
+            if await self.exec_cmd(rule) and rule in self.untagged:
+                removecmd = rule.untagged_removecmd(self.untagged[rule])
+                await self.exec_cmd(rule, removecmd, record=False)
+
+    async def exec_cmd(self, entry, cmd=None, record=True):
+        """Run the command line of an entry, or another command about it.
+
+        :returns: True if the command succeeded
+        """
+        cmd = cmd or entry.create_line()
+        async with self.semaphore:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+            )
+            _, stderr = await proc.communicate()
+        if proc.returncode == 0:
+            if record:
+                metrics.record("applied", entry.kind)
+            return True
+        metrics.record("failed", entry.kind)
+        self.failures.append((cmd, stderr.decode("utf8", "replace").strip()))
+        return False
@@ -7,6 +7,8 @@ concrete implementations, that model a routing table
             ---------------------------------------
            |                    |                  |
      RoutingEntryTable  RoutingEntryRoute  RoutingEntryRule
+
+The entries of one run are held by a RoutingModel, built by the validator.
 """
 import collections
 import re
@@ -16,12 +18,97 @@ from abc import ABCMeta, abstractmethod, abstractproperty
 
 from charmhelpers.core import hookenv
 
+from routing_metrics import metrics
+
+# tos names printed by ip rule, the later files taking precedence
+DSFIELD_PATHS = (
+    "/usr/lib/iproute2/rt_dsfield",
+    "/usr/share/iproute2/rt_dsfield",
+    "/etc/iproute2/rt_dsfield",
+)
+
+
+class RoutingModel:
+    """Routing entries of one run, with the tables they define."""
+
+    def __init__(self, entries=(), deferred=None):
+        """Init function.
+
+        :param entries: iterable of RoutingEntryType added to the model
+        :param deferred: {device: <RoutingEntryType>[]} of entries waiting
+                         for their device, kept as is
+        """
+        self.entries = []  # <RoutingEntryType>[]
+        # device -> <RoutingEntryType>[] applied once the device exists
+        self.deferred = collections.OrderedDict(deferred or {})
+        self.table_ids = collections.OrderedDict()  # charm table name -> number
+        self.addlines = set()
+        for entries_of_device in self.deferred.values():
+            self.addlines.update(entry.addline for entry in entries_of_device)
+        self.add_entries(entries)
+
+    def add_entry(self, entry, missing_device=None):
+        """Add routing entry type.
+
+        The validator may see the same entry multiple times, duplicates are
+        skipped.
+
+        :param entry: routing entry
+        :param missing_device: absent device the entry waits for, if any
+        """
+        if entry.addline in self.addlines:
+            return
+        self.addlines.add(entry.addline)
+        if missing_device:
+            self.deferred.setdefault(missing_device, []).append(entry)
+            return
+        self.entries.append(entry)
+        if entry.kind == "table":
+            table = entry.config["table"]
+            if table not in RoutingEntryTable.builtin_tables:
+                offset = RoutingEntryTable.table_index_offset
+                self.table_ids.setdefault(table, offset + len(self.table_ids))
+            entry.table_ids = self.table_ids
+
+    def add_entries(self, entries):
+        """Add many routing entries, skipping duplicates in a single pass.
+
+        :param entries: iterable of routing entries
+        """
+        for entry in entries:
+            self.add_entry(entry)
+
+    def configs(self):
+        """Return the config of every entry."""
+        return [entry.config for entry in self.entries]
+
+    def deferred_entries(self):
+        """Return the entries waiting for a device, in validation order."""
+        return [entry for entries in self.deferred.values() for entry in entries]
+
+    def deferred_configs(self):
+        """Return {device: [config entries]} of the deferred entries."""
+        return collections.OrderedDict(
+            (device, [entry.config for entry in entries])
+            for device, entries in self.deferred.items()
+        )
+
+    def __iter__(self):
+        """Iterate over the entries."""
+        return iter(self.entries)
+
+    def __len__(self):
+        """Return the number of entries."""
+        return len(self.entries)
+
 
 class RoutingEntryType(metaclass=ABCMeta):
     """Abstract type RoutingEntryType."""
 
-    entries = []  # static <RoutingEntryType>[]
     config = None  # config entry
+    kind = None  # entry type name used in the config and in metrics
+    protocol_id = 250  # routing protocol tagging charm managed routes and rules
+    protocol_name = "juju-routing"
 
     def __init__(self):
         """Init this class."""
@@ -45,7 +132,10 @@ class RoutingEntryType(metaclass=ABCMeta):
                     stderr=subprocess.STDOUT,
                 )
                 ps.communicate()
-                return ps.returncode == 0
+                if ps.returncode != 0:
+                    metrics.record("failed", self.kind)
+                    return False
+                return True
             else:
                 hookenv.log(
                     "Subprocess check: {} {}".format(self.__class__.__name__, cmd),
@@ -55,22 +145,9 @@ class RoutingEntryType(metaclass=ABCMeta):
                 return True
         except subprocess.CalledProcessError as error:
             hookenv.log(error, level=hookenv.ERROR)
+            metrics.record("failed", self.kind)
             return False
 
-    @staticmethod
-    def add_entry(entry):
-        """Add routing entry type.
-
-        The validator may be called multiple times
-        The static list will get duplicate items added
-
-        :param entry: routing entry
-        """
-        for rule in RoutingEntryType.entries:
-            if rule.addline == entry.addline:
-                return
-        RoutingEntryType.entries.append(entry)
-
     @abstractmethod
     def apply(self):
         """Apply a rule object to the system.
@@ -109,26 +186,16 @@ class RoutingEntryTable(RoutingEntryType):
 
     default_table_file = "/etc/iproute2/rt_tables"
     table_name_file = "/etc/iproute2/rt_tables.d/juju-managed.conf"
-    table_index_offset = 100  # static
-    tables = set([])
-    tables_all = set([])
+    table_index_offset = 100
     builtin_tables = {"main", "local", "default"}
+    kind = "table"
 
     def __init__(self, config):
-        """Add unique tables to the tables list."""
+        """Object init function."""
         hookenv.log("Created {}".format(self.__class__.__name__), level=hookenv.INFO)
         super().__init__()
         self.config = config
-        RoutingEntryTable.tables_all.update(self.builtin_tables)
-
-        if not self.table_exists:
-            RoutingEntryTable.tables.add(self.config["table"])
-            RoutingEntryTable.tables_all.add(self.config["table"])
-
-    @property
-    def table_exists(self):
-        """Verify if the table shared is reserved by iproute2."""
-        return self.config["table"] in RoutingEntryTable.tables_all
+        self.table_ids = {}  # {name: number} of the tables of the model
 
     def create_line(self):
         """Not implemented in this base class."""
@@ -137,11 +204,9 @@ class RoutingEntryTable(RoutingEntryType):
     def apply(self):
         """Open iproute tables and add the known list of tables into this file."""
         with open(RoutingEntryTable.table_name_file, "w") as rt_table_file:
-            num = RoutingEntryTable.table_index_offset
-            for num, tbl in enumerate(RoutingEntryTable.tables):
-                rt_table_file.write(
-                    "{} {}\n".format(num + RoutingEntryTable.table_index_offset, tbl)
-                )
+            for tbl, num in self.table_ids.items():
+                rt_table_file.write("{} {}\n".format(num, tbl))
+        metrics.record("applied", self.kind)
 
     @property
     def addline(self):
@@ -166,34 +231,46 @@ class RoutingEntryTable(RoutingEntryType):
 class RoutingEntryRoute(RoutingEntryType):
     """RoutingEntryType used for routes."""
 
+    kind = "route"
+
     def __init__(self, config):
         """Object init function."""
         hookenv.log("Created {}".format(self.__class__.__name__), level=hookenv.INFO)
         super().__init__()
         self.config = config
 
-    def create_line(self):
+    def create_line(self, gateway=None):
         """Create and return the command line for this route object.
 
         "default_route" and "net" are mutually exclusive. One of them is required
         "default_route" requires "table"
         "gateway" is mandatory
 
-        Optional keywords: device, table, metric, mtu, mtu_lock
+        :param gateway: next hop replacing the configured gateway, if set
+
+        Optional keywords: device, table, metric, src, mtu, mtu_lock, advmss,
+        initcwnd, initrwnd, congctl, quickack
 
+        Routes are tagged with the charm's routing protocol.
         """
         opts = collections.OrderedDict(
             {
                 "device": "dev",
                 "table": "table",
                 "metric": "metric",
+                "src": "src",
                 "mtu": "mtu",
                 "mtu_lock": "mtu lock",
+                "advmss": "advmss",
+                "initcwnd": "initcwnd",
+                "initrwnd": "initrwnd",
+                "congctl": "congctl",
+                "quickack": "quickack",
             }
         )
         cmd = ["ip", "route", "replace"]
 
-        gateway = self.config.get("gateway")
+        gateway = gateway or self.config.get("gateway")
         # default route in table
         if "default_route" in self.config.keys():
             cmd.extend(
@@ -210,7 +287,7 @@ class RoutingEntryRoute(RoutingEntryType):
         else:
             if gateway:
                 # route in any given table or none
-                cmd.extend([self.config["net"], "via", self.config["gateway"]])
+                cmd.extend([self.config["net"], "via", gateway])
             else:
                 # directly connected route
                 cmd.extend([self.config["net"]])
@@ -221,11 +298,13 @@ class RoutingEntryRoute(RoutingEntryType):
                 cmd.extend(keyword.split() + [str(self.config[opt])])
             except KeyError:
                 pass
+        cmd.extend(["proto", str(self.protocol_id)])
         return cmd
 
     def apply(self):
         """Apply this rule object to the system."""
-        super().exec_cmd(self.create_line())
+        if super().exec_cmd(self.create_line()):
+            metrics.record("applied", self.kind)
 
     @property
     def addline(self):
@@ -246,6 +325,20 @@ class RoutingEntryRule(RoutingEntryType):
         r"^(\d{1,13}|0x[0-9a-f]{1,8})(?:\/(0x[0-9a-f]{1,8}))?$"
     )
     MARK_PATTERN = re.compile(MARK_PATTERN_TXT, re.IGNORECASE)
+    PROTO_SUFFIX = re.compile(r"\s+proto\s+(\S+)$")
+    TOS_SELECTOR = re.compile(r"\btos\s+(\S+)")
+    dsfield_cache = None  # {tos name: value} read from rt_dsfield
+    LISTED_SELECTORS = (
+        "tos",
+        "fwmark",
+        "iif",
+        "oif",
+        "uidrange",
+        "ipproto",
+        "sport",
+        "dport",
+    )
+    kind = "rule"
 
     @staticmethod
     def fwmark_user(fwmark):
@@ -265,6 +358,43 @@ class RoutingEntryRule(RoutingEntryType):
         ]
         return "/".join(map(hex, as_ints))
 
+    @classmethod
+    def dsfield_names(cls):
+        """Return {name: value} of the tos names iproute2 lists rules with."""
+        if cls.dsfield_cache is None:
+            names = {}
+            for path in DSFIELD_PATHS:
+                try:
+                    with open(path) as dsfield_file:
+                        for line in dsfield_file:
+                            fields = line.split("#", 1)[0].split()
+                            if len(fields) == 2:
+                                names[fields[1]] = int(fields[0], 0)
+                except (OSError, ValueError):
+                    pass
+            cls.dsfield_cache = names
+        return cls.dsfield_cache
+
+    @classmethod
+    def tos_value(cls, tos):
+        """Return the integer of a tos given by value or rt_dsfield name, or None."""
+        try:
+            return int(str(tos), 0)
+        except ValueError:
+            return cls.dsfield_names().get(str(tos))
+
+    @classmethod
+    def numeric_tos(cls, line):
+        """Return an "ip rule" line with its tos name replaced by its value."""
+
+        def replace(match):
+            value = cls.tos_value(match.group(1))
+            if value is None:
+                return match.group(0)
+            return "tos 0x{:02x}".format(value)
+
+        return cls.TOS_SELECTOR.sub(replace, line)
+
     def __init__(self, config):
         """Object init function."""
         hookenv.log("Created {}".format(self.__class__.__name__), level=hookenv.INFO)
@@ -293,13 +423,29 @@ class RoutingEntryRule(RoutingEntryType):
         ip rule add from X.X.X.X/XX priority NNN
         # any src, fwmark 0x1/0xF, iif bond0, table mytable
         ip rule add from any fwmark 1/0xF iif bond0 table mytable priority NNN
+        # any src, TCP to ports 8000-8080, table mytable
+        ip rule add from all ipproto tcp dport 8000-8080 table mytable
+        # anything but X.X.X.X/XX, lookup main ignoring its default route
+        ip rule add not from X.X.X.X/XX table main suppress_prefixlength 0
+
+        Rules are tagged with the charm's routing protocol.
         """
-        cmd = ["ip", "rule", "add", "from", self.config["from-net"]]
+        cmd = ["ip", "rule", "add"]
+        if self.config.get("not"):
+            cmd.append("not")
+        cmd.extend(["from", self.config["from-net"]])
         opts = [
             ("fwmark", "fwmark"),
             ("iif", "iif"),
+            ("oif", "oif"),
             ("to-net", "to"),
+            ("tos", "tos"),
+            ("uidrange", "uidrange"),
+            ("ipproto", "ipproto"),
+            ("sport", "sport"),
+            ("dport", "dport"),
             ("table", "table"),
+            ("suppress_prefixlength", "suppress_prefixlength"),
             ("priority", "priority"),
         ]
         for opt, keyword in opts:
@@ -307,13 +453,22 @@ class RoutingEntryRule(RoutingEntryType):
                 cmd.extend([keyword, str(self.config[opt])])
             except KeyError:
                 pass
+        cmd.extend(["protocol", str(self.protocol_id)])
         return cmd
 
     def apply(self):
         """Apply this rule object to the system."""
-        if self.is_duplicate() is False:
-            # ip rule replace not supported, check for duplicates
-            super().exec_cmd(self.create_line())
+        installed = self.find_installed()
+        if installed is not None and self.is_tagged(installed):
+            metrics.record("duplicate", self.kind)
+            return
+        # ip rule replace not supported, check for duplicates
+        if super().exec_cmd(self.create_line()):
+            metrics.record("applied", self.kind)
+            if installed is not None:
+                # installed by hand or before the rules were tagged, the
+                # tagged copy is in place before it is deleted
+                super().exec_cmd(self.untagged_removecmd(installed))
 
     @property
     def addline(self):
@@ -325,32 +480,77 @@ class RoutingEntryRule(RoutingEntryType):
         """Return the remove line for the ifdown script."""
         return " ".join(self.create_line()).replace(" add ", " del ") + "\n"
 
-    def is_duplicate(self):
-        """Ip rule add does not prevent duplicates in older kernel versions."""
+    def untagged_removecmd(self, installed):
+        """Return the command deleting the untagged copy of this rule.
+
+        The copy is deleted by its listed priority and protocol, not to delete
+        the tagged copy added next to it.
+
+        :param installed: "ip rule" line of the untagged copy
+        """
+        cmd = self.create_line()[:-2]  # without "protocol 250"
+        cmd[2] = "del"
+        if "priority" not in self.config:
+            cmd.extend(["priority", installed.split(":", 1)[0].strip()])
+        match = self.PROTO_SUFFIX.search(installed.strip())
+        cmd.extend(["protocol", match.group(1) if match else "unspec"])
+        return cmd
+
+    def is_tagged(self, line):
+        """Return True if an "ip rule" line is tagged with the charm's protocol."""
+        match = self.PROTO_SUFFIX.search(line.strip())
+        return match is not None and match.group(1) in (
+            str(self.protocol_id),
+            self.protocol_name,
+        )
+
+    def is_duplicate(self, existing_rules=None):
+        """Ip rule add does not prevent duplicates in older kernel versions.
+
+        A matching rule not tagged with the charm's protocol is not a duplicate,
+        it is deleted and added again tagged.
+
+        :param existing_rules: lines of "ip rule" output, queried if None
+        """
+        installed = self.find_installed(existing_rules)
+        return installed is not None and self.is_tagged(installed)
+
+    def find_installed(self, existing_rules=None):
+        """Return the "ip rule" line matching this rule, or None.
+
+        :param existing_rules: lines of "ip rule" output, queried if None
+        """
         # https://patchwork.ozlabs.org/patch/624553/
-        matchparams = ["from", self.config["from-net"]]
+        matchparams = ["not"] if self.config.get("not") else []
+        matchparams.extend(["from", self.config["from-net"]])
 
         to = self.config.get("to-net")
         if to and to != "all":  # ip rule omits to=all as it's implied
             matchparams.extend(("to", to))
 
-        fwmark = self.config.get("fwmark")
-        if fwmark:
-            matchparams.extend(("fwmark", fwmark))
-
-        iif = self.config.get("iif")
-        if iif:
-            matchparams.extend(("iif", iif))
+        # the selectors are listed in this order by ip rule
+        for opt in self.LISTED_SELECTORS:
+            value = self.config.get(opt)
+            if value is not None:
+                matchparams.extend((opt, str(value)))
 
         matchparams.extend(("lookup", self.config.get("table", "main")))
+        suppress = self.config.get("suppress_prefixlength")
+        if suppress is not None:
+            matchparams.extend(("suppress_prefixlength", str(suppress)))
         matchline = " ".join(matchparams)
         prio = str(self.config.get("priority", ""))
-        existing_rules = (
-            subprocess.check_output(["ip", "rule"]).decode("utf8").splitlines()
-        )
-        for rule in existing_rules:
-            rule = rule.strip()
+        if existing_rules is None:
+            existing_rules = self.list_rules()
+        for line in existing_rules:
+            # the protocol, if any, is listed after the lookup
+            rule = self.numeric_tos(self.PROTO_SUFFIX.sub("", line.strip()))
             if rule.startswith(prio) and rule.endswith(matchline):
                 hookenv.log("Found dup rule: {}".format(matchline), level=hookenv.DEBUG)
-                return True
-        return False
+                return line
+        return None
+
+    @staticmethod
+    def list_rules():
+        """Return the lines of the "ip rule" output."""
+        return subprocess.check_output(["ip", "rule"]).decode("utf8").splitlines()
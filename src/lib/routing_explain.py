@@ -0,0 +1,261 @@
+"""PacketExplainer Class.
+
+Explains the path of a packet through the desired routing model, offline:
+the policy rules are evaluated in priority order, and each table they look
+up is searched by longest prefix match, as the kernel does.
+
+Only the charm's entries are known, plus the default rules of the kernel
+(local, main and default tables). A table without a matching route makes
+the lookup continue with the next rule, so a packet that only the kernel's
+own routes would carry, e.g. through a connected network of the main table,
+is reported as unresolved.
+
+The rules and routes are indexed once, so that many packets can be explained
+in a batch:
+
+    explainer = PacketExplainer(model)
+    explainer.explain({"src": "10.0.0.5", "dst": "8.8.8.8", "iif": "eth1"})
+"""
+import ipaddress
+import socket
+
+from routing_state import normalize_mark, normalize_range, normalize_tos
+
+LOCAL_IIF = "lo"  # input interface of locally generated packets
+SYSTEM_RULES = (
+    (0, {"from-net": "all", "table": "local"}),
+    (32766, {"from-net": "all", "table": "main"}),
+    (32767, {"from-net": "all", "table": "default"}),
+)
+
+
+class PacketExplainError(Exception):
+    """The packet description is invalid."""
+
+    pass
+
+
+def protocol_number(proto):
+    """Return the number of an IP protocol given by name or number."""
+    if proto is None:
+        return None
+    if str(proto).isdigit():
+        return int(proto)
+    try:
+        return socket.getprotobyname(str(proto))
+    except OSError:
+        raise PacketExplainError("Unknown protocol {}".format(proto))
+
+
+def parse_net(net, version=None):
+    """Return (version, network int, mask int, prefixlen), None for "all"."""
+    if net in (None, "all", "any"):
+        return None
+    if net == "default":
+        net = "0.0.0.0/0" if version == 4 else "::/0"
+    network = ipaddress.ip_network(net, strict=False)
+    return (
+        network.version,
+        int(network.network_address),
+        int(network.netmask),
+        network.prefixlen,
+    )
+
+
+def net_contains(net, version, addr):
+    """Return True if a parsed network contains an address, "all" always does."""
+    if net is None:
+        return True
+    return addr is not None and net[0] == version and addr & net[2] == net[1]
+
+
+def in_range(bounds, value):
+    """Return True if the value is in the (start, end) range, or no range."""
+    if bounds is None:
+        return True
+    return value is not None and bounds[0] <= value <= bounds[1]
+
+
+class IndexedRule:
+    """Rule selector parsed for fast matching."""
+
+    def __init__(self, priority, conf, version=4):
+        """Parse the selector of a rule config.
+
+        :param priority: priority of the rule, None until the kernel picks one
+        :param version: IP version of a rule without networks
+        """
+        self.priority = priority
+        self.conf = conf
+        self.table = str(conf.get("table", "main"))
+        self.src = parse_net(conf.get("from-net"))
+        self.dst = parse_net(conf.get("to-net"))
+        self.fwmark = normalize_mark(conf.get("fwmark"))
+        self.iif = conf.get("iif")
+        self.oif = conf.get("oif")
+        self.tos = normalize_tos(conf.get("tos"))
+        self.uidrange = normalize_range(conf.get("uidrange"))
+        self.ipproto = protocol_number(conf.get("ipproto"))
+        self.sport = normalize_range(conf.get("sport"))
+        self.dport = normalize_range(conf.get("dport"))
+        self.invert = bool(conf.get("not"))
+        suppress = conf.get("suppress_prefixlength")
+        self.suppress = None if suppress is None else int(suppress)
+        # the networks select the family of the rule, as with ip rule add
+        nets = [net for net in (self.src, self.dst) if net]
+        self.version = nets[0][0] if nets else version
+
+    def matches(self, packet):
+        """Return True if the rule selects the packet."""
+        if self.version is not None and self.version != packet.version:
+            return False
+        selected = (
+            net_contains(self.src, packet.version, packet.src)
+            and net_contains(self.dst, packet.version, packet.dst)
+            and (self.iif is None or self.iif == packet.iif)
+            and (self.oif is None or self.oif == packet.oif)
+            and (
+                self.fwmark is None or packet.fwmark & self.fwmark[1] == self.fwmark[0]
+            )
+            and (self.tos is None or self.tos == packet.tos)
+            and in_range(self.uidrange, packet.uid)
+            and (self.ipproto is None or self.ipproto == packet.proto)
+            and in_range(self.sport, packet.sport)
+            and in_range(self.dport, packet.dport)
+        )
+        return selected != self.invert
+
+    def describe(self):
+        """Return the rule config with its effective priority."""
+        return dict(self.conf, priority=self.priority)
+
+
+class Packet:
+    """Parsed packet description."""
+
+    def __init__(self, desc):
+        """Parse a {"src", "dst", "iif", "oif", "fwmark", ...} description."""
+        try:
+            dst = ipaddress.ip_address(desc["dst"])
+            src = ipaddress.ip_address(desc["src"]) if desc.get("src") else None
+            if src is not None and src.version != dst.version:
+                raise ValueError("src and dst are of different families")
+            self.fwmark = int(str(desc.get("fwmark", 0)), 0)
+            self.tos = int(str(desc.get("tos", 0)), 0)
+            self.uid = None if desc.get("uid") is None else int(desc["uid"])
+            self.sport = None if desc.get("sport") is None else int(desc["sport"])
+            self.dport = None if desc.get("dport") is None else int(desc["dport"])
+        except KeyError as error:
+            raise PacketExplainError("Packet {} needs {}".format(desc, error))
+        except (TypeError, ValueError) as error:
+            raise PacketExplainError("Packet {} invalid: {}".format(desc, error))
+        self.version = dst.version
+        self.dst = int(dst)
+        self.src = None if src is None else int(src)
+        self.iif = desc.get("iif") or LOCAL_IIF
+        self.oif = desc.get("oif")
+        self.proto = protocol_number(desc.get("proto"))
+
+
+class PacketExplainer:
+    """Index of the rules and routes of a model, answering packet lookups."""
+
+    def __init__(self, model):
+        """Index the entries of a RoutingModel."""
+        # the default rules exist for both families
+        self.rules = [IndexedRule(prio, conf, None) for prio, conf in SYSTEM_RULES]
+        self.tables = {}  # (table, version) -> {prefixlen: {network: route}}
+        for entry in model:
+            if entry.kind == "rule":
+                priority = entry.config.get("priority")
+                rule = IndexedRule(priority, entry.config)
+                if priority is None:
+                    rule.priority = self.kernel_priority(rule.version)
+                else:
+                    rule.priority = int(priority)
+                self.rules.append(rule)
+            elif entry.kind == "route":
+                self.add_route(entry.config)
+        # stable sort: rules of the same priority keep their insertion order
+        self.rules.sort(key=lambda rule: rule.priority)
+        self.prefixlens = {
+            key: sorted(routes, reverse=True) for key, routes in self.tables.items()
+        }
+
+    def kernel_priority(self, version):
+        """Return the priority the kernel gives to a rule added without one.
+
+        It is one less than the first priority after 0 of the rules of the
+        same family installed before it.
+        """
+        priorities = [
+            rule.priority
+            for rule in self.rules
+            if rule.priority > 0 and rule.version in (None, version)
+        ]
+        return max(min(priorities) - 1, 0)
+
+    def add_route(self, conf):
+        """Index a route config by table, family, prefix length and network."""
+        if conf.get("default_route"):
+            version = ipaddress.ip_address(conf["gateway"]).version
+            net = parse_net("default", version)
+        else:
+            net = parse_net(conf["net"])
+        version, network, _, prefixlen = net
+        routes = self.tables.setdefault((str(conf.get("table", "main")), version), {})
+        current = routes.setdefault(prefixlen, {}).get(network)
+        metric = int(conf.get("metric", 0))
+        if current is None or metric < int(current.get("metric", 0)):
+            routes[prefixlen][network] = conf
+
+    def lookup(self, table, packet):
+        """Return (prefixlen, route) of the longest prefix match in a table."""
+        key = (table, packet.version)
+        routes = self.tables.get(key)
+        if not routes:
+            return None, None
+        bits = 32 if packet.version == 4 else 128
+        for prefixlen in self.prefixlens[key]:
+            mask = ((1 << prefixlen) - 1) << (bits - prefixlen)
+            route = routes[prefixlen].get(packet.dst & mask)
+            if route is not None:
+                return prefixlen, route
+        return None, None
+
+    def explain(self, desc):
+        """Return the rule, table and route taken by a described packet.
+
+        :param desc: {"dst", and optionally "src", "iif", "oif", "fwmark",
+                     "tos", "uid", "proto", "sport", "dport"}
+        :returns: {"result": "route", "rule", "table", "route"}, or
+                  {"result": "unresolved", "rules"} with the rules that
+                  matched but whose tables had no route for the packet
+        """
+        packet = Packet(desc)
+        tried = []
+        for rule in self.rules:
+            if not rule.matches(packet):
+                continue
+            prefixlen, route = self.lookup(rule.table, packet)
+            if route is not None and (
+                rule.suppress is None or prefixlen > rule.suppress
+            ):
+                return {
+                    "result": "route",
+                    "rule": rule.describe(),
+                    "table": rule.table,
+                    "route": route,
+                }
+            tried.append(rule.describe())
+        return {"result": "unresolved", "rules": tried}
+
+    def explain_all(self, descs):
+        """Explain a batch of packets, reporting invalid ones in place."""
+        results = []
+        for desc in descs:
+            try:
+                results.append(self.explain(desc))
+            except PacketExplainError as error:
+                results.append({"result": "error", "error": str(error)})
+        return results
@@ -0,0 +1,290 @@
+"""RoutingMetrics Class.
+
+Collects timings and counters while a hook or action runs and renders them
+in the Prometheus text exposition format, so that node-exporter's textfile
+collector can pick them up.
+"""
+import collections
+import contextlib
+import hashlib
+import os
+import pathlib
+import tempfile
+import time
+
+from charmhelpers.core import hookenv
+
+
+class RoutingMetrics:
+    """Per-hook routing metrics collector."""
+
+    prefix = "juju_advanced_routing"
+    history_key = "advanced-routing.apply-history"
+    history_size = 50  # number of runs kept in the unit state
+    last_apply_key = "advanced-routing.last-apply-metrics"
+
+    def __init__(self):
+        """Init function."""
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        self.phases = collections.OrderedDict()
+        self.entries = collections.Counter()
+        self.events = collections.Counter()
+        self.gauges = {}
+        self.spawns = []
+        self.fingerprint = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the wrapped block and account it to the given phase."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def record(self, event, kind):
+        """Count an entry event (applied, duplicate, failed) for an entry kind."""
+        self.events[(event, kind)] += 1
+
+    def count(self, event):
+        """Return the number of entry events of a type, for all entry kinds."""
+        return sum(n for (name, _), n in self.events.items() if name == event)
+
+    def record_spawn(self, command, started):
+        """Open the ledger record of a spawned process and return it."""
+        spawn = {"command": command, "started": started, "seconds": None, "exit": None}
+        self.spawns.append(spawn)
+        return spawn
+
+    @staticmethod
+    def finish_spawn(spawn, returncode):
+        """Close the ledger record of a process that exited."""
+        spawn["seconds"] = time.monotonic() - spawn["started"]
+        spawn["exit"] = returncode
+
+    def spawn_totals(self):
+        """Return {command: [count, seconds in children, failures]}."""
+        totals = collections.OrderedDict()
+        for spawn in self.spawns:
+            total = totals.setdefault(spawn["command"], [0, 0.0, 0])
+            total[0] += 1
+            total[1] += spawn["seconds"] or 0.0
+            total[2] += spawn["exit"] not in (0, None)
+        return totals
+
+    def spawn_summary(self):
+        """Return a one-line summary of the processes spawned during this run."""
+        totals = self.spawn_totals()
+        seconds = sum(total[1] for total in totals.values())
+        parts = []
+        for command, (count, secs, failed) in sorted(
+            totals.items(), key=lambda item: -item[1][1]
+        ):
+            part = "{} x{} {:.3f}s".format(command, count, secs)
+            if failed:
+                part += " ({} failed)".format(failed)
+            parts.append(part)
+        return "Spawned {} processes, {:.3f}s in children: {}".format(
+            len(self.spawns), seconds, ", ".join(parts) or "none"
+        )
+
+    def count_entries(self, entries):
+        """Count the validated entries by kind."""
+        self.entries = collections.Counter(entry.kind for entry in entries)
+
+    def set_gauge(self, name, value):
+        """Set a free-form gauge, e.g. the number of drifted entries."""
+        self.gauges[name] = value
+
+    def set_fingerprint(self, conf):
+        """Fingerprint the routing configuration that was applied."""
+        digest = hashlib.sha256((conf or "").encode("utf8")).hexdigest()
+        self.fingerprint = digest[:16]
+
+    def render(self):
+        """Return the collected metrics in Prometheus text format."""
+        lines = []
+
+        def add(name, help_text, samples):
+            metric = "{}_{}".format(self.prefix, name)
+            lines.append("# HELP {} {}".format(metric, help_text))
+            lines.append("# TYPE {} gauge".format(metric))
+            for labels, value in samples:
+                label_txt = ",".join(
+                    '{}="{}"'.format(key, val) for key, val in labels.items()
+                )
+                if label_txt:
+                    label_txt = "{{{}}}".format(label_txt)
+                lines.append("{}{} {}".format(metric, label_txt, value))
+
+        add(
+            "last_run_timestamp_seconds",
+            "Time the charm last reported routing metrics.",
+            [({"hook": hookenv.hook_name()}, round(time.time(), 3))],
+        )
+        add(
+            "phase_duration_seconds",
+            "Time spent in each routing phase during the last run.",
+            [({"phase": name}, round(secs, 6)) for name, secs in self.phases.items()],
+        )
+        add(
+            "entries",
+            "Number of validated routing entries by type.",
+            [({"type": kind}, count) for kind, count in sorted(self.entries.items())],
+        )
+        for event in ("applied", "duplicate", "failed"):
+            add(
+                "entries_{}".format(event),
+                "Number of routing entries {} during the last run.".format(event),
+                [
+                    ({"type": kind}, count)
+                    for (name, kind), count in sorted(self.events.items())
+                    if name == event
+                ],
+            )
+        totals = self.spawn_totals()
+        add(
+            "subprocesses",
+            "Number of external processes spawned during the last run.",
+            [({}, len(self.spawns))],
+        )
+        add(
+            "subprocess_seconds",
+            "Time spent waiting for external processes during the last run.",
+            [({}, round(sum(total[1] for total in totals.values()), 6))],
+        )
+        add(
+            "subprocesses_by_command",
+            "Number of external processes spawned by command.",
+            [({"command": cmd}, total[0]) for cmd, total in sorted(totals.items())],
+        )
+        add(
+            "subprocess_seconds_by_command",
+            "Time spent waiting for external processes by command.",
+            [
+                ({"command": cmd}, round(total[1], 6))
+                for cmd, total in sorted(totals.items())
+            ],
+        )
+        add(
+            "subprocess_failures",
+            "Number of external processes that exited non-zero, by command.",
+            [({"command": cmd}, total[2]) for cmd, total in sorted(totals.items())],
+        )
+        for name, value in sorted(self.gauges.items()):
+            add(name, "Routing gauge {}.".format(name), [({}, value)])
+        if self.fingerprint:
+            add(
+                "config_info",
+                "Fingerprint of the applied routing configuration.",
+                [({"fingerprint": self.fingerprint}, 1)],
+            )
+        return "\n".join(lines) + "\n"
+
+    def span(self):
+        """Return the timing span of this run, or None if nothing was timed."""
+        if not self.phases:
+            return None
+        return {
+            "hook": hookenv.hook_name(),
+            "timestamp": round(time.time(), 3),
+            "phases": {name: round(secs, 6) for name, secs in self.phases.items()},
+            "entries": dict(self.entries),
+            "subprocesses": len(self.spawns),
+            "subprocess_seconds": round(
+                sum(spawn["seconds"] or 0.0 for spawn in self.spawns), 6
+            ),
+        }
+
+    def save_history(self, kv):
+        """Append the timing span of this run to the bounded unit history."""
+        span = self.span()
+        if span is None:
+            return False
+        history = kv.get(self.history_key, [])
+        history.append(span)
+        while len(history) > self.history_size:
+            history.pop(0)
+        kv.set(self.history_key, history)
+        kv.flush()
+        return True
+
+    def keep_last_apply(self, kv):
+        """Persist the metrics of a configuration apply, or restore the last ones.
+
+        Runs that apply no configuration, e.g. update-status, rewrite the
+        textfile too, so they report the phases, entry counts and gauges of
+        the last apply, under their own.
+
+        :returns: True if this run applied a configuration
+        """
+        if "apply" in self.phases and self.entries:
+            self.gauges["last_apply_timestamp_seconds"] = round(time.time(), 3)
+            kv.set(
+                self.last_apply_key,
+                {
+                    "phases": dict(self.phases),
+                    "entries": dict(self.entries),
+                    "events": [
+                        [event, kind, count]
+                        for (event, kind), count in self.events.items()
+                    ],
+                    "gauges": self.gauges,
+                    "fingerprint": self.fingerprint,
+                },
+            )
+            kv.flush()
+            return True
+        last = kv.get(self.last_apply_key)
+        if not last:
+            return False
+        phases = collections.OrderedDict(last["phases"])
+        phases.update(self.phases)
+        self.phases = phases
+        self.entries = self.entries or collections.Counter(last["entries"])
+        if not self.events:
+            self.events = collections.Counter(
+                {(event, kind): count for event, kind, count in last["events"]}
+            )
+        self.gauges = dict(last["gauges"], **self.gauges)
+        self.fingerprint = self.fingerprint or last["fingerprint"]
+        return False
+
+    def load_history(self, kv, limit=None):
+        """Return the recorded spans, newest first."""
+        history = list(reversed(kv.get(self.history_key, [])))
+        if limit:
+            history = history[:limit]
+        return history
+
+    def write(self, path):
+        """Atomically write the metrics to a textfile-collector file.
+
+        Nothing is written if the collector directory does not exist, i.e.
+        node-exporter is not deployed on this machine.
+        """
+        path = pathlib.Path(path)
+        if not path.parent.is_dir():
+            hookenv.log(
+                "Skipping metrics, {} does not exist".format(path.parent),
+                level=hookenv.DEBUG,
+            )
+            return False
+
+        fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix=".", text=True)
+        try:
+            with os.fdopen(fd, "w") as metrics_file:
+                metrics_file.write(self.render())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, str(path))
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+        return True
+
+
+metrics = RoutingMetrics()
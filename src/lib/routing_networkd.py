@@ -0,0 +1,174 @@
+"""Rendering of the routing entries as systemd-networkd drop-ins.
+
+In the "networkd" persistence mode the validated entries are written as
+[Route] and [RoutingPolicyRule] sections into a drop-in of the .network file
+managing each interface, e.g.
+
+    /etc/systemd/network/10-netplan-eth0.network.d/95-juju-routing.conf
+
+so that networkd installs them itself as soon as the link is configured,
+without any script being run. Routes go to the drop-in of their device, or of
+the device their gateway is reached through. Rules go to the drop-in of their
+incoming or outgoing interface, or of the device of the first route of the
+table they look up.
+"""
+import collections
+import pathlib
+import re
+import subprocess
+
+from routing_state import ip_json
+
+from routing_validator import RoutingConfigValidatorError
+
+DROPIN_NAME = "95-juju-routing.conf"
+NETWORK_FILE_PATTERN = re.compile(r"^\s*Network File:\s*(\S+)\s*$", re.MULTILINE)
+BUILTIN_TABLES = {"default": 253, "main": 254, "local": 255}
+
+# config key -> [Route] setting
+ROUTE_SETTINGS = collections.OrderedDict(
+    [
+        ("gateway", "Gateway"),
+        ("metric", "Metric"),
+        ("src", "PreferredSource"),
+        ("mtu", "MTUBytes"),
+        ("advmss", "TCPAdvertisedMaximumSegmentSize"),
+        ("initcwnd", "InitialCongestionWindow"),
+        ("initrwnd", "InitialAdvertisedReceiveWindow"),
+        ("congctl", "TCPCongestionControlAlgorithm"),
+    ]
+)
+# config key -> [RoutingPolicyRule] setting
+RULE_SETTINGS = collections.OrderedDict(
+    [
+        ("to-net", "To"),
+        ("fwmark", "FirewallMark"),
+        ("iif", "IncomingInterface"),
+        ("oif", "OutgoingInterface"),
+        ("tos", "TypeOfService"),
+        ("uidrange", "User"),
+        ("ipproto", "IPProtocol"),
+        ("sport", "SourcePort"),
+        ("dport", "DestinationPort"),
+        ("suppress_prefixlength", "SuppressPrefixLength"),
+        ("priority", "Priority"),
+    ]
+)
+
+
+class NetworkdRenderError(RoutingConfigValidatorError):
+    """The entries cannot be rendered as networkd drop-ins."""
+
+    pass
+
+
+def table_id(table, table_ids):
+    """Return the number of a table, networkd does not know the charm's names."""
+    if table in BUILTIN_TABLES:
+        return BUILTIN_TABLES[table]
+    return table_ids[table]
+
+
+def route_section(conf, table_ids, protocol):
+    """Return the [Route] section of a route config."""
+    lines = ["[Route]"]
+    if not conf.get("default_route"):
+        lines.append("Destination={}".format(conf["net"]))
+    if "mtu_lock" in conf:
+        # networkd cannot lock the MTU, the locked one wins as with ip route
+        conf = dict(conf, mtu=conf["mtu_lock"])
+    for key, setting in ROUTE_SETTINGS.items():
+        if key in conf:
+            lines.append("{}={}".format(setting, conf[key]))
+    if "quickack" in conf:
+        lines.append("QuickAck={}".format("yes" if int(conf["quickack"]) else "no"))
+    if not conf.get("gateway"):
+        lines.append("Scope=link")
+    lines.append("Table={}".format(table_id(conf.get("table", "main"), table_ids)))
+    lines.append("Protocol={}".format(protocol))
+    return "\n".join(lines) + "\n"
+
+
+def rule_section(conf, table_ids, protocol):
+    """Return the [RoutingPolicyRule] section of a rule config."""
+    lines = ["[RoutingPolicyRule]"]
+    if conf.get("from-net", "all") not in ("all", "any"):
+        lines.append("From={}".format(conf["from-net"]))
+    for key, setting in RULE_SETTINGS.items():
+        if conf.get(key, "all") != "all":
+            lines.append("{}={}".format(setting, conf[key]))
+    if conf.get("not"):
+        lines.append("InvertRule=yes")
+    lines.append("Table={}".format(table_id(conf.get("table", "main"), table_ids)))
+    lines.append("Protocol={}".format(protocol))
+    return "\n".join(lines) + "\n"
+
+
+def gateway_device(gateway):
+    """Return the device a gateway is currently reached through."""
+    try:
+        routes = ip_json(["route", "get", gateway])
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        routes = []
+    if not routes or "dev" not in routes[0]:
+        raise NetworkdRenderError("No device reaches gateway {}".format(gateway))
+    return routes[0]["dev"]
+
+
+def network_file(device):
+    """Return the name of the .network file networkd manages a device with."""
+    try:
+        output = subprocess.check_output(
+            ["networkctl", "status", "--no-pager", device], stderr=subprocess.STDOUT
+        ).decode("utf8")
+    except (OSError, subprocess.CalledProcessError):
+        output = ""
+    match = NETWORK_FILE_PATTERN.search(output)
+    if not match or match.group(1) == "n/a":
+        raise NetworkdRenderError(
+            "{} is not managed by systemd-networkd".format(device)
+        )
+    return pathlib.Path(match.group(1)).name
+
+
+def group_by_device(confs, resolve_gateway=gateway_device):
+    """Return {device: [config entries]} for the routes and rules.
+
+    :param confs: list of validated config entries
+    :param resolve_gateway: function returning the device reaching a gateway
+    """
+    groups = collections.OrderedDict()
+    table_devices = {}
+    for conf in confs:
+        if conf["type"] != "route":
+            continue
+        device = conf.get("device") or resolve_gateway(conf["gateway"])
+        groups.setdefault(device, []).append(conf)
+        table_devices.setdefault(conf.get("table", "main"), device)
+
+    for conf in confs:
+        if conf["type"] != "rule":
+            continue
+        device = (
+            conf.get("iif")
+            or conf.get("oif")
+            or table_devices.get(conf.get("table", "main"))
+            or next(iter(groups), None)
+        )
+        if device is None:
+            raise NetworkdRenderError(
+                "No device to attach the rule from {} to".format(conf["from-net"])
+            )
+        groups.setdefault(device, []).append(conf)
+    return groups
+
+
+def render_dropin(confs, table_ids, protocol):
+    """Return the content of the drop-in holding the entries of one device."""
+    sections = ["# This file is managed by Juju.\n"]
+    for conf in confs:
+        if conf["type"] == "route":
+            sections.append(route_section(conf, table_ids, protocol))
+        else:
+            sections.append(rule_section(conf, table_ids, protocol))
+    return "\n".join(sections)
@@ -0,0 +1,261 @@
+"""Optional optimization passes over the validated routing entries.
+
+The passes take the list of validated entries and return a new, smaller list
+that routes packets the same way.
+"""
+import collections
+import ipaddress
+
+from charmhelpers.core import hookenv
+
+from routing_entry import RoutingEntryRoute, RoutingEntryRule
+
+from routing_state import normalize_mark, normalize_net
+
+# rule keys understood by the shadowing analysis
+RULE_SELECTORS = {"from-net", "to-net", "fwmark", "iif"}
+RULE_KEYS = RULE_SELECTORS | {"type", "table", "priority"}
+
+
+def route_group(conf):
+    """Return the attributes a route shares with the routes it can merge with."""
+    version = ipaddress.ip_network(conf["net"]).version
+    attrs = sorted((key, str(value)) for key, value in conf.items() if key != "net")
+    return (version, tuple(attrs))
+
+
+def aggregate_routes(entries, deferred=()):
+    """Collapse adjacent route prefixes sharing table, gateway, device, metric...
+
+    Only routes to a "net" are merged, and only with routes that have exactly
+    the same other attributes. A merge is skipped if a route of another group
+    in the same table, deferred ones included, would then win the longest
+    prefix match for addresses that the merged routes used to win.
+
+    :param entries: list of validated RoutingEntryType
+    :param deferred: list of the entries waiting for their device, not merged
+    :returns: (entries, number of routes before, number of routes after)
+    """
+    groups, table_nets = group_routes(entries, deferred)
+    replaced = {}  # id(original entry) -> list of entries replacing it
+    for group, members in groups.items():
+        if len(members) < 2:
+            continue
+        table = members[0][1].config.get("table", "main")
+        supernets = collect_supernets(members, group, table_nets[table])
+        for supernet, merged in supernets.items():
+            if len(merged) < 2:
+                continue
+            template = dict(merged[0].config, net=str(supernet))
+            replaced[id(merged[0])] = [RoutingEntryRoute(template)]
+            for entry in merged[1:]:
+                replaced[id(entry)] = []
+
+    result = []
+    for entry in entries:
+        result.extend(replaced.get(id(entry), [entry]))
+    before = sum(len(members) for members in groups.values())
+    return result, before, before - len(entries) + len(result)
+
+
+def group_routes(entries, deferred=()):
+    """Group the routes to a "net" by their other attributes.
+
+    The deferred routes are only accounted in the networks of their table.
+
+    :returns: (group -> [(network, entry)], table -> network -> groups)
+    """
+    groups = collections.OrderedDict()
+    table_nets = collections.defaultdict(lambda: collections.defaultdict(set))
+    for entry in entries:
+        if entry.kind == "route" and "net" in entry.config:
+            net = ipaddress.ip_network(entry.config["net"])
+            group = route_group(entry.config)
+            groups.setdefault(group, []).append((net, entry))
+            table_nets[entry.config.get("table", "main")][net].add(group)
+    for entry in deferred:
+        if entry.kind == "route" and "net" in entry.config:
+            net = ipaddress.ip_network(entry.config["net"])
+            group = route_group(entry.config)
+            table_nets[entry.config.get("table", "main")][net].add(group)
+    return groups, table_nets
+
+
+def collect_supernets(members, group, table_nets):
+    """Map each safe collapsed supernet of a group to the entries it replaces."""
+    collapsed = set(ipaddress.collapse_addresses(net for net, _ in members))
+    supernets = collections.OrderedDict()
+    for net, entry in members:
+        supernet = next(
+            net.supernet(new_prefix=length)
+            for length in range(net.prefixlen, -1, -1)
+            if net.supernet(new_prefix=length) in collapsed
+        )
+        # another group's route between the supernet and this route would
+        # now be more specific than the merged route, or replace it if it is
+        # at the supernet itself
+        conflict = any(
+            table_nets.get(net.supernet(new_prefix=length), {group}) - {group}
+            for length in range(supernet.prefixlen, net.prefixlen + 1)
+        )
+        supernets.setdefault(supernet, [])
+        if conflict:
+            supernets[supernet].append(None)
+        else:
+            supernets[supernet].append(entry)
+    # a supernet with a conflicting member is not merged at all
+    return collections.OrderedDict(
+        (supernet, merged)
+        for supernet, merged in supernets.items()
+        if None not in merged
+    )
+
+
+def rule_family(conf):
+    """Return the IP version of a rule."""
+    for key in ("from-net", "to-net"):
+        if ":" in str(conf.get(key, "")):
+            return 6
+    return 4
+
+
+def net_covers(outer, inner):
+    """Return True if the outer rule network contains the inner one."""
+    outer, inner = normalize_net(outer), normalize_net(inner)
+    if outer == "all":
+        return True
+    if inner == "all":
+        return False
+    return ipaddress.ip_network(inner).subnet_of(ipaddress.ip_network(outer))
+
+
+def rule_covers(outer, inner):
+    """Return True if every packet selected by inner is selected by outer."""
+    if set(outer) - RULE_KEYS or rule_family(outer) != rule_family(inner):
+        return False
+    if inner.get("not"):
+        # an inverted rule selects everything outside its networks
+        return False
+    if outer.get("iif") is not None and outer["iif"] != inner.get("iif"):
+        return False
+    if outer.get("fwmark") and normalize_mark(outer["fwmark"]) != normalize_mark(
+        inner.get("fwmark")
+    ):
+        return False
+    return net_covers(outer.get("from-net"), inner.get("from-net")) and net_covers(
+        outer.get("to-net"), inner.get("to-net")
+    )
+
+
+def drop_dead_rules(rules, entries):
+    """Drop rules that look up a charm table without any route.
+
+    :param entries: the entries to look for routes in, deferred ones included
+    """
+    charm_tables = {entry.config["table"] for entry in entries if entry.kind == "table"}
+    routed_tables = {
+        entry.config.get("table", "main") for entry in entries if entry.kind == "route"
+    }
+    dead_tables = charm_tables - routed_tables
+    return [rule for rule in rules if rule.config.get("table") not in dead_tables]
+
+
+def drop_shadowed_rules(rules, entries):
+    """Drop rules that can never match because an earlier rule always does.
+
+    An earlier rule shadows a later one if it selects a superset of its
+    packets and either looks up the same table, or a table holding a default
+    route, so that the lookup cannot fall through to the later rule.
+    Only rules with an explicit priority are considered.
+    """
+    default_tables = {
+        entry.config["table"]
+        for entry in entries
+        if entry.kind == "route" and entry.config.get("default_route")
+    }
+    ordered = sorted(
+        (int(rule.config["priority"]), index, rule)
+        for index, rule in enumerate(rules)
+        if "priority" in rule.config
+    )
+    shadowed = set()
+    for position, (_, _, rule) in enumerate(ordered):
+        table = rule.config.get("table", "main")
+        for _, _, earlier in ordered[:position]:
+            earlier_table = earlier.config.get("table", "main")
+            terminal = earlier_table == table or earlier_table in default_tables
+            if id(earlier) not in shadowed and terminal:
+                if rule_covers(earlier.config, rule.config):
+                    shadowed.add(id(rule))
+                    break
+    return [rule for rule in rules if id(rule) not in shadowed]
+
+
+def merge_rules(rules):
+    """Merge rules that only differ by adjacent "from-net" networks.
+
+    Only rules with an explicit priority are merged, and only if no other
+    rule of the same family shares that priority, so that the evaluation
+    order is unchanged. Inverted rules are never merged.
+    """
+    groups = collections.OrderedDict()
+    priorities = collections.Counter()
+    for rule in rules:
+        conf = rule.config
+        version = rule_family(conf)
+        priorities[(version, conf.get("priority"))] += 1
+        if "priority" not in conf or normalize_net(conf.get("from-net")) == "all":
+            continue
+        if conf.get("not"):
+            # "not A" and "not B" together are not "not (A + B)"
+            continue
+        attrs = ((key, str(value)) for key, value in conf.items() if key != "from-net")
+        groups.setdefault((version, tuple(sorted(attrs))), []).append(rule)
+
+    replaced = {}
+    for (version, _), members in groups.items():
+        priority = members[0].config["priority"]
+        shared = priorities[(version, priority)] != len(members)
+        if len(members) < 2 or shared:
+            continue
+        nets = ipaddress.collapse_addresses(
+            ipaddress.ip_network(rule.config["from-net"]) for rule in members
+        )
+        merged = [
+            RoutingEntryRule(dict(members[0].config, **{"from-net": str(net)}))
+            for net in nets
+        ]
+        if len(merged) < len(members):
+            replaced[id(members[0])] = merged
+            for rule in members[1:]:
+                replaced[id(rule)] = []
+
+    result = []
+    for rule in rules:
+        result.extend(replaced.get(id(rule), [rule]))
+    return result
+
+
+def minimize_rules(entries, deferred=()):
+    """Drop dead and shadowed rules and merge mergeable ones.
+
+    A table whose routes are all deferred is not dead, but its deferred
+    default route does not make it shadow later rules until it is installed.
+
+    :param entries: list of validated RoutingEntryType
+    :param deferred: list of the entries waiting for their device, kept as is
+    :returns: (entries, number of rules before, number of rules after)
+    """
+    rules = [entry for entry in entries if entry.kind == "rule"]
+    alive = drop_dead_rules(rules, list(entries) + list(deferred))
+    kept = merge_rules(drop_shadowed_rules(alive, entries))
+    result = [entry for entry in entries if entry.kind != "rule"] + kept
+    return result, len(rules), len(kept)
+
+
+def log_reduction(name, before, after):
+    """Log how much an optimization pass shrank the entries."""
+    hookenv.log(
+        "{}: {} entries reduced to {}".format(name, before, after),
+        level=hookenv.INFO,
+    )
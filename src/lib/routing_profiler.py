@@ -0,0 +1,79 @@
+"""Opt-in profiling of charm handlers and actions.
+
+When the "profiling" config option is set, or the
+JUJU_ADVANCED_ROUTING_PROFILE environment variable is set to a non-empty
+value, the wrapped block runs under cProfile and tracemalloc. The resulting
+stats are written to a bounded directory, keeping only the newest runs.
+"""
+import cProfile
+import contextlib
+import os
+import pathlib
+import time
+import tracemalloc
+
+from charmhelpers.core import hookenv
+
+PROFILE_ENV = "JUJU_ADVANCED_ROUTING_PROFILE"
+PROFILE_DIR = pathlib.Path("/usr/local/lib/juju-charm-advanced-routing/profiles")
+PROFILE_KEEP = 20  # number of profiled runs kept on disk
+ALLOC_TOP = 25  # number of allocation sites reported per run
+
+
+def is_enabled():
+    """Return True if profiling was requested for this run."""
+    if os.environ.get(PROFILE_ENV):
+        return True
+    return bool(hookenv.config().get("profiling"))
+
+
+def rotate(profile_dir=PROFILE_DIR, keep=PROFILE_KEEP):
+    """Remove all but the newest profiled runs."""
+    runs = {}
+    for path in profile_dir.iterdir():
+        runs.setdefault(path.name.split(".", 1)[0], []).append(path)
+    for stem in sorted(runs)[:-keep]:
+        for path in runs[stem]:
+            path.unlink()
+
+
+def write_stats(name, profiler, snapshot, peak, profile_dir=PROFILE_DIR):
+    """Write cProfile and tracemalloc results for one profiled run."""
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    stem = "{}-{}-{}".format(time.strftime("%Y%m%dT%H%M%S"), os.getpid(), name)
+    profiler.dump_stats(str(profile_dir / "{}.pstats".format(stem)))
+    with open(str(profile_dir / "{}.alloc.txt".format(stem)), "w") as alloc_file:
+        alloc_file.write("peak {} bytes\n".format(peak))
+        for stat in snapshot.statistics("lineno")[:ALLOC_TOP]:
+            alloc_file.write("{}\n".format(stat))
+    rotate(profile_dir, PROFILE_KEEP)
+    hookenv.log(
+        "Profile for {} written to {}".format(name, profile_dir / stem),
+        level=hookenv.INFO,
+    )
+
+
+@contextlib.contextmanager
+def profile(name, profile_dir=PROFILE_DIR):
+    """Profile the wrapped block if profiling is enabled."""
+    if not is_enabled():
+        yield
+        return
+
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        try:
+            write_stats(name, profiler, snapshot, peak, profile_dir)
+        except OSError as error:
+            hookenv.log(
+                "Could not write profile for {}: {}".format(name, error),
+                hookenv.WARNING,
+            )
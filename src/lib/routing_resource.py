@@ -0,0 +1,290 @@
+"""RoutingResource Class.
+
+Reads routing entries from the "routes" Juju resource. The resource is
+either gzipped JSON, using the same format as the advanced-routing-config
+option, or a compact line-oriented format close to the ip(8) syntax:
+
+    # comments and empty lines are ignored
+    table SF1
+    route default via 10.191.86.2 table SF1 metric 101 dev eth0
+    route 6.6.6.0/24 via 10.191.86.2
+    route 6.6.7.0/24 dev eth0 mtu lock 1400
+    route 10.20.0.0/16 via 10.191.86.2 initcwnd 32 initrwnd 32 quickack 1
+    rule from 192.170.2.0/24 to 192.170.2.0/24 table SF1 priority 101
+    rule fwmark 0x10/0xff iif eth0 table SF1
+    rule ipproto tcp dport 8000-8080 table SF1 priority 102
+
+The parsed entries are cached by the SHA-256 of the resource, the cache
+schema and the charm revision, so that an unchanged resource is not parsed
+again in later hooks, but is once the charm is upgraded.
+"""
+import gzip
+import hashlib
+import io
+import json
+import mmap
+import pathlib
+
+from charmhelpers.core import hookenv
+
+CACHE_SCHEMA = 1  # bump when the parsed entries change for a same resource
+GZIP_MAGIC = b"\x1f\x8b"
+JSON_CHUNK_SIZE = 64 * 1024  # characters decompressed at a time
+JSON_MAX_ENTRY_SIZE = 1024 * 1024  # longest JSON entry buffered
+
+# keyword -> (config key, value type), per entry type
+ROUTE_KEYWORDS = {
+    "via": ("gateway", str),
+    "dev": ("device", str),
+    "table": ("table", str),
+    "metric": ("metric", int),
+    "mtu": ("mtu", int),
+    "mtu_lock": ("mtu_lock", int),
+    "src": ("src", str),
+    "advmss": ("advmss", int),
+    "initcwnd": ("initcwnd", int),
+    "initrwnd": ("initrwnd", int),
+    "congctl": ("congctl", str),
+    "quickack": ("quickack", int),
+}
+RULE_KEYWORDS = {
+    "from": ("from-net", str),
+    "to": ("to-net", str),
+    "fwmark": ("fwmark", str),
+    "iif": ("iif", str),
+    "oif": ("oif", str),
+    "tos": ("tos", str),
+    "uidrange": ("uidrange", str),
+    "ipproto": ("ipproto", str),
+    "sport": ("sport", str),
+    "dport": ("dport", str),
+    "table": ("table", str),
+    "suppress_prefixlength": ("suppress_prefixlength", int),
+    "priority": ("priority", int),
+    "pref": ("priority", int),
+}
+
+
+class RoutingResourceError(Exception):
+    """Resource format error exception."""
+
+    pass
+
+
+class JsonStream:
+    """Buffer over a text stream, decoding one JSON value at a time."""
+
+    def __init__(self, text):
+        """Init function."""
+        self.text = text
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def read(self):
+        """Drop the consumed text and append the next chunk."""
+        chunk = self.text.read(JSON_CHUNK_SIZE)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+    def next_char(self):
+        """Skip the whitespace and return the next character."""
+        while True:
+            while (
+                self.position < len(self.buffer)
+                and self.buffer[self.position].isspace()
+            ):
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.eof:
+                raise RoutingResourceError(
+                    "Invalid JSON in routes resource: unexpected end"
+                )
+            self.read()
+
+    def decode(self):
+        """Decode the value at the current position, reading more as needed."""
+        self.next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # a number may continue in the next chunk
+                if self.eof or end < len(self.buffer):
+                    self.position = end
+                    return value
+            except ValueError as error:
+                if self.eof:
+                    raise RoutingResourceError(
+                        "Invalid JSON in routes resource: {}".format(error)
+                    )
+            if len(self.buffer) - self.position > JSON_MAX_ENTRY_SIZE:
+                raise RoutingResourceError(
+                    "Routes resource entry longer than {} characters".format(
+                        JSON_MAX_ENTRY_SIZE
+                    )
+                )
+            self.read()
+
+
+class RoutingResource:
+    """Streaming reader for the routes resource."""
+
+    cache_dir = pathlib.Path(
+        "/usr/local/lib/juju-charm-advanced-routing/resource-cache"
+    )
+
+    def __init__(self, path):
+        """Init function."""
+        self.path = pathlib.Path(path)
+        self._digest = None
+
+    @property
+    def digest(self):
+        """Return the SHA-256 of the resource."""
+        if self._digest is None:
+            with open(str(self.path), "rb") as res_file, mmap.mmap(
+                res_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as res_map:
+                self._digest = hashlib.sha256(res_map).hexdigest()
+        return self._digest
+
+    @property
+    def cache_key(self):
+        """Return the cache key of the resource for this charm revision."""
+        try:
+            revision_path = pathlib.Path(hookenv.charm_dir() or ".") / "revision"
+            revision = revision_path.read_text().strip()
+        except OSError:
+            revision = "unknown"
+        return "{}-{}-{}".format(CACHE_SCHEMA, revision, self.digest)
+
+    def load(self):
+        """Return the entries of the resource, from the cache if possible.
+
+        A cache file that cannot be read is handled as a cache miss.
+        """
+        cache_path = self.cache_dir / "{}.json".format(self.cache_key)
+        if cache_path.is_file():
+            hookenv.log(
+                "Using cached routes resource {}".format(cache_path),
+                level=hookenv.INFO,
+            )
+            try:
+                with open(str(cache_path)) as cache_file:
+                    return json.load(cache_file)
+            except (OSError, ValueError) as error:
+                hookenv.log(
+                    "Ignoring unreadable routes resource cache: {}".format(error),
+                    hookenv.WARNING,
+                )
+
+        entries = list(self.entries())
+        self.write_cache(cache_path, entries)
+        return entries
+
+    def write_cache(self, cache_path, entries):
+        """Replace the cached entries with the ones parsed from this resource."""
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            for stale in self.cache_dir.glob("*.json"):
+                stale.unlink()
+            with open(str(cache_path), "w") as cache_file:
+                json.dump(entries, cache_file)
+        except OSError as error:
+            hookenv.log(
+                "Could not cache routes resource: {}".format(error), hookenv.WARNING
+            )
+
+    def entries(self):
+        """Yield the entries of the resource, streaming through a memory map."""
+        with open(str(self.path), "rb") as res_file, mmap.mmap(
+            res_file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as res_map:
+            if res_map[:2] == GZIP_MAGIC:
+                with gzip.GzipFile(fileobj=res_map) as gz_file:
+                    text = io.TextIOWrapper(gz_file, encoding="utf8")
+                    try:
+                        yield from self.json_entries(text)
+                    except (EOFError, OSError, UnicodeDecodeError) as error:
+                        raise RoutingResourceError(
+                            "Invalid gzipped routes resource: {}".format(error)
+                        )
+                return
+
+            for lineno, line in enumerate(iter(res_map.readline, b""), 1):
+                line = line.split(b"#", 1)[0].strip()
+                if not line:
+                    continue
+                try:
+                    line = line.decode("utf8")
+                except UnicodeDecodeError as error:
+                    raise RoutingResourceError(
+                        "Bad routes resource line {}: {}".format(lineno, error)
+                    )
+                yield self.parse_line(line, lineno)
+
+    @staticmethod
+    def json_entries(text):
+        """Yield the items of a JSON list one at a time, from a text stream.
+
+        Only the entry being decoded is buffered, not the whole list.
+        """
+        stream = JsonStream(text)
+        if stream.next_char() != "[":
+            raise RoutingResourceError("Routes resource must be a JSON list")
+        stream.position += 1
+        if stream.next_char() == "]":
+            return
+        while True:
+            yield stream.decode()
+            char = stream.next_char()
+            if char == "]":
+                return
+            if char != ",":
+                raise RoutingResourceError(
+                    "Invalid JSON in routes resource: expected , or ]"
+                )
+            stream.position += 1
+
+    def parse_line(self, line, lineno):
+        """Return the config entry for one line of the compact format."""
+        tokens = line.split()
+        entry_type = tokens.pop(0)
+        try:
+            if entry_type == "table" and len(tokens) == 1:
+                return {"type": "table", "table": tokens[0]}
+            if entry_type == "route" and tokens:
+                conf = {"type": "route"}
+                dst = tokens.pop(0)
+                if dst == "default":
+                    conf["default_route"] = True
+                else:
+                    conf["net"] = dst
+                tokens = " ".join(tokens).replace("mtu lock ", "mtu_lock ").split()
+                return self.parse_keywords(conf, tokens, ROUTE_KEYWORDS)
+            if entry_type == "rule":
+                conf = {"type": "rule"}
+                if tokens[:1] == ["not"]:
+                    conf["not"] = True
+                    tokens.pop(0)
+                return self.parse_keywords(conf, tokens, RULE_KEYWORDS)
+        except (KeyError, IndexError, ValueError) as error:
+            raise RoutingResourceError(
+                "Bad routes resource line {}: {} ({})".format(lineno, line, error)
+            )
+        raise RoutingResourceError(
+            "Bad routes resource line {}: {}".format(lineno, line)
+        )
+
+    @staticmethod
+    def parse_keywords(conf, tokens, keywords):
+        """Fill conf with "keyword value" pairs."""
+        if len(tokens) % 2:
+            raise ValueError("keyword without value")
+        for keyword, value in zip(tokens[::2], tokens[1::2]):
+            key, value_type = keywords[keyword]
+            conf[key] = value_type(value)
+        return conf
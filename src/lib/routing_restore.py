@@ -0,0 +1,121 @@
+"""Early-boot restore of the routing model.
+
+Runs as a systemd oneshot ordered before network-online.target, so that the
+charm's tables, routes and rules are all in place before the services waiting
+for the network start. It runs outside of the charm environment, so only the
+standard library is used.
+
+The configuration is a JSON file written by the charm:
+
+    {
+        "devices": ["eth0", "eth1"],    # devices the routes go through
+        "device_timeout": 30.0,         # seconds to wait for them to be up
+        "batch": [                      # ip -batch lines, routes then rules
+            "route replace default via 10.0.0.1 table SF1 proto 250",
+            "rule add from 10.0.0.0/24 table SF1 priority 100 protocol 250"
+        ]
+    }
+
+The restore waits until every device is up, or the timeout expires, then
+installs all the entries with a single "ip -force -batch" process. The time
+spent waiting and applying is written to a JSON stats file that the charm
+exports with its metrics.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+CONFIG_PATH = "/usr/local/lib/juju-charm-advanced-routing/boot-restore.json"
+STATS_PATH = "/usr/local/lib/juju-charm-advanced-routing/boot-restore-stats.json"
+SYS_CLASS_NET = "/sys/class/net"
+# operational states of a device able to carry the routes
+READY_STATES = {"up", "unknown"}
+POLL_INTERVAL = 0.1
+
+log = logging.getLogger("boot-restore")
+
+
+def device_ready(device, sys_class_net=SYS_CLASS_NET):
+    """Return True if the device exists and is up."""
+    try:
+        with open(os.path.join(sys_class_net, device, "operstate")) as operstate:
+            return operstate.read().strip() in READY_STATES
+    except OSError:
+        return False
+
+
+def wait_devices(devices, timeout, ready=device_ready):
+    """Wait until all devices are ready, return the ones that never were."""
+    deadline = time.monotonic() + timeout
+    pending = [device for device in devices if not ready(device)]
+    while pending and time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        pending = [device for device in pending if not ready(device)]
+    return pending
+
+
+def apply_batch(batch):
+    """Run the ip batch, return the number of failed lines."""
+    if not batch:
+        return 0
+    proc = subprocess.run(
+        ["ip", "-force", "-batch", "-"],
+        input="\n".join(batch) + "\n",
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    for line in proc.stderr.splitlines():
+        log.error("%s", line)
+    return proc.stderr.count("Command failed")
+
+
+def restore(config, ready=device_ready):
+    """Wait for the devices, apply the batch and return the stats."""
+    started = time.monotonic()
+    missing = wait_devices(
+        config.get("devices", []), config.get("device_timeout", 30.0), ready
+    )
+    if missing:
+        log.warning("Devices not up, their routes may fail: %s", " ".join(missing))
+    waited = time.monotonic()
+    failures = apply_batch(config.get("batch", []))
+    return {
+        "timestamp": round(time.time(), 3),
+        "wait_seconds": round(waited - started, 6),
+        "apply_seconds": round(time.monotonic() - waited, 6),
+        "missing_devices": missing,
+        "entries": len(config.get("batch", [])),
+        "failures": failures,
+    }
+
+
+def main(argv=None):
+    """Restore the routing model."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", default=CONFIG_PATH)
+    parser.add_argument("--stats", default=STATS_PATH)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    with open(args.config) as config_file:
+        stats = restore(json.load(config_file))
+    log.info(
+        "Restored %d entries in %.3fs after waiting %.3fs for the devices, "
+        "%d failed",
+        stats["entries"],
+        stats["apply_seconds"],
+        stats["wait_seconds"],
+        stats["failures"],
+    )
+    with open(args.stats, "w") as stats_file:
+        json.dump(stats, stats_file)
+    # failed entries are installed again once their interface comes up
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
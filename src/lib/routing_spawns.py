@@ -0,0 +1,75 @@
+"""Ledger of the external processes spawned by the charm.
+
+Once installed, every process started through the subprocess module (and
+thus through asyncio, charmhelpers and juju-log) is recorded with its
+command class, e.g. "ip route" or "juju-log", the time until it exited and
+its exit code. The records are kept by the routing metrics, which export
+them and log a per-hook summary.
+"""
+import os
+import subprocess
+import time
+
+from routing_metrics import metrics
+
+# commands whose first non-option argument names the operation
+SUBCOMMAND_TOOLS = {"ip", "systemctl"}
+# ip options followed by a value
+IP_VALUE_OPTIONS = {"-n", "-netns", "-b", "-batch", "-f", "-family", "-rc", "-rcvbuf"}
+
+_original_popen = subprocess.Popen
+
+
+def argv_class(args):
+    """Return the command class of an argv, e.g. "ip route" or "sh"."""
+    if isinstance(args, (str, bytes, os.PathLike)):
+        args = os.fsdecode(args).split()
+    args = [os.fsdecode(arg) for arg in args]
+    if not args:
+        return "?"
+    name = os.path.basename(args[0])
+    if name not in SUBCOMMAND_TOOLS:
+        return name
+    skip = False
+    for arg in args[1:]:
+        if skip:
+            skip = False
+        elif arg.startswith("-"):
+            skip = name == "ip" and arg in IP_VALUE_OPTIONS
+        else:
+            return "{} {}".format(name, arg)
+    return name
+
+
+class LedgerPopen(_original_popen):
+    """Popen recording its command class, duration and exit code."""
+
+    def __init__(self, args, *popen_args, **popen_kwargs):
+        """Start the process and open its ledger record."""
+        self._spawn = None
+        started = time.monotonic()
+        super().__init__(args, *popen_args, **popen_kwargs)
+        self._spawn = metrics.record_spawn(argv_class(args), started)
+
+    @property
+    def returncode(self):
+        """Return the exit code, or None while the process runs."""
+        return self.__dict__.get("_returncode")
+
+    @returncode.setter
+    def returncode(self, value):
+        # set by wait(), poll() and by the asyncio child watcher alike
+        self.__dict__["_returncode"] = value
+        if value is not None and self.__dict__.get("_spawn") is not None:
+            metrics.finish_spawn(self._spawn, value)
+            self._spawn = None
+
+
+def install():
+    """Record every process spawned from now on."""
+    subprocess.Popen = LedgerPopen
+
+
+def uninstall():
+    """Stop recording the spawned processes."""
+    subprocess.Popen = _original_popen
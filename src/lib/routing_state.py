@@ -0,0 +1,600 @@
+"""Kernel routing state.
+
+Takes structured snapshots of the kernel routes and policy rules through
+"ip -json", normalises them to the same keys as the charm configuration
+and computes the difference between a desired set of entries and what is
+installed.
+"""
+import collections
+import ipaddress
+import json
+import subprocess
+
+from routing_entry import RoutingEntryRule, RoutingEntryType
+
+FULL_MASK = 0xFFFFFFFF
+RuleSelector = collections.namedtuple(
+    "RuleSelector",
+    [
+        "src",
+        "dst",
+        "fwmark",
+        "iif",
+        "oif",
+        "invert",
+        "tos",
+        "uidrange",
+        "ipproto",
+        "sport",
+        "dport",
+        "suppress_prefixlength",
+    ],
+)
+# integer route metrics compared against the kernel
+ROUTE_METRICS = ("mtu", "advmss", "initcwnd", "initrwnd", "quickack")
+
+
+def ip_json(args):
+    """Run an ip command with JSON output and return the decoded list."""
+    output = subprocess.check_output(["ip", "-json"] + args).decode("utf8")
+    return json.loads(output) if output.strip() else []
+
+
+def conf_families(confs):
+    """Return the IP versions used by a list of config entries."""
+    families = {4}
+    for conf in confs:
+        for key in ("net", "gateway", "from-net", "to-net"):
+            if ":" in str(conf.get(key, "")):
+                families.add(6)
+    return sorted(families)
+
+
+def normalize_net(net, version=4):
+    """Return a network in canonical string form, "all" is kept as is."""
+    if net in (None, "all"):
+        return "all"
+    if net == "default":
+        return "0.0.0.0/0" if version == 4 else "::/0"
+    return str(ipaddress.ip_network(net, strict=False))
+
+
+def normalize_mark(fwmark):
+    """Return (mark, mask) integers for a "0x10/0xff" style fwmark."""
+    if not fwmark:
+        return None
+    mark, _, mask = str(fwmark).partition("/")
+    mark = int(mark, 0)
+    mask = int(mask, 0) if mask else FULL_MASK
+    return (mark, mask)
+
+
+def route_key(conf):
+    """Return the (table, destination, metric) identity of a route config."""
+    if conf.get("default_route"):
+        version = ipaddress.ip_address(conf["gateway"]).version
+        dst = normalize_net("default", version)
+    else:
+        dst = normalize_net(conf["net"])
+        version = ipaddress.ip_network(dst).version
+    default_metric = 1024 if version == 6 else 0
+    metric = int(conf.get("metric", default_metric))
+    return (conf.get("table", "main"), dst, metric)
+
+
+def route_attrs(conf):
+    """Return the attributes of a route config compared against the kernel."""
+    attrs = {
+        "gateway": conf.get("gateway"),
+        "dev": conf.get("device"),
+        "prefsrc": conf.get("src"),
+        "congctl": conf.get("congctl"),
+    }
+    for name in ROUTE_METRICS:
+        if name in conf:
+            attrs[name] = int(conf[name])
+    return {key: value for key, value in attrs.items() if value is not None}
+
+
+def kernel_route_key(route, version):
+    """Return the (table, destination, metric) identity of a kernel route."""
+    dst = normalize_net(route.get("dst", "default"), version)
+    return (str(route.get("table", "main")), dst, int(route.get("metric", 0)))
+
+
+def kernel_route_attrs(route):
+    """Return the comparable attributes of a kernel route."""
+    attrs = {
+        "gateway": route.get("gateway"),
+        "dev": route.get("dev"),
+        "prefsrc": route.get("prefsrc"),
+    }
+    for metric in route.get("metrics", []):
+        for name, value in metric.items():
+            if isinstance(value, list):  # locked metric, e.g. ["lock", 1400]
+                value = value[-1]
+            attrs[name] = value
+    return attrs
+
+
+def normalize_range(value):
+    """Return (start, end) integers for a "N" or "N-M" range."""
+    if value is None:
+        return None
+    start, _, end = str(value).partition("-")
+    return (int(start), int(end or start))
+
+
+def normalize_tos(tos):
+    """Return the tos as an integer, names are looked up in rt_dsfield."""
+    if tos is None:
+        return None
+    value = RoutingEntryRule.tos_value(tos)
+    return tos if value is None else value
+
+
+def rule_selector(conf):
+    """Return the selector of a rule config, without priority and table."""
+    suppress = conf.get("suppress_prefixlength")
+    return RuleSelector(
+        normalize_net(conf.get("from-net")),
+        normalize_net(conf.get("to-net")),
+        normalize_mark(conf.get("fwmark")),
+        conf.get("iif"),
+        conf.get("oif"),
+        bool(conf.get("not")),
+        normalize_tos(conf.get("tos")),
+        normalize_range(conf.get("uidrange")),
+        conf.get("ipproto"),
+        normalize_range(conf.get("sport")),
+        normalize_range(conf.get("dport")),
+        None if suppress is None else int(suppress),
+    )
+
+
+def rule_priority(conf):
+    """Return the priority of a rule config, or None if the kernel picks it."""
+    priority = conf.get("priority")
+    return None if priority is None else int(priority)
+
+
+def route_event_key(conf, table):
+    """Return the identity of a route config as rtnetlink reports it.
+
+    :param table: number of the table of the route
+    :returns: [version, table, destination, metric]
+    """
+    _, dst, metric = route_key(conf)
+    return [ipaddress.ip_network(dst).version, table, dst, metric]
+
+
+def rule_event_key(conf, table):
+    """Return the identity of a rule config as rtnetlink reports it.
+
+    :param table: number of the table the rule looks up
+    :returns: [version, table, src, dst, mark, mask, iif, oif, priority]
+    """
+    selector = rule_selector(conf)
+    nets = [
+        ipaddress.ip_network(net)
+        for net in (selector.src, selector.dst)
+        if net != "all"
+    ]
+    # the kernel does not tell "from all" from "from 0.0.0.0/0"
+    src, dst = (
+        "all" if net == "all" or ipaddress.ip_network(net).prefixlen == 0 else net
+        for net in (selector.src, selector.dst)
+    )
+    mark, mask = selector.fwmark or (None, None)
+    return [
+        nets[0].version if nets else 4,
+        table,
+        src,
+        dst,
+        mark,
+        mask,
+        selector.iif,
+        selector.oif,
+        rule_priority(conf),
+    ]
+
+
+def kernel_rule_selector(rule):
+    """Return the selector of a kernel rule, without priority and table."""
+
+    def net(addr, length):
+        if addr in (None, "all"):
+            return "all"
+        if length is None:
+            return normalize_net(addr)
+        return normalize_net("{}/{}".format(addr, length))
+
+    def port_range(name):
+        if name in rule:
+            return (rule[name], rule[name])
+        if name + "_start" in rule:
+            return (rule[name + "_start"], rule[name + "_end"])
+        return None
+
+    mark = None
+    if "fwmark" in rule:
+        mark = (int(rule["fwmark"], 0), int(rule.get("fwmask", hex(FULL_MASK)), 0))
+    uidrange = None
+    if "uid_start" in rule:
+        uidrange = (rule["uid_start"], rule["uid_end"])
+    return RuleSelector(
+        net(rule.get("src"), rule.get("srclen")),
+        net(rule.get("dst"), rule.get("dstlen")),
+        mark,
+        rule.get("iif"),
+        rule.get("oif"),
+        "not" in rule,
+        normalize_tos(rule.get("tos")),
+        uidrange,
+        rule.get("ipproto"),
+        port_range("sport"),
+        port_range("dport"),
+        rule.get("suppress_prefixlen"),
+    )
+
+
+def selector_args(selector):
+    """Return the ip rule arguments matching a selector."""
+    args = ["not"] if selector.invert else []
+    args.extend(["from", selector.src])
+    if selector.dst != "all":
+        args.extend(["to", selector.dst])
+    if selector.fwmark:
+        args.extend(["fwmark", "{:#x}/{:#x}".format(*selector.fwmark)])
+    for key in ("iif", "oif", "ipproto"):
+        value = getattr(selector, key)
+        if value is not None:
+            args.extend([key, str(value)])
+    if isinstance(selector.tos, int):
+        args.extend(["tos", "{:#04x}".format(selector.tos)])
+    elif selector.tos is not None:
+        args.extend(["tos", selector.tos])
+    for key in ("uidrange", "sport", "dport"):
+        value = getattr(selector, key)
+        if value is not None:
+            args.extend([key, "{}-{}".format(*value)])
+    return args
+
+
+def kernel_rule_del_cmd(rule, version):
+    """Return the command deleting exactly this kernel rule."""
+    cmd = ["ip", "-{}".format(version), "rule", "del"]
+    if "priority" in rule:
+        cmd.extend(["priority", str(rule["priority"])])
+    selector = kernel_rule_selector(rule)
+    cmd.extend(selector_args(selector))
+    cmd.extend(["table", str(rule.get("table", "main"))])
+    if selector.suppress_prefixlength is not None:
+        cmd.extend(["suppress_prefixlength", str(selector.suppress_prefixlength)])
+    if "protocol" in rule:
+        cmd.extend(["protocol", str(rule["protocol"])])
+    return cmd
+
+
+def kernel_route_del_cmd(route, version):
+    """Return the command deleting exactly this kernel route."""
+    cmd = ["ip", "-{}".format(version), "route", "del"]
+    if route.get("type", "unicast") != "unicast":
+        cmd.append(route["type"])
+    cmd.append(route.get("dst", "default"))
+    cmd.extend(["table", str(route.get("table", "main"))])
+    if "metric" in route:
+        cmd.extend(["metric", str(route["metric"])])
+    if "protocol" in route:
+        cmd.extend(["proto", str(route["protocol"])])
+    return cmd
+
+
+def is_tagged(entry):
+    """Return True if a dumped route or rule carries the charm's protocol."""
+    return str(entry.get("protocol")) in (
+        str(RoutingEntryType.protocol_id),
+        RoutingEntryType.protocol_name,
+    )
+
+
+def compact_route(route):
+    """Return the significant attributes of a dumped kernel route."""
+    compact = {"dst": route.get("dst", "default")}
+    for key in ("gateway", "dev", "metric", "prefsrc", "nexthops"):
+        if key in route:
+            compact[key] = route[key]
+    for metric in route.get("metrics", []):
+        compact.update(metric)
+    if route.get("flags"):
+        compact["flags"] = route["flags"]
+    return compact
+
+
+def compact_rule(rule):
+    """Return a dumped kernel rule without its table and protocol."""
+    return {
+        key: value
+        for key, value in rule.items()
+        if key not in ("table", "protocol") and value not in (None, [], "")
+    }
+
+
+def networks_overlap(net, prefix, version):
+    """Return True if a dumped destination or source overlaps the prefix."""
+    if net in (None, "all") or prefix.version != version:
+        return False
+    return ipaddress.ip_network(normalize_net(net, version)).overlaps(prefix)
+
+
+def route_matches(version, route, prefix=None, device=None):
+    """Return True if a dumped route passes the prefix and device filters."""
+    if prefix and not networks_overlap(route.get("dst", "default"), prefix, version):
+        return False
+    if device:
+        devices = [route.get("dev")]
+        devices.extend(hop.get("dev") for hop in route.get("nexthops", []))
+        return device in devices
+    return True
+
+
+def rule_matches(version, rule, prefix=None, device=None):
+    """Return True if a dumped rule passes the prefix and device filters."""
+    if prefix:
+        src = "{}/{}".format(rule["src"], rule["srclen"]) if "srclen" in rule else None
+        dst = "{}/{}".format(rule["dst"], rule["dstlen"]) if "dstlen" in rule else None
+        if not any(networks_overlap(net, prefix, version) for net in (src, dst)):
+            return False
+    if device:
+        return device in (rule.get("iif"), rule.get("oif"))
+    return True
+
+
+class KernelState:
+    """Structured snapshot of the kernel routes and rules."""
+
+    def __init__(self, routes=None, rules=None):
+        """Index routes by identity and rules by selector.
+
+        :param routes: list of (ip version, route dict) as dumped by ip -json
+        :param rules: list of (ip version, rule dict) as dumped by ip -json
+        """
+        self.route_list = list(routes or [])
+        self.rule_list = list(rules or [])
+        self.routes = {}
+        for version, route in self.route_list:
+            self.routes[kernel_route_key(route, version)] = route
+        self.rules = collections.defaultdict(list)
+        for _, rule in self.rule_list:
+            self.rules[kernel_rule_selector(rule)].append(rule)
+
+    @classmethod
+    def snapshot(cls, families=(4,), owned=False, routes=True):
+        """Dump the routes of all tables and all rules for the given families.
+
+        :param owned: only dump the routes and rules tagged by the charm
+        :param routes: dump the routes too, not only the rules
+        """
+        route_filter = []
+        if owned:
+            route_filter = ["proto", str(RoutingEntryType.protocol_id)]
+        route_list = []
+        rule_list = []
+        for version in families:
+            family = "-{}".format(version)
+            if routes:
+                dump = ip_json([family, "route", "show", "table", "all"] + route_filter)
+                route_list.extend((version, route) for route in dump)
+            # ip rule show ignores a protocol filter, the rules are filtered here
+            rules = ip_json([family, "rule", "show"])
+            rule_list.extend(
+                (version, rule) for rule in rules if not owned or is_tagged(rule)
+            )
+        return cls(route_list, rule_list)
+
+    def by_table(self, tables=None, table=None, prefix=None, device=None, limit=None):
+        """Group the routes and rules of the snapshot by table.
+
+        :param tables: {name: id} of the tables defined by the charm
+        :param table: only keep this table
+        :param prefix: only keep routes and rules whose networks overlap it
+        :param device: only keep routes via and rules matching this device
+        :param limit: maximum number of routes and rules kept
+        :returns: ({table: {"id", "routes", "rules"}}, number of matches)
+        """
+        if prefix:
+            prefix = ipaddress.ip_network(prefix, strict=False)
+        groups = collections.OrderedDict()
+        for name, table_id in sorted((tables or {}).items(), key=lambda t: t[1]):
+            if table in (None, name):
+                groups[name] = {"id": table_id, "routes": [], "rules": []}
+
+        matches = 0
+        for key, entries, matcher, compact in (
+            ("routes", self.route_list, route_matches, compact_route),
+            ("rules", self.rule_list, rule_matches, compact_rule),
+        ):
+            for version, entry in entries:
+                name = str(entry.get("table", "main"))
+                if table not in (None, name) or not matcher(
+                    version, entry, prefix, device
+                ):
+                    continue
+                matches += 1
+                if limit is not None and matches > limit:
+                    continue
+                group = groups.setdefault(name, {"routes": [], "rules": []})
+                group[key].append(compact(entry))
+        if prefix or device:
+            groups = collections.OrderedDict(
+                (name, group)
+                for name, group in groups.items()
+                if group["routes"] or group["rules"]
+            )
+        return groups, matches
+
+    def obsolete_cmds(self, desired):
+        """Return the commands deleting the entries missing from the desired ones.
+
+        Rules are deleted before routes, so that no rule is left looking up a
+        table whose routes are gone. Only the entries tagged by the charm are
+        deleted.
+
+        :param desired: list of validated config entries that are installed
+        """
+        routes = set()
+        rules = set()
+        for conf in desired:
+            if conf["type"] == "route":
+                routes.add(route_key(conf))
+            elif conf["type"] == "rule":
+                table = str(conf.get("table", "main"))
+                rules.add((rule_selector(conf), table, rule_priority(conf)))
+
+        cmds = []
+        for version, rule in self.rule_list:
+            if not is_tagged(rule):
+                continue
+            selector = kernel_rule_selector(rule)
+            table = str(rule.get("table", "main"))
+            if (selector, table, rule.get("priority")) in rules:
+                continue
+            if (selector, table, None) in rules:  # priority picked by the kernel
+                continue
+            cmds.append(kernel_rule_del_cmd(rule, version))
+        for version, route in self.route_list:
+            if is_tagged(route) and kernel_route_key(route, version) not in routes:
+                cmds.append(kernel_route_del_cmd(route, version))
+        return cmds
+
+    def route_state(self, conf):
+        """Return "unchanged", "replace" or "add" for a route config.
+
+        A route installed without the charm's protocol is replaced, to tag it.
+        """
+        route = self.routes.get(route_key(conf))
+        if route is None:
+            return "add"
+        if not is_tagged(route):
+            return "replace"
+        kernel_attrs = kernel_route_attrs(route)
+        for name, value in route_attrs(conf).items():
+            if kernel_attrs.get(name) != value:
+                return "replace"
+        return "unchanged"
+
+    def has_route(self, conf):
+        """Return True if a route with the config's identity is installed."""
+        return route_key(conf) in self.routes
+
+    def find_rules(self, conf):
+        """Return the installed rules with the config's selector and priority."""
+        priority = rule_priority(conf)
+        return [
+            rule
+            for rule in self.rules.get(rule_selector(conf), [])
+            if priority is None or rule.get("priority") == priority
+        ]
+
+    def rule_state(self, conf):
+        """Return "unchanged", "replace" or "add" for a rule config.
+
+        A rule installed without the charm's protocol is replaced, to tag it.
+        """
+        rules = self.find_rules(conf)
+        table = str(conf.get("table", "main"))
+        installed = [rule for rule in rules if str(rule.get("table")) == table]
+        if any(is_tagged(rule) for rule in installed):
+            return "unchanged"
+        if installed or (rules and rule_priority(conf) is not None):
+            return "replace"
+        return "add"
+
+    def has_rule(self, conf):
+        """Return True if the rule is installed with the same table."""
+        table = str(conf.get("table", "main"))
+        return any(str(rule.get("table")) == table for rule in self.find_rules(conf))
+
+
+class RoutingPlan:
+    """Difference between the desired entries and the kernel state."""
+
+    ops = ("add", "replace", "delete")
+
+    def __init__(self, desired, previous, state):
+        """Compute the plan.
+
+        :param desired: list of validated config entries to be installed
+        :param previous: list of config entries applied by the previous run
+        :param state: KernelState snapshot
+        """
+        self.state = state
+        self.changes = []
+        self.unchanged = 0
+        self.drift = 0
+
+        previous_keys = {self.identity(conf) for conf in previous}
+        desired_keys = set()
+        replaced_rules = set()
+        for conf in desired:
+            identity = self.identity(conf)
+            desired_keys.add(identity)
+            op = self.entry_state(conf, previous_keys)
+            if op == "unchanged":
+                self.unchanged += 1
+                continue
+            if op == "replace" and conf["type"] == "rule":
+                replaced_rules.add(identity[:3])
+            if identity in previous_keys:
+                # applied by the charm before but missing or changed since
+                self.drift += 1
+            self.changes.append((op, conf))
+
+        for conf in previous:
+            identity = self.identity(conf)
+            if identity in desired_keys or identity[:3] in replaced_rules:
+                continue
+            if self.is_installed(conf):
+                self.changes.append(("delete", conf))
+
+    def entry_state(self, conf, previous_keys):
+        """Return "unchanged", "replace" or "add" for a desired entry."""
+        if conf["type"] == "table":
+            return "unchanged" if self.identity(conf) in previous_keys else "add"
+        if conf["type"] == "route":
+            return self.state.route_state(conf)
+        return self.state.rule_state(conf)
+
+    def is_installed(self, conf):
+        """Return True if a previously applied entry is still installed."""
+        if conf["type"] == "table":
+            return True
+        if conf["type"] == "route":
+            return self.state.has_route(conf)
+        return self.state.has_rule(conf)
+
+    @staticmethod
+    def identity(conf):
+        """Return a hashable identity for a config entry."""
+        if conf["type"] == "table":
+            return ("table", conf["table"])
+        if conf["type"] == "route":
+            return ("route",) + route_key(conf)
+        return (
+            "rule",
+            rule_priority(conf),
+            rule_selector(conf),
+            str(conf.get("table", "main")),
+        )
+
+    def counts(self):
+        """Return the number of changes by operation."""
+        counts = collections.Counter(op for op, _ in self.changes)
+        summary = {op: counts[op] for op in self.ops}
+        summary["unchanged"] = self.unchanged
+        return summary
+
+    def listing(self, limit=None):
+        """Return up to limit changes as dicts."""
+        changes = self.changes if limit is None else self.changes[:limit]
+        return [{"op": op, "entry": conf} for op, conf in changes]
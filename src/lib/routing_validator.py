@@ -2,10 +2,17 @@
 
 Validates the entire json configuration constructing a model.
 """
+import collections
+import concurrent.futures
+import functools
 import ipaddress
+import itertools
 import json
+import multiprocessing
+import os
 import pprint
 import re
+import socket
 
 from charmhelpers.core import hookenv
 
@@ -15,11 +22,24 @@ from routing_entry import (
     RoutingEntryRoute,
     RoutingEntryRule,
     RoutingEntryTable,
-    RoutingEntryType,
+    RoutingModel,
 )
 
+from routing_resource import RoutingResource, RoutingResourceError
+
 TABLE_NAME_PATTERN = r"[a-zA-Z0-9]+[a-zA-Z0-9-]*"
 TABLE_NAME_PATTERN_RE = r"^{}$".format(TABLE_NAME_PATTERN)
+CONGCTL_PATTERN = re.compile(r"^[a-z0-9_]+$")
+TCP_METRICS = ("advmss", "initcwnd", "initrwnd")
+PROTOCOLS_PATH = "/etc/protocols"
+RANGE_PATTERN = re.compile(r"^(\d+)(?:-(\d+))?$")
+IPV4_TOS_MASK = 0x1E  # the IPv4 kernel rejects a rule tos outside of it
+PARALLEL_CHUNK_SIZE = 2000
+PARALLEL_CHUNKS_IN_FLIGHT = 2  # per worker, bounds the memory of chunk results
+# keys that may hold a list of networks or be given as a "<key>-range"
+TEMPLATE_KEYS = ("net", "from-net", "to-net")
+# rule selectors that imply "from-net": "all" when it is not set
+RULE_SELECTORS = ("oif", "tos", "uidrange", "ipproto", "sport", "dport")
 
 
 class RoutingConfigValidatorError(Exception):
@@ -31,6 +51,10 @@ class RoutingConfigValidatorError(Exception):
 class RoutingConfigValidator:
     """Validates the entire json configuration constructing model of rules."""
 
+    resource_digest = None  # SHA-256 of the routes resource, if one was read
+    parallel_threshold = 0  # verify routes and rules in parallel from this count
+    defer_missing_devices = False  # park entries of absent devices, not reject
+
     def __init__(self):
         """Init function."""
         hookenv.log("Init {}".format(self.__class__.__name__), level=hookenv.INFO)
@@ -38,26 +62,52 @@ class RoutingConfigValidator:
         self.pattern = re.compile(TABLE_NAME_PATTERN)
         self.tables = set([])
         self.config = []
+        self.model = RoutingModel()
+
+    def read_configurations(self, conf, resource_path=None):
+        """Read and parse the JSON configuration file.
 
-    def read_configurations(self, conf):
-        """Read and parse the JSON configuration file."""
+        Entries read from the routes resource, if one is attached, are merged
+        after the ones of the charm config option.
+        """
         json_decoded = []
 
-        if not conf:
+        if not conf and not resource_path:
             msg = "JSON data empty in charm config option 'advanced-routing-config'."
             self.report_error(msg)
 
         try:
-            json_decoded = json.loads(conf)
+            json_decoded = json.loads(conf) if conf else []
             hookenv.log("Read json config from juju config", level=hookenv.INFO)
         except ValueError as err:
             msg = "JSON format invalid, conf: {}, Error: {}".format(conf, err)
             self.report_error(msg)
 
+        if resource_path:
+            json_decoded = json_decoded + self.read_resource(resource_path)
+
         self.config = json_decoded
 
+    def read_resource(self, resource_path):
+        """Read the entries of the routes resource."""
+        resource = RoutingResource(resource_path)
+        try:
+            entries = resource.load()
+        except (OSError, RoutingResourceError) as err:
+            msg = "Routes resource {} invalid: {}".format(resource_path, err)
+            self.report_error(msg)
+        self.resource_digest = resource.digest
+        hookenv.log(
+            "Read {} entries from routes resource".format(len(entries)),
+            level=hookenv.INFO,
+        )
+        return entries
+
     def verify_config(self):
-        """Iterate entries in the config checking each type for sanity."""
+        """Iterate entries in the config checking each type for sanity.
+
+        :returns: the RoutingModel of the validated entries
+        """
         hookenv.log("Verifying json config", level=hookenv.INFO)
         type_order = ["table", "route", "rule"]
 
@@ -69,18 +119,125 @@ class RoutingConfigValidator:
 
         for entry_type in type_order:
             # get all the tables together first, so that we can provide strict relations
-            for conf in self.config:
-                try:
-                    type = conf["type"]
-                    verifier = dispatch_table[type]
-                except KeyError as error:
-                    msg = "Bad config: routing entry error, {}".format(error)
-                    self.report_error(msg)
-
-                if entry_type != type:
-                    continue
+            confs = self.expand_type(entry_type, dispatch_table)
+            head = []
+            if entry_type != "table" and self.parallel_threshold:
+                head = list(itertools.islice(confs, self.parallel_threshold))
+            if head and len(head) == self.parallel_threshold:
+                self.verify_parallel(entry_type, itertools.chain(head, confs))
+                continue
+            for conf in itertools.chain(head, confs):
+                dispatch_table[entry_type](conf)
+        return self.model
+
+    def expand_type(self, entry_type, dispatch_table):
+        """Yield the expanded config entries of one type."""
+        for conf in self.config:
+            try:
+                type = conf["type"]
+                dispatch_table[type]
+            except KeyError as error:
+                msg = "Bad config: routing entry error, {}".format(error)
+                self.report_error(msg)
 
-                verifier(conf)
+            if entry_type == type:
+                yield from self.expand(conf)
+
+    def verify_parallel(self, entry_type, confs):
+        """Verify routes or rules in chunks across a pool of processes.
+
+        The checks that only depend on an entry run in the workers, the table
+        and device references are verified once the chunks come back, in
+        config order.
+        """
+        workers = os.cpu_count() or 1
+        hookenv.log(
+            "Verifying {}s in chunks of {} with {} processes".format(
+                entry_type, PARALLEL_CHUNK_SIZE, workers
+            ),
+            level=hookenv.INFO,
+        )
+        entry_class = RoutingEntryRoute if entry_type == "route" else RoutingEntryRule
+        verify_references = getattr(self, "verify_{}_references".format(entry_type))
+        chunks = iter(lambda: list(itertools.islice(confs, PARALLEL_CHUNK_SIZE)), [])
+
+        def entries(results):
+            for checked, error in results:
+                if error:
+                    self.report_error(error)
+                for conf in checked:
+                    missing_device = verify_references(conf)
+                    yield entry_class(conf), missing_device
+
+        # forked workers inherit the charm's sys.path
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(workers, context) as executor:
+            results = submit_bounded(
+                executor,
+                functools.partial(check_chunk, entry_type),
+                chunks,
+                workers * PARALLEL_CHUNKS_IN_FLIGHT,
+            )
+            for entry, missing_device in entries(results):
+                self.model.add_entry(entry, missing_device)
+
+    def expand(self, conf):
+        """Yield the entries described by a config entry, one at a time.
+
+        A "net", "from-net" or "to-net" key may hold a list of networks, or be
+        given as a "<key>-range" of "count" networks of the size of "start",
+        "step" networks apart (default 1). An entry with several of them
+        yields every combination.
+        """
+        values = []
+        for key in TEMPLATE_KEYS:
+            range_key = "{}-range".format(key)
+            if range_key in conf:
+                if key in conf:
+                    self.report_error(
+                        "Bad network config: {} and {} are mutually exclusive "
+                        "in {}".format(key, range_key, conf)
+                    )
+                values.append((key, range_key, self.net_range(conf[range_key])))
+            elif isinstance(conf.get(key), list):
+                values.append((key, key, functools.partial(iter, conf[key])))
+
+        if not values:
+            yield conf
+            return
+
+        template = {
+            key: value
+            for key, value in conf.items()
+            if key not in {template_key for _, template_key, _ in values}
+        }
+        names = [key for key, _, _ in values]
+        for combination in combinations([nets for _, _, nets in values]):
+            yield dict(template, **dict(zip(names, combination)))
+
+    def net_range(self, spec):
+        """Return a function yielding the networks of a {start, count, step} range.
+
+        The range is checked at once, the networks are generated on each call.
+        """
+        try:
+            start = ipaddress.ip_network(spec["start"])
+            count = int(spec["count"])
+            step = int(spec.get("step", 1))
+            if count < 1 or step < 1:
+                raise ValueError("count and step must be positive")
+            # raises if the last network is out of the address space
+            start.network_address + (count - 1) * step * start.num_addresses
+        except (KeyError, TypeError, ValueError) as error:
+            msg = "Bad network config: invalid range {} - {}".format(spec, error)
+            self.report_error(msg)
+
+        def networks():
+            for index in range(count):
+                address = start.network_address + index * step * start.num_addresses
+                yield str(ipaddress.ip_network((address, start.prefixlen)))
+
+        return networks
 
     def verify_table(self, conf):
         """Verify tables."""
@@ -91,7 +248,7 @@ class RoutingConfigValidator:
         is_valid_name = self.pattern.match(conf["table"])
         if is_valid_name and conf["table"] not in self.tables:
             self.tables.add(conf["table"])
-            RoutingEntryType.add_entry(RoutingEntryTable(conf))
+            self.model.add_entry(RoutingEntryTable(conf))
             return
 
         if not is_valid_name:
@@ -109,14 +266,46 @@ class RoutingConfigValidator:
         )
 
         # Verify items in configuration
+        self.check_route(conf)
+        missing_device = self.verify_route_references(conf)
+
+        self.model.add_entry(RoutingEntryRoute(conf), missing_device)
+
+    def check_route(self, conf):
+        """Run the route checks that only depend on the entry itself."""
         self.verify_route_gateway(conf)
         self.verify_route_network(conf)
+        self.verify_route_metric(conf)
+        self.verify_route_src(conf)
+        self.verify_route_tcp_metrics(conf)
+        self.verify_route_congctl(conf)
+        self.verify_route_quickack(conf)
+        self.verify_route_backup_gateways(conf)
+
+    def verify_route_references(self, conf):
+        """Verify the tables and devices a route refers to.
+
+        :returns: the device of the route if it does not exist yet, else None
+        """
         table_exists = self.verify_route_table(conf)
         self.verify_route_default_route(conf, table_exists)
-        self.verify_route_device(conf)
-        self.verify_route_metric(conf)
+        return self.verify_route_device(conf)
 
-        RoutingEntryType.add_entry(RoutingEntryRoute(conf))
+    def verify_device(self, device):
+        """Verify a network device exists.
+
+        With defer_missing_devices, an absent device is accepted and returned
+        so that the entries using it are applied once it appears.
+        """
+        if device in netifaces.interfaces():
+            return None
+        if not self.defer_missing_devices:
+            self.report_error("Device {} does not exist".format(device))
+        hookenv.log(
+            "Device {} does not exist, deferring its entries".format(device),
+            level=hookenv.WARNING,
+        )
+        return device
 
     def verify_route_gateway(self, conf):
         """Verify route gateway in conf.
@@ -211,12 +400,10 @@ class RoutingConfigValidator:
         Need either "device" or "gateway"
         """
         try:
-            if conf["device"] not in netifaces.interfaces():
-                msg = "Device {} does not exist".format(conf["device"])
-                self.report_error(msg)
+            return self.verify_device(conf["device"])
         except KeyError:
             if "gateway" in conf:
-                return
+                return None
             self.report_error("Need either 'gateway' or 'device'")
 
     def verify_route_metric(self, conf):
@@ -233,6 +420,106 @@ class RoutingConfigValidator:
             msg = "Bad network config: metric expected to be integer"
             self.report_error(msg)
 
+    def verify_route_src(self, conf):
+        """Verify route preferred source address.
+
+        "src" is an optional configuration parameter, it must be of the same
+        address family as the route.
+        """
+        if "src" not in conf:
+            return
+        try:
+            src = ipaddress.ip_address(conf["src"])
+        except ValueError as error:
+            msg = "Bad network config: {} - {}".format(conf["src"], error)
+            self.report_error(msg)
+
+        if conf.get("default_route"):
+            version = ipaddress.ip_address(conf["gateway"]).version
+        elif "net" in conf:
+            version = ipaddress.ip_network(conf["net"]).version
+        else:
+            msg = "Bad network config: src {} needs the route 'net' def".format(
+                conf["src"]
+            )
+            self.report_error(msg)
+        if src.version != version:
+            msg = "Bad network config: src {} is not an IPv{} address in {}".format(
+                conf["src"], version, conf
+            )
+            self.report_error(msg)
+
+    def verify_route_tcp_metrics(self, conf):
+        """Verify route TCP metrics.
+
+        "advmss", "initcwnd" and "initrwnd" are optional configuration
+        parameters, expected to be positive integers. They are rendered as
+        given, so floats and booleans are rejected too.
+        """
+        for key in TCP_METRICS:
+            if key not in conf:
+                continue
+            value = conf[key]
+            if isinstance(value, (int, str)) and not isinstance(value, bool):
+                if re.fullmatch(r"[0-9]+", str(value)) and int(value) > 0:
+                    continue
+            msg = "Bad network config: {} expected to be a positive integer".format(key)
+            self.report_error(msg)
+
+    def verify_route_congctl(self, conf):
+        """Verify route congestion control algorithm.
+
+        "congctl" is an optional configuration parameter. The algorithm module
+        is loaded by the kernel on demand, so only the name format is checked.
+        """
+        congctl = conf.get("congctl")
+        if congctl is not None and not CONGCTL_PATTERN.match(str(congctl)):
+            msg = "Bad network config: congctl {} is not a valid algorithm".format(
+                congctl
+            )
+            self.report_error(msg)
+
+    def verify_route_quickack(self, conf):
+        """Verify route quickack.
+
+        "quickack" is an optional configuration parameter, a boolean or 0/1.
+        """
+        if "quickack" not in conf:
+            return
+        if conf["quickack"] not in (True, False, 0, 1):
+            msg = "Bad network config: quickack expected to be bool in {}".format(conf)
+            self.report_error(msg)
+        # ip(8) only understands 0 and 1
+        conf["quickack"] = int(conf["quickack"])
+
+    def verify_route_backup_gateways(self, conf):
+        """Verify route backup gateways.
+
+        "backup_gateways" is an optional list of addresses of the same family
+        as "gateway", used by the gateway monitor when the gateway is dead.
+        """
+        backups = conf.get("backup_gateways")
+        if backups is None:
+            return
+        if "gateway" not in conf or not isinstance(backups, list):
+            msg = "Bad network config: backup_gateways should be a list and need "
+            msg += "a 'gateway' in {}".format(conf)
+            self.report_error(msg)
+        try:
+            version = ipaddress.ip_address(conf["gateway"]).version
+        except ValueError as error:
+            self.report_error("Bad gateway IP: {} - {}".format(conf["gateway"], error))
+        for backup in backups:
+            try:
+                if ipaddress.ip_address(backup).version == version:
+                    continue
+                msg = "Bad network config: backup gateway {} is not IPv{}".format(
+                    backup, version
+                )
+            except ValueError as error:
+                msg = "Bad backup gateway IP: {} - {}".format(backup, error)
+            self.report_error(msg)
+
     def verify_rule(self, conf):
         """Verify rules."""
         hookenv.log(
@@ -240,14 +527,35 @@ class RoutingConfigValidator:
         )
 
         # Verify items in configuration
+        self.check_rule(conf)
+        missing_device = self.verify_rule_references(conf)
+
+        self.model.add_entry(RoutingEntryRule(conf), missing_device)
+
+    def check_rule(self, conf):
+        """Run the rule checks that only depend on the entry itself."""
         self.verify_rule_mark(conf)
-        self.verify_rule_iif(conf)
+        self.verify_rule_tos(conf)
+        self.verify_rule_uidrange(conf)
+        self.verify_rule_ipproto(conf)
+        self.verify_rule_ports(conf)
+        self.verify_rule_not(conf)
+        self.verify_rule_suppress_prefixlength(conf)
+        if not conf.get("from-net") and any(key in conf for key in RULE_SELECTORS):
+            conf["from-net"] = "all"
         self.verify_rule_from_net(conf)
         self.verify_rule_to_net(conf)
-        self.verify_rule_table(conf)
         self.verify_rule_prirority(conf)
 
-        RoutingEntryType.add_entry(RoutingEntryRule(conf))
+    def verify_rule_references(self, conf):
+        """Verify the tables and devices a rule refers to.
+
+        :returns: the first device of the rule not existing yet, else None
+        """
+        missing_iif = self.verify_rule_iif(conf)
+        missing_oif = self.verify_rule_oif(conf)
+        self.verify_rule_table(conf)
+        return missing_iif or missing_oif
 
     def verify_rule_mark(self, conf):
         """
@@ -279,10 +587,135 @@ class RoutingConfigValidator:
         "iif" key isn't required, but verify the network device exists
         """
         iif = conf.get("iif")
-        if iif and iif not in netifaces.interfaces():
-            msg = "Device {} does not exist".format(iif)
+        if iif:
+            return self.verify_device(iif)
+        return None
+
+    def verify_rule_oif(self, conf):
+        """
+        Verify rule output interface.
+
+        "oif" key isn't required, but verify the network device exists
+        """
+        oif = conf.get("oif")
+        if oif:
+            return self.verify_device(oif)
+        return None
+
+    def verify_rule_tos(self, conf):
+        """Verify rule type of service.
+
+        "tos" key isn't required. It is stored in hex. IPv6 rules match the
+        whole traffic class, IPv4 rules only the TOS bits.
+        """
+        if "tos" not in conf:
+            return
+        ipv6 = any(":" in str(conf.get(key, "")) for key in ("from-net", "to-net"))
+        mask = 0xFF if ipv6 else IPV4_TOS_MASK
+        try:
+            tos = int(str(conf["tos"]), 0)
+            if 0 <= tos <= 0xFF and not tos & ~mask:
+                conf["tos"] = "0x{:02x}".format(tos)
+                return
+        except ValueError:
+            pass
+        self.report_error("Bad network config: tos {} invalid".format(conf["tos"]))
+
+    def parse_range(self, conf, key, maximum):
+        """Return (start, end) of a "N" or "N-M" range, reporting errors."""
+        match = RANGE_PATTERN.match(str(conf[key]))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2) or start)
+            if start <= end <= maximum:
+                return start, end
+        msg = "Bad network config: {} {} is not a valid range".format(key, conf[key])
+        self.report_error(msg)
+
+    def verify_rule_uidrange(self, conf):
+        """Verify rule uid range.
+
+        "uidrange" key isn't required. It is stored as "start-end".
+        """
+        if "uidrange" in conf:
+            conf["uidrange"] = "{}-{}".format(
+                *self.parse_range(conf, "uidrange", 0xFFFFFFFF)
+            )
+
+    def verify_rule_ipproto(self, conf):
+        """Verify rule IP protocol.
+
+        "ipproto" key isn't required. Protocol numbers and names are stored
+        by the first name of the protocol when one is known, as listed by
+        ip rule, e.g. "6" and "TCP" are stored as "tcp".
+        """
+        ipproto = conf.get("ipproto")
+        if ipproto is None:
+            return
+        try:
+            if str(ipproto).isdigit():
+                number = int(ipproto)
+                if number > 0xFF:
+                    raise OSError("out of range")
+            else:
+                number = socket.getprotobyname(str(ipproto).lower())
+            conf["ipproto"] = self.protocol_name(number)
+            return
+        except OSError as error:
+            msg = "Bad network config: ipproto {} - {}".format(ipproto, error)
+        self.report_error(msg)
+
+    def protocol_name(self, number):
+        """Return the first name of a protocol number in /etc/protocols."""
+        try:
+            with open(PROTOCOLS_PATH) as protocols:
+                for line in protocols:
+                    fields = line.split("#", 1)[0].split()
+                    if len(fields) > 1 and fields[1] == str(number):
+                        return fields[0]
+        except OSError:
+            pass
+        return str(number)
+
+    def verify_rule_ports(self, conf):
+        """Verify rule source and destination ports.
+
+        "sport" and "dport" keys aren't required. A single port is stored as
+        "port", a range as "start-end".
+        """
+        for key in ("sport", "dport"):
+            if key not in conf:
+                continue
+            start, end = self.parse_range(conf, key, 0xFFFF)
+            conf[key] = str(start) if start == end else "{}-{}".format(start, end)
+
+    def verify_rule_not(self, conf):
+        """Verify rule inversion.
+
+        "not" key isn't required, it inverts the selector of the rule.
+        """
+        if not isinstance(conf.get("not", False), bool):
+            msg = "Bad network config: not should be bool in {}".format(conf)
             self.report_error(msg)
 
+    def verify_rule_suppress_prefixlength(self, conf):
+        """Verify rule suppress_prefixlength.
+
+        "suppress_prefixlength" key isn't required. Lookup results with a
+        prefix length lower or equal to it are ignored.
+        """
+        if "suppress_prefixlength" not in conf:
+            return
+        try:
+            if 0 <= int(conf["suppress_prefixlength"]) <= 128:
+                return
+        except ValueError:
+            pass
+        msg = "Bad network config: suppress_prefixlength {} invalid".format(
+            conf["suppress_prefixlength"]
+        )
+        self.report_error(msg)
+
     def verify_rule_from_net(self, conf):
         """Verify rule source network.
 
@@ -343,3 +776,49 @@ class RoutingConfigValidator:
         """Error reporting."""
         hookenv.log(msg, level=hookenv.ERROR)
         raise RoutingConfigValidatorError(msg)
+
+
+def check_chunk(entry_type, confs):
+    """Run the per-entry checks of a chunk of routes or rules.
+
+    Runs in a worker process of RoutingConfigValidator.verify_parallel.
+
+    :returns: (the normalized entries, None) or ([], the first error)
+    """
+    check = getattr(RoutingConfigValidator(), "check_{}".format(entry_type))
+    try:
+        for conf in confs:
+            check(conf)
+    except RoutingConfigValidatorError as error:
+        return [], str(error)
+    return confs, None
+
+
+def combinations(sources):
+    """Yield the cartesian product of networks, as itertools.product does.
+
+    Unlike itertools.product, the networks are not stored: each source is a
+    function returning an iterator, called again for every combination of
+    the sources before it.
+    """
+    if not sources:
+        yield ()
+        return
+    for head in sources[0]():
+        for tail in combinations(sources[1:]):
+            yield (head,) + tail
+
+
+def submit_bounded(executor, fn, iterable, limit):
+    """Yield the results of fn over iterable, in order, like executor.map.
+
+    Unlike executor.map, which submits every item at once, at most limit
+    items are submitted and not yet consumed at any time.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,327 @@
+"""Kernel route and rule event watcher.
+
+Listens to the rtnetlink route and rule notifications and installs again the
+charm's entries that something else deleted, e.g. networkd flushing a table,
+without waiting for the next interface event. It runs as a systemd service
+outside of the charm environment, so only the standard library is used.
+
+The configuration is a JSON file written by the charm:
+
+    {
+        "rate": 20.0,           # repairs per second, over all entries
+        "max_repairs": 5,       # repairs of one entry per window
+        "window": 60.0,         # seconds
+        "entries": [
+            {
+                "name": "route 10.0.0.0/24 table SF1",
+                "kind": "route",
+                "key": [4, 100, "10.0.0.0/24", 0],
+                "cmd": ["ip", "route", "replace", ...]
+            },
+            {
+                "name": "rule from 10.0.0.0/24 table SF1",
+                "kind": "rule",
+                "key": [4, 100, "10.0.0.0/24", "all", null, null, null, null, 100],
+                "cmd": ["ip", "rule", "add", ...]
+            }
+        ]
+    }
+
+Route keys are [version, table, destination, metric] and rule keys [version,
+table, src, dst, fwmark, mask, iif, oif, priority], the priority being null
+when the kernel picks it. Only the deletions of entries tagged with the
+charm's protocol are looked up, in a dict, and only the deleted entry is
+installed again.
+
+An entry deleted more than "max_repairs" times within "window" seconds is
+left alone until the window passes, as another agent is then managing it.
+"""
+import argparse
+import collections
+import errno
+import ipaddress
+import json
+import logging
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+CONFIG_PATH = "/usr/local/lib/juju-charm-advanced-routing/event-watcher.json"
+PROTOCOL = 250  # routing protocol tagging the charm's routes and rules
+RECV_BUFFER = 4 * 1024 * 1024  # absorbs the events of a table flush
+
+NETLINK_ROUTE = 0
+RTM_DELROUTE = 25
+RTM_DELRULE = 33
+# multicast groups: RTMGRP_IPV4_ROUTE, RTMGRP_IPV6_ROUTE, RTNLGRP_IPV4_RULE
+# and RTNLGRP_IPV6_RULE
+GROUPS = 0x40 | 0x400 | 1 << (8 - 1) | 1 << (19 - 1)
+FAMILIES = {socket.AF_INET: 4, socket.AF_INET6: 6}
+
+NLMSGHDR = struct.Struct("=IHHII")
+# struct rtmsg, and struct fib_rule_hdr of the same layout
+RTMSG = struct.Struct("=BBBBBBBBI")
+RTATTR = struct.Struct("=HH")
+U32 = struct.Struct("=I")
+
+RTA_DST = 1
+RTA_PRIORITY = 6
+RTA_TABLE = 15
+FRA_DST = 1
+FRA_SRC = 2
+FRA_IFNAME = 3
+FRA_PRIORITY = 6
+FRA_FWMARK = 10
+FRA_TABLE = 15
+FRA_FWMASK = 16
+FRA_OIFNAME = 17
+FRA_PROTOCOL = 21
+
+log = logging.getLogger("event-watcher")
+
+
+def align(length):
+    """Round a netlink length up to the 4 bytes alignment."""
+    return (length + 3) & ~3
+
+
+def messages(data):
+    """Yield the (type, payload) of the netlink messages in a datagram."""
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, msg_type, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            return
+        start = offset + NLMSGHDR.size
+        yield msg_type, data[start:offset + length]
+        offset += align(length)
+
+
+def attributes(payload):
+    """Return {type: bytes} of the attributes following a rtmsg header."""
+    attrs = {}
+    offset = RTMSG.size
+    while offset + RTATTR.size <= len(payload):
+        length, attr_type = RTATTR.unpack_from(payload, offset)
+        if length < RTATTR.size:
+            break
+        start = offset + RTATTR.size
+        attrs[attr_type] = payload[start:offset + length]
+        offset += align(length)
+    return attrs
+
+
+def u32(attrs, attr_type, default=None):
+    """Return an integer attribute."""
+    if attr_type not in attrs:
+        return default
+    return U32.unpack_from(attrs[attr_type])[0]
+
+
+def string(attrs, attr_type):
+    """Return a NUL terminated string attribute."""
+    if attr_type not in attrs:
+        return None
+    return attrs[attr_type].split(b"\0", 1)[0].decode()
+
+
+def network(attrs, attr_type, prefixlen):
+    """Return a network attribute in canonical form, "all" for none."""
+    if attr_type not in attrs or not prefixlen:
+        return "all"
+    address = ipaddress.ip_address(attrs[attr_type])
+    return str(ipaddress.ip_network((address, prefixlen), strict=False))
+
+
+def route_key(payload):
+    """Return the key of a deleted route tagged by the charm, or None."""
+    family, dst_len, _, _, table, protocol, _, _, _ = RTMSG.unpack_from(payload)
+    if protocol != PROTOCOL or family not in FAMILIES:
+        return None
+    version = FAMILIES[family]
+    attrs = attributes(payload)
+    dst = network(attrs, RTA_DST, dst_len)
+    if dst == "all":
+        dst = "0.0.0.0/0" if version == 4 else "::/0"
+    return (version, u32(attrs, RTA_TABLE, table), dst, u32(attrs, RTA_PRIORITY, 0))
+
+
+def rule_key(payload):
+    """Return the key of a deleted rule tagged by the charm, or None."""
+    family, dst_len, src_len, _, table, _, _, _, _ = RTMSG.unpack_from(payload)
+    attrs = attributes(payload)
+    if attrs.get(FRA_PROTOCOL, b"\0")[0] != PROTOCOL or family not in FAMILIES:
+        return None
+    version = FAMILIES[family]
+    mark = u32(attrs, FRA_FWMARK)
+    mask = u32(attrs, FRA_FWMASK)
+    if not mark and not mask:
+        mark = mask = None
+    return (
+        version,
+        u32(attrs, FRA_TABLE, table),
+        network(attrs, FRA_SRC, src_len),
+        network(attrs, FRA_DST, dst_len),
+        mark,
+        mask,
+        string(attrs, FRA_IFNAME),
+        string(attrs, FRA_OIFNAME),
+        u32(attrs, FRA_PRIORITY),
+    )
+
+
+class EventWatcher:
+    """Install again the deleted entries of the desired model."""
+
+    def __init__(
+        self,
+        entries,
+        rate=20.0,
+        max_repairs=5,
+        window=60.0,
+        run=subprocess.run,
+        clock=time.monotonic,
+    ):
+        """Init function.
+
+        :param entries: list of {"name", "kind", "key", "cmd"}
+        :param rate: repairs per second, over all entries
+        :param max_repairs: repairs of one entry within window seconds
+        :param run: function running a command
+        :param clock: function returning the time in seconds
+        """
+        self.index = {}  # (kind, key) -> [entry]
+        for entry in entries:
+            self.index.setdefault((entry["kind"], tuple(entry["key"])), []).append(
+                entry
+            )
+        self.rate = rate
+        self.tokens = rate
+        self.max_repairs = max_repairs
+        self.window = window
+        self.run = run
+        self.clock = clock
+        self.refilled = clock()
+        self.repairs = collections.defaultdict(collections.deque)
+
+    def lookup(self, msg_type, payload):
+        """Return the desired entry deleted by an event, or None."""
+        if msg_type == RTM_DELROUTE:
+            key = route_key(payload)
+            candidates = key and self.index.get(("route", key))
+        elif msg_type == RTM_DELRULE:
+            key = rule_key(payload)
+            # rules added without priority are indexed without it
+            candidates = key and (
+                self.index.get(("rule", key))
+                or self.index.get(("rule", key[:-1] + (None,)))
+            )
+        else:
+            return None
+        if not candidates:
+            return None
+        if len(candidates) > 1:
+            # adding the wrong one would duplicate a rule still installed
+            log.warning(
+                "%d entries match the deletion of %s, leaving them to the next "
+                "interface event",
+                len(candidates),
+                candidates[0]["name"],
+            )
+            return None
+        return candidates[0]
+
+    def allow(self, entry):
+        """Return True if the rate limits let an entry be repaired now."""
+        now = self.clock()
+        self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        repairs = self.repairs[entry["name"]]
+        while repairs and repairs[0] <= now - self.window:
+            repairs.popleft()
+        if len(repairs) >= self.max_repairs:
+            if len(repairs) == self.max_repairs:
+                log.warning(
+                    "%s deleted %d times in %.0fs, another agent manages it, "
+                    "leaving it alone",
+                    entry["name"],
+                    len(repairs),
+                    self.window,
+                )
+                repairs.append(now)  # warn once per window
+            return False
+        if self.tokens < 1:
+            log.warning("Repair rate exceeded, not installing %s", entry["name"])
+            return False
+        self.tokens -= 1
+        repairs.append(now)
+        return True
+
+    def handle(self, msg_type, payload):
+        """Repair the entry deleted by an event, return it if repaired."""
+        entry = self.lookup(msg_type, payload)
+        if entry is None or not self.allow(entry):
+            return None
+        started = self.clock()
+        proc = self.run(
+            entry["cmd"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        if proc.returncode:
+            # e.g. the device of the route went down, its up script will run
+            log.warning("Cannot install %s: %s", entry["name"], proc.stderr.strip())
+            return None
+        log.info(
+            "Installed %s again in %.1fms",
+            entry["name"],
+            (self.clock() - started) * 1000,
+        )
+        return entry
+
+    def watch(self, sock):
+        """Handle the events received on a netlink socket, forever."""
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError as error:
+                if error.errno != errno.ENOBUFS:
+                    raise
+                log.warning("Events lost, the receive buffer overflowed")
+                continue
+            for msg_type, payload in messages(data):
+                self.handle(msg_type, payload)
+
+
+def open_socket():
+    """Return a netlink socket subscribed to the route and rule events."""
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+    sock.bind((0, GROUPS))
+    return sock
+
+
+def main(argv=None):
+    """Run the event watcher."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", default=CONFIG_PATH)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+    watcher = EventWatcher(
+        config["entries"],
+        config.get("rate", 20.0),
+        config.get("max_repairs", 5),
+        config.get("window", 60.0),
+    )
+    log.info("Watching %d entries", len(config["entries"]))
+    watcher.watch(open_socket())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
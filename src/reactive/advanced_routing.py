@@ -3,25 +3,54 @@ import sys
 
 from advanced_routing_helper import AdvancedRoutingHelper, PolicyRoutingExists
 
+from charmhelpers.core import hookenv
+
 from charms.layer import status
-from charms.reactive import clear_flag, set_flag, when, when_not
+from charms.reactive import (
+    clear_flag,
+    hook,
+    is_flag_set,
+    set_flag,
+    when,
+    when_any,
+    when_not,
+)
+
+from routing_profiler import profile
+
+import routing_spawns
 
 from routing_validator import RoutingConfigValidatorError
 
 
+routing_spawns.install()
+
 try:
     advanced_routing = AdvancedRoutingHelper()
 except PolicyRoutingExists as error:
     status.blocked(str(error))
     sys.exit(0)
 
+hookenv.atexit(advanced_routing.record_run)
+
 
-def apply_config():
+def ready_status():
+    """Set the active status, naming the devices entries are waiting for."""
+    devices = advanced_routing.deferred_devices
+    if devices:
+        status.active(
+            "Unit is ready, waiting for devices: {}".format(" ".join(devices))
+        )
+    else:
+        status.active("Unit is ready")
+
+
+def apply_config(reconcile=False):
     """Set if-up/down scripts and run them."""
     status.maintenance("Installing routes")
     try:
         advanced_routing.setup()
-        advanced_routing.apply_config()
+        advanced_routing.apply_config(reconcile)
         return True
     except RoutingConfigValidatorError as error:
         status.blocked(str(error))
@@ -31,36 +60,64 @@ def apply_config():
 @when_not("advanced-routing.installed")
 def install_routing():
     """Install the charm."""
-    if not advanced_routing.is_advanced_routing_enabled:
-        status.blocked("Advanced routing is disabled")
-        return
+    with profile("install_routing"):
+        if not advanced_routing.is_advanced_routing_enabled:
+            status.blocked("Advanced routing is disabled")
+            return
 
-    if advanced_routing.is_action_managed:
-        status.blocked("Changes pending via apply-changes action")
-        return
+        if advanced_routing.is_action_managed:
+            status.blocked("Changes pending via apply-changes action")
+            return
+
+        if not apply_config():
+            return
+
+        set_flag("advanced-routing.installed")
+        ready_status()
 
-    if not apply_config():
-        return
 
-    set_flag("advanced-routing.installed")
-    status.active("Unit is ready")
+@hook("upgrade-charm")
+def upgrade_charm():
+    """Keep the installed routes, the new charm reconciles them in place.
+
+    Attaching a new routes resource runs the upgrade-charm hook too.
+    """
+    advanced_routing.migrate_state()
+    set_flag("advanced-routing.upgraded")
+    set_flag("advanced-routing.resource-changed")
 
 
 @when("advanced-routing.installed")
-@when("config.changed")
+@when_any("config.changed", "advanced-routing.resource-changed")
 def reconfigure_routing():
     """Handle routing configuration change."""
-    if advanced_routing.is_action_managed:
-        status.blocked("Changes pending via apply-changes action")
+    with profile("reconfigure_routing"):
+        clear_flag("advanced-routing.resource-changed")
+        if advanced_routing.is_action_managed:
+            status.blocked("Changes pending via apply-changes action")
+            return
+
+        if not advanced_routing.is_advanced_routing_enabled:
+            status.maintenance("Removing routes")
+            advanced_routing.remove_routes()
+            clear_flag("advanced-routing.installed")
+            clear_flag("advanced-routing.upgraded")
+            return
+
+        # the new entries are installed before the obsolete ones are removed,
+        # after an upgrade only those the kernel does not have as configured
+        if not apply_config(reconcile=is_flag_set("advanced-routing.upgraded")):
+            return
+
+        clear_flag("advanced-routing.upgraded")
+        ready_status()
+
+
+@hook("update-status")
+def apply_deferred():
+    """Apply the entries of the devices that appeared since the last run."""
+    if not is_flag_set("advanced-routing.installed"):
         return
-
-    status.maintenance("Removing routes")
-    advanced_routing.remove_routes()
-    if not advanced_routing.is_advanced_routing_enabled:
-        clear_flag("advanced-routing.installed")
-        return
-
-    if not apply_config():
-        return
-
-    status.active("Unit is ready")
+    with profile("apply_deferred"):
+        if advanced_routing.apply_deferred():
+            ready_status()
@@ -30,16 +30,19 @@ JSON_CONFIGS = [
             "# This file is managed by Juju.\n"
             "ip route flush cache\n"
             "# Table: name SF1\n"
-            "ip route replace default via 10.191.86.2 table SF1 dev ens3 metric 101\n"
-            "ip route replace 6.6.6.0/24 via 10.191.86.2\n"
-            "ip rule add from 192.170.2.0/24 to 192.170.2.0/24 table SF1 priority 101\n"
+            "ip route replace default via 10.191.86.2 table SF1 dev ens3 metric 101"
+            " proto 250\n"
+            "ip route replace 6.6.6.0/24 via 10.191.86.2 proto 250\n"
+            "ip rule add from 192.170.2.0/24 to 192.170.2.0/24 table SF1 priority 101"
+            " protocol 250\n"
         ),
         "expected_ifdown": (
             "#!/bin/sh\n"
             "# This file is managed by Juju.\n"
-            "ip rule del from 192.170.2.0/24 to 192.170.2.0/24 table SF1 priority 101\n"
-            "ip route del 6.6.6.0/24 via 10.191.86.2\n"
-            "ip route del default via 10.191.86.2 table SF1 dev ens3 metric 101\n"
+            "ip -4 route flush table all proto 250\n"
+            "ip -6 route flush table all proto 250\n"
+            "ip rule del from 192.170.2.0/24 to 192.170.2.0/24 table SF1 priority 101"
+            " protocol 250\n"
             "ip route flush table SF1\n"
             "ip rule del table SF1\n"
             "ip route flush cache\n"
@@ -72,16 +75,17 @@ JSON_CONFIGS = [
             "# This file is managed by Juju.\n"
             "ip route flush cache\n"
             "# Table: name mytable\n"
-            "ip route replace default via 10.205.6.1 table mytable\n"
-            "ip rule add from 10.205.6.0/24 to 1.1.1.1/32 priority 100\n"
-            "ip rule add from 10.205.6.0/24 table mytable priority 101\n"
+            "ip route replace default via 10.205.6.1 table mytable proto 250\n"
+            "ip rule add from 10.205.6.0/24 to 1.1.1.1/32 priority 100 protocol 250\n"
+            "ip rule add from 10.205.6.0/24 table mytable priority 101 protocol 250\n"
         ),
         "expected_ifdown": (
             "#!/bin/sh\n"
             "# This file is managed by Juju.\n"
-            "ip rule del from 10.205.6.0/24 table mytable priority 101\n"
-            "ip rule del from 10.205.6.0/24 to 1.1.1.1/32 priority 100\n"
-            "ip route del default via 10.205.6.1 table mytable\n"
+            "ip -4 route flush table all proto 250\n"
+            "ip -6 route flush table all proto 250\n"
+            "ip rule del from 10.205.6.0/24 table mytable priority 101 protocol 250\n"
+            "ip rule del from 10.205.6.0/24 to 1.1.1.1/32 priority 100 protocol 250\n"
             "ip route flush table mytable\n"
             "ip rule del table mytable\n"
             "ip route flush cache\n"
@@ -115,16 +119,19 @@ JSON_CONFIGS = [
             "# This file is managed by Juju.\n"
             "ip route flush cache\n"
             "# Table: name mytable\n"
-            "ip route replace 1.1.2.0/24 dev ens3 table mytable\n"
-            "ip rule add from all to 1.1.2.1/32 priority 100\n"
-            "ip rule add from 10.205.7.0/24 to all table mytable priority 101\n"
+            "ip route replace 1.1.2.0/24 dev ens3 table mytable proto 250\n"
+            "ip rule add from all to 1.1.2.1/32 priority 100 protocol 250\n"
+            "ip rule add from 10.205.7.0/24 to all table mytable priority 101"
+            " protocol 250\n"
         ),
         "expected_ifdown": (
             "#!/bin/sh\n"
             "# This file is managed by Juju.\n"
-            "ip rule del from 10.205.7.0/24 to all table mytable priority 101\n"
-            "ip rule del from all to 1.1.2.1/32 priority 100\n"
-            "ip route del 1.1.2.0/24 dev ens3 table mytable\n"
+            "ip -4 route flush table all proto 250\n"
+            "ip -6 route flush table all proto 250\n"
+            "ip rule del from 10.205.7.0/24 to all table mytable priority 101"
+            " protocol 250\n"
+            "ip rule del from all to 1.1.2.1/32 priority 100 protocol 250\n"
             "ip route flush table mytable\n"
             "ip rule del table mytable\n"
             "ip route flush cache\n"
@@ -145,12 +152,14 @@ JSON_CONFIGS = [
             "# This file is managed by Juju.\n"
             "ip route flush cache\n"
             "# Table: name main\n"
-            "ip rule add from 10.205.7.0/24 to all table main\n"
+            "ip rule add from 10.205.7.0/24 to all table main protocol 250\n"
         ),
         "expected_ifdown": (
             "#!/bin/sh\n"
             "# This file is managed by Juju.\n"
-            "ip rule del from 10.205.7.0/24 to all table main\n"
+            "ip -4 route flush table all proto 250\n"
+            "ip -6 route flush table all proto 250\n"
+            "ip rule del from 10.205.7.0/24 to all table main protocol 250\n"
             "# Skip removing builtin table main\n"
             "ip route flush cache\n"
         ),
@@ -178,16 +187,19 @@ JSON_CONFIGS = [
             "# This file is managed by Juju.\n"
             "ip route flush cache\n"
             "# Table: name mytable\n"
-            "ip route replace 1.1.2.0/24 dev ens3\n"
-            "ip rule add from all to 1.1.2.1/32 priority 100\n"
-            "ip rule add from 10.205.7.0/24 to all table mytable priority 101\n"
+            "ip route replace 1.1.2.0/24 dev ens3 proto 250\n"
+            "ip rule add from all to 1.1.2.1/32 priority 100 protocol 250\n"
+            "ip rule add from 10.205.7.0/24 to all table mytable priority 101"
+            " protocol 250\n"
         ),
         "expected_ifdown": (
             "#!/bin/sh\n"
             "# This file is managed by Juju.\n"
-            "ip rule del from 10.205.7.0/24 to all table mytable priority 101\n"
-            "ip rule del from all to 1.1.2.1/32 priority 100\n"
-            "ip route del 1.1.2.0/24 dev ens3\n"
+            "ip -4 route flush table all proto 250\n"
+            "ip -6 route flush table all proto 250\n"
+            "ip rule del from 10.205.7.0/24 to all table mytable priority 101"
+            " protocol 250\n"
+            "ip rule del from all to 1.1.2.1/32 priority 100 protocol 250\n"
             "ip route flush table mytable\n"
             "ip rule del table mytable\n"
             "ip route flush cache\n"
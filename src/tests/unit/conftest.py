@@ -53,9 +53,23 @@ def mock_charm_dir(monkeypatch):
     )
 
 
+@pytest.fixture
+def mock_unit_state(tmpdir, monkeypatch):
+    """Keep the unit state database in a temporary directory."""
+    from charmhelpers.core import unitdata
+
+    monkeypatch.setenv("UNIT_STATE_DB", str(tmpdir.join(".unit-state.db")))
+    monkeypatch.setattr(unitdata, "_KV", None)
+
+
 @pytest.fixture
 def advanced_routing_helper(
-    mock_layers, tmpdir, mock_hookenv_config, mock_charm_dir, monkeypatch
+    mock_layers,
+    tmpdir,
+    mock_hookenv_config,
+    mock_charm_dir,
+    mock_unit_state,
+    monkeypatch,
 ):
     """Routing fixture."""
     from advanced_routing_helper import AdvancedRoutingHelper
@@ -1,8 +1,15 @@
 """Main unit testing module."""
+import os
 import pathlib
 import shutil
+import subprocess
 import unittest.mock as mock
 
+import pytest
+
+import routing_entry
+
+import routing_state
 
 import routing_validator
 
@@ -12,6 +19,7 @@ class TestAdvancedRoutingHelper:
 
     test_dir = pathlib.Path("/tmp/test/charm-advanced-routing")
     test_networkd_conf_path = test_dir / "networkd.conf.d" / "juju-networkd.conf"
+    test_protocol_name_path = test_dir / "rt_protos.d" / "juju-managed.conf"
     test_netplanup_path = test_dir / "symlink_test" / "netplanup"
     test_cleanup_path = test_dir / "symlink_test" / "netplandown"
     test_ifup_path = test_dir / "symlink_test" / "ifup"
@@ -54,7 +62,7 @@ class TestAdvancedRoutingHelper:
 
         assert uppath.exists()
 
-    def test_setup(self, advanced_routing_helper):
+    def test_setup(self, advanced_routing_helper, monkeypatch):
         """Test setup."""
 
         def noop():
@@ -66,14 +74,69 @@ class TestAdvancedRoutingHelper:
         test_obj.common_ifup_path = self.test_dir / "if-up" / self.test_script
         test_obj.common_cleanup_path = self.test_dir / "cleanup" / self.test_script
         test_obj.networkd_conf_path = self.test_networkd_conf_path
+        test_obj.protocol_name_path = self.test_protocol_name_path
 
         test_obj.post_setup = noop
-        routing_validator.RoutingConfigValidator.__init__ = mock.Mock(return_value=None)
+        test_obj.setup_boot_restore = noop
+        monkeypatch.setattr(
+            routing_validator.RoutingConfigValidator,
+            "__init__",
+            mock.Mock(return_value=None),
+        )
+        monkeypatch.setattr(
+            routing_validator.RoutingConfigValidator,
+            "verify_config",
+            mock.Mock(return_value=routing_validator.RoutingModel()),
+        )
         test_obj.setup()
 
         assert test_obj.common_ifup_path.exists()
         assert test_obj.common_cleanup_path.exists()
 
+    def test_ifup_coalesces(self, advanced_routing_helper, tmp_path):
+        """Test that overlapping runs of the up script apply once."""
+
+        def noop():
+            pass
+
+        test_obj = advanced_routing_helper
+        test_obj.common_ifup_path = self.test_dir / "if-up" / self.test_script
+        test_obj.common_cleanup_path = self.test_dir / "cleanup" / self.test_script
+        test_obj.networkd_conf_path = self.test_networkd_conf_path
+        test_obj.protocol_name_path = self.test_protocol_name_path
+        test_obj.ifup_lock_path = tmp_path / "ifup.lock"
+        test_obj.ifup_pending_path = tmp_path / "ifup.pending"
+        test_obj.charm_config["ifup-debounce"] = 0.3
+        test_obj.post_setup = noop
+        test_obj.setup_boot_restore = noop
+        test_obj.pre_setup()
+        test_obj.model = routing_entry.RoutingModel(
+            [
+                routing_entry.RoutingEntryRoute(
+                    {"type": "route", "net": "10.0.0.0/24", "gateway": "10.0.0.1"}
+                )
+            ]
+        )
+        test_obj.render()
+
+        # a fake ip logging its arguments
+        calls = tmp_path / "calls"
+        fake_ip = tmp_path / "ip"
+        fake_ip.write_text('#!/bin/sh\necho "$*" >> {}\n'.format(calls))
+        fake_ip.chmod(0o755)
+        env = dict(os.environ, PATH="{}:{}".format(tmp_path, os.environ["PATH"]))
+        runs = [
+            subprocess.Popen([str(test_obj.common_ifup_path)], env=env)
+            for _ in range(5)
+        ]
+        for run in runs:
+            assert run.wait(timeout=10) == 0
+
+        assert calls.read_text().splitlines() == [
+            "route flush cache",
+            "route replace 10.0.0.0/24 via 10.0.0.1 proto 250",
+        ]
+
     def test_remove_routes(self, advanced_routing_helper, mock_check_call):
         """Test post_setup."""
         test_obj = advanced_routing_helper
@@ -122,6 +185,30 @@ class TestAdvancedRoutingHelper:
         test_obj.symlink_force(target, link)
         assert link.exists()
 
+    def test_flush_owned(self, advanced_routing_helper, monkeypatch):
+        """Test that only the rules tagged by the charm are flushed."""
+        test_obj = advanced_routing_helper
+        rules = [
+            {"priority": 0, "src": "all", "table": "local"},
+            {"priority": 100, "src": "10.0.0.0", "srclen": 24, "table": "SF1"},
+            {"priority": 101, "src": "all", "table": "SF1", "protocol": "250"},
+            {"priority": 32766, "src": "all", "table": "main"},
+            {"priority": 32767, "src": "all", "table": "default"},
+        ]
+        # ip rule show ignores the protocol filter
+        monkeypatch.setattr("routing_state.ip_json", lambda args: rules)
+        commands = []
+        monkeypatch.setattr("subprocess.check_call", commands.append)
+
+        test_obj.flush_owned()
+
+        assert [" ".join(cmd) for cmd in commands] == [
+            "ip -4 route flush table all proto 250",
+            "ip -6 route flush table all proto 250",
+            "ip -4 rule del priority 101 from all table SF1 protocol 250",
+            "ip -6 rule del priority 101 from all table SF1 protocol 250",
+        ]
+
     def test_setup_persistent_rules(self, advanced_routing_helper):
         """Test setup_persistent_rules."""
         test_obj = advanced_routing_helper
@@ -130,3 +217,330 @@ class TestAdvancedRoutingHelper:
         test_obj.setup_persistent_rules()
 
         assert test_obj.networkd_conf_path.exists()
+
+    def test_gateway_monitor_config(self, advanced_routing_helper):
+        """Test that gateway routes are monitored with their backups."""
+        import routing_entry
+
+        test_obj = advanced_routing_helper
+        test_obj.model = routing_entry.RoutingModel(
+            [
+                routing_entry.RoutingEntryRoute(
+                    {
+                        "type": "route",
+                        "default_route": True,
+                        "gateway": "10.0.0.1",
+                        "backup_gateways": ["10.0.0.2"],
+                        "table": "SF1",
+                    }
+                ),
+                routing_entry.RoutingEntryRoute(
+                    {"type": "route", "net": "10.1.0.0/24", "device": "lo"}
+                ),
+            ]
+        )
+
+        config = test_obj.gateway_monitor_config()
+
+        assert config["probe"] == "neigh"
+        cmd = "ip route replace default via {} table SF1 proto 250"
+        assert config["routes"] == [
+            {
+                "name": "default table SF1",
+                "gateways": [
+                    ["10.0.0.1", cmd.format("10.0.0.1").split()],
+                    ["10.0.0.2", cmd.format("10.0.0.2").split()],
+                ],
+            }
+        ]
+
+    def test_event_watcher_config(self, advanced_routing_helper):
+        """Test that the applied entries are indexed for the event watcher."""
+        test_obj = advanced_routing_helper
+        test_obj.charm_config["gateway-monitor"] = True
+        cmd = "ip route replace 10.1.0.0/24 dev lo table SF1 proto 250"
+        confs = [
+            {"type": "table", "table": "SF1"},
+            {"type": "route", "net": "10.0.0.0/24", "gateway": "10.0.0.1"},
+            {"type": "route", "net": "10.1.0.0/24", "device": "lo", "table": "SF1"},
+            {"type": "rule", "from-net": "10.1.0.0/24", "table": "SF1"},
+        ]
+
+        config = test_obj.event_watcher_config(confs, {"SF1": 100})
+
+        assert config["rate"] == 20.0
+        # the gateway route is left to the gateway monitor
+        assert config["entries"] == [
+            {
+                "name": "route replace 10.1.0.0/24 dev lo table SF1",
+                "kind": "route",
+                "key": [4, 100, "10.1.0.0/24", 0],
+                "cmd": cmd.split(),
+            },
+            {
+                "name": "rule add from 10.1.0.0/24 table SF1",
+                "kind": "rule",
+                "key": [4, 100, "10.1.0.0/24", "all", None, None, None, None, None],
+                "cmd": "ip rule add from 10.1.0.0/24 table SF1 protocol 250".split(),
+            },
+        ]
+
+    def test_render_networkd(self, advanced_routing_helper, monkeypatch):
+        """Test that the entries are written into networkd drop-ins."""
+        import routing_entry
+
+        test_obj = advanced_routing_helper
+        test_obj.networkd_network_dir_path = self.test_dir / "network"
+        stale = test_obj.networkd_network_dir_path / "10-eth9.network.d"
+        stale.mkdir(parents=True)
+        (stale / "95-juju-routing.conf").touch()
+        test_obj.model = routing_entry.RoutingModel(
+            [
+                routing_entry.RoutingEntryRoute(
+                    {"type": "route", "net": "10.1.0.0/24", "device": "eth0"}
+                )
+            ]
+        )
+        monkeypatch.setattr(
+            "advanced_routing_helper.network_file",
+            lambda device: "10-netplan-{}.network".format(device),
+        )
+        reload = mock.Mock()
+        monkeypatch.setattr(test_obj, "reload_networkd", reload)
+
+        test_obj.render_networkd()
+
+        dropin = (
+            test_obj.networkd_network_dir_path
+            / "10-netplan-eth0.network.d"
+            / "95-juju-routing.conf"
+        )
+        assert "Destination=10.1.0.0/24" in dropin.read_text()
+        assert not stale.exists()
+        reload.assert_called_once_with()
+
+    def test_post_setup_networkd_failure(self, advanced_routing_helper, monkeypatch):
+        """Test that the up script is kept if the drop-ins cannot be written."""
+        import routing_networkd
+
+        test_obj = advanced_routing_helper
+        test_obj.charm_config["persistence"] = "networkd"
+        removed = []
+        monkeypatch.setattr(test_obj, "remove_file", removed.append)
+
+        def render_networkd():
+            raise routing_networkd.NetworkdRenderError("eth9 is not managed")
+
+        monkeypatch.setattr(test_obj, "render_networkd", render_networkd)
+
+        with pytest.raises(routing_networkd.NetworkdRenderError):
+            test_obj.post_setup()
+        assert removed == []
+
+    def test_boot_restore_config(self, advanced_routing_helper):
+        """Test that the boot restore waits for the devices of the routes."""
+        import routing_entry
+
+        test_obj = advanced_routing_helper
+        test_obj.model = routing_entry.RoutingModel(
+            [
+                routing_entry.RoutingEntryTable({"type": "table", "table": "SF1"}),
+                routing_entry.RoutingEntryRoute(
+                    {"type": "route", "net": "10.1.0.0/24", "device": "eth1"}
+                ),
+                routing_entry.RoutingEntryRule(
+                    {"type": "rule", "from-net": "10.1.0.0/24", "table": "SF1"}
+                ),
+            ]
+        )
+
+        config = test_obj.boot_restore_config()
+
+        assert config == {
+            "devices": ["eth1"],
+            "device_timeout": 30.0,
+            "batch": [
+                "route replace 10.1.0.0/24 dev eth1 proto 250",
+                "rule add from 10.1.0.0/24 table SF1 protocol 250",
+            ],
+        }
+
+    def test_apply_deferred(self, advanced_routing_helper, monkeypatch):
+        """Test that the deferred entries of appeared devices are applied."""
+        from charmhelpers.core import unitdata
+
+        test_obj = advanced_routing_helper
+        bond_route = {"type": "route", "net": "10.0.1.0/24", "device": "bond1"}
+        vlan_rule = {"type": "rule", "from-net": "10.0.2.0/24", "oif": "vlan7"}
+        test_obj.model = routing_entry.RoutingModel()
+        test_obj.model.add_entry(routing_entry.RoutingEntryRoute(bond_route), "bond1")
+        test_obj.model.add_entry(routing_entry.RoutingEntryRule(vlan_rule), "vlan7")
+        test_obj.save_deferred()
+        assert test_obj.deferred_devices == ["bond1", "vlan7"]
+
+        applied = []
+        monkeypatch.setattr(
+            routing_entry.RoutingEntryType,
+            "exec_cmd",
+            lambda entry, cmd, pipe=False: applied.append(cmd) or True,
+        )
+        monkeypatch.setattr(
+            "advanced_routing_helper.netifaces.interfaces", lambda: ["eth0", "bond1"]
+        )
+
+        persisted = []
+        monkeypatch.setattr(test_obj, "persist_applied", persisted.append)
+
+        assert test_obj.apply_deferred() == ["bond1"]
+        assert applied == [routing_entry.RoutingEntryRoute(bond_route).create_line()]
+        assert persisted == [[bond_route]]
+        assert test_obj.deferred_devices == ["vlan7"]
+        assert unitdata.kv().get(test_obj.applied_key) == [bond_route]
+        # nothing new appeared
+        assert test_obj.apply_deferred() == []
+
+    def test_persist_applied(self, advanced_routing_helper, monkeypatch):
+        """Test that the entries of appeared devices are persisted for reboots."""
+        test_obj = advanced_routing_helper
+        test_obj.charm_config["persistence"] = "networkd"
+        test_obj.charm_config["boot-restore"] = True
+        applied = [
+            {"type": "table", "table": "SF1"},
+            {"type": "route", "net": "10.0.0.0/24", "gateway": "10.0.0.1"},
+            {"type": "route", "net": "10.0.1.0/24", "device": "bond1", "table": "SF1"},
+        ]
+        rendered = []
+        monkeypatch.setattr(
+            test_obj,
+            "render_networkd",
+            lambda: rendered.append(("networkd", test_obj.model.configs())),
+        )
+        monkeypatch.setattr(
+            test_obj,
+            "write_boot_restore_config",
+            lambda: rendered.append(("restore", test_obj.boot_restore_config())),
+        )
+
+        test_obj.persist_applied(applied)
+
+        assert rendered[0] == ("networkd", applied)
+        assert rendered[1][1]["devices"] == ["bond1"]
+        assert rendered[1][1]["batch"][-1] == (
+            "route replace 10.0.1.0/24 dev bond1 table SF1 proto 250"
+        )
+        assert len(test_obj.model) == 0
+
+    def test_migrate_state(self, advanced_routing_helper):
+        """Test that the entries applied by a previous version are normalised."""
+        from charmhelpers.core import unitdata
+
+        test_obj = advanced_routing_helper
+        route = {"type": "route", "net": "10.0.0.0/24", "gateway": "10.0.0.1"}
+        unitdata.kv().set(
+            test_obj.applied_key,
+            [route, {"type": "rule", "fwmark": "16", "table": "SF1"}],
+        )
+
+        test_obj.migrate_state()
+
+        assert unitdata.kv().get(test_obj.applied_key) == [
+            route,
+            {"type": "rule", "fwmark": "0x10", "from-net": "all", "table": "SF1"},
+        ]
+        assert unitdata.kv().get(test_obj.deferred_key) == {}
+        assert unitdata.kv().get(test_obj.state_version_key) == 1
+
+    def test_apply_config_reconcile(self, advanced_routing_helper, monkeypatch):
+        """Test that reconciling only applies the entries that changed."""
+        from charmhelpers.core import unitdata
+
+        test_obj = advanced_routing_helper
+        test_obj.setup_gateway_monitor = lambda: None
+        test_obj.remove_obsolete = lambda: None
+        confs = [
+            {"type": "table", "table": "SF1"},
+            {"type": "route", "net": "10.0.0.0/24", "gateway": "10.0.0.1"},
+            {"type": "route", "net": "10.0.1.0/24", "gateway": "10.0.0.1"},
+            {"type": "rule", "from-net": "10.0.0.0/24", "table": "SF1"},
+        ]
+        unitdata.kv().set(test_obj.applied_key, confs[:2])
+        kernel = routing_state.KernelState(
+            routes=[
+                (4, {"dst": "10.0.0.0/24", "gateway": "10.0.0.1", "protocol": 250})
+            ],
+            rules=[
+                (4, {"src": "10.0.0.0", "srclen": 24, "table": "SF1", "protocol": 250})
+            ],
+        )
+        monkeypatch.setattr(
+            routing_state.KernelState, "snapshot", mock.Mock(return_value=kernel)
+        )
+        applied = []
+        for entry_class in (
+            routing_entry.RoutingEntryTable,
+            routing_entry.RoutingEntryRoute,
+            routing_entry.RoutingEntryRule,
+        ):
+            monkeypatch.setattr(
+                entry_class, "apply", lambda entry: applied.append(entry.config)
+            )
+        test_obj.model = routing_entry.RoutingModel(
+            routing_entry.RoutingEntryTable(confs[0])
+            if conf["type"] == "table"
+            else routing_entry.RoutingEntryRoute(conf)
+            if conf["type"] == "route"
+            else routing_entry.RoutingEntryRule(conf)
+            for conf in confs
+        )
+
+        test_obj.apply_config(reconcile=True)
+
+        # the installed route and rule are left alone
+        assert applied == [confs[0], confs[2]]
+        assert unitdata.kv().get(test_obj.applied_key) == confs
+
+    def test_upgrade_from_state_version_0(self, advanced_routing_helper, monkeypatch):
+        """Test that an upgrade tags the entries a previous version installed."""
+        from charmhelpers.core import unitdata
+
+        test_obj = advanced_routing_helper
+        test_obj.setup_gateway_monitor = lambda: None
+        test_obj.remove_obsolete = lambda: None
+        confs = [
+            {"type": "route", "net": "10.0.0.0/24", "gateway": "10.0.0.1"},
+            {"type": "route", "net": "10.0.1.0/24", "gateway": "10.0.0.1"},
+            {"type": "rule", "from-net": "all", "fwmark": "0x10", "table": "SF1"},
+        ]
+        # state left by a version without a state version nor protocol tags
+        unitdata.kv().unset(test_obj.state_version_key)
+        old_rule = {"type": "rule", "fwmark": "16", "table": "SF1"}
+        unitdata.kv().set(test_obj.applied_key, confs[:2] + [old_rule])
+        kernel = routing_state.KernelState(
+            routes=[
+                (4, {"dst": "10.0.0.0/24", "gateway": "10.0.0.1", "protocol": "boot"}),
+                (4, {"dst": "10.0.1.0/24", "gateway": "10.0.0.1", "protocol": 250}),
+            ],
+            rules=[(4, {"src": "all", "fwmark": "0x10", "table": "SF1"})],
+        )
+        monkeypatch.setattr(
+            routing_state.KernelState, "snapshot", mock.Mock(return_value=kernel)
+        )
+        applied = []
+        for entry_class in (
+            routing_entry.RoutingEntryRoute,
+            routing_entry.RoutingEntryRule,
+        ):
+            monkeypatch.setattr(
+                entry_class, "apply", lambda entry: applied.append(entry.config)
+            )
+        test_obj.model = routing_entry.RoutingModel(
+            [routing_entry.RoutingEntryRoute(conf) for conf in confs[:2]]
+            + [routing_entry.RoutingEntryRule(confs[2])]
+        )
+
+        test_obj.migrate_state()
+        test_obj.apply_config(reconcile=True)
+
+        # only the tagged route is left alone
+        assert applied == [confs[0], confs[2]]
+        assert unitdata.kv().get(test_obj.state_version_key) == 1
@@ -0,0 +1,116 @@
+"""AsyncApplier unit testing module."""
+import asyncio
+
+import routing_apply
+
+import routing_entry
+
+
+class FakeProcess:
+    """asyncio subprocess stand-in recording the command order."""
+
+    def __init__(self, returncode):
+        """Init function."""
+        self.returncode = returncode
+
+    async def communicate(self):
+        """Yield to the other tasks before completing."""
+        await asyncio.sleep(0)
+        return b"", b"RTNETLINK answers: Invalid argument"
+
+
+def test_apply_order(monkeypatch):
+    """Test that entries are applied after the entries they depend on."""
+    monkeypatch.setattr("routing_entry.hookenv.log", lambda *args, **kw: None)
+    monkeypatch.setattr("routing_apply.hookenv.log", lambda *args, **kw: None)
+    monkeypatch.setattr(
+        "routing_entry.RoutingEntryRule.list_rules",
+        staticmethod(
+            lambda: [
+                "100:\tfrom 10.0.9.0/24 lookup SF1 proto 250",
+                "100:\tfrom 10.0.8.0/24 lookup SF1 proto boot",
+            ]
+        ),
+    )
+    commands = []
+
+    async def create_subprocess_exec(*cmd, **kwargs):
+        commands.append(" ".join(cmd))
+        return FakeProcess(1 if "6.6.6.0/24" in cmd else 0)
+
+    monkeypatch.setattr(
+        "routing_apply.asyncio.create_subprocess_exec", create_subprocess_exec
+    )
+    entries = [
+        routing_entry.RoutingEntryRoute(conf)
+        for conf in (
+            {"net": "10.0.0.0/24", "device": "eth1", "table": "SF1"},
+            {"default_route": True, "gateway": "10.0.0.1", "table": "SF1"},
+            {"net": "6.6.6.0/24", "gateway": "10.0.0.1", "table": "SF2"},
+        )
+    ] + [
+        routing_entry.RoutingEntryRule(conf)
+        for conf in (
+            {"from-net": "10.0.0.0/24", "table": "SF1", "priority": 100},
+            {"from-net": "10.0.9.0/24", "table": "SF1", "priority": 100},
+            {"from-net": "10.0.8.0/24", "table": "SF1", "priority": 100},
+            {"from-net": "10.0.1.0/24", "table": "SF2"},
+        )
+    ]
+
+    failures = routing_apply.AsyncApplier(entries, 4).apply()
+
+    assert len(commands) == 7
+    assert commands[0] == "ip route replace 10.0.0.0/24 dev eth1 table SF1 proto 250"
+    default_route = commands.index(
+        "ip route replace default via 10.0.0.1 table SF1 proto 250"
+    )
+    rule = commands.index(
+        "ip rule add from 10.0.0.0/24 table SF1 priority 100 protocol 250"
+    )
+    assert default_route < rule
+    # make before break: the tagged copy is added before the untagged deletion
+    retag = commands.index(
+        "ip rule add from 10.0.8.0/24 table SF1 priority 100 protocol 250"
+    )
+    assert commands[retag + 1] == (
+        "ip rule del from 10.0.8.0/24 table SF1 priority 100 protocol boot"
+    )
+    assert [" ".join(cmd) for cmd, _ in failures] == [
+        "ip route replace 6.6.6.0/24 via 10.0.0.1 table SF2 proto 250"
+    ]
+
+
+def test_apply_rules_in_order(monkeypatch):
+    """Test that rules are applied in config order if one has no priority."""
+    monkeypatch.setattr("routing_apply.hookenv.log", lambda *args, **kw: None)
+    monkeypatch.setattr(
+        "routing_entry.RoutingEntryRule.list_rules", staticmethod(lambda: [])
+    )
+    commands = []
+
+    async def create_subprocess_exec(*cmd, **kwargs):
+        commands.append(" ".join(cmd))
+        return FakeProcess(0)
+
+    monkeypatch.setattr(
+        "routing_apply.asyncio.create_subprocess_exec", create_subprocess_exec
+    )
+    entries = [
+        routing_entry.RoutingEntryRule(conf)
+        for conf in (
+            {"from-net": "10.0.0.0/24", "table": "SF1", "priority": 100},
+            {"from-net": "10.0.1.0/24", "table": "SF1"},
+            {"from-net": "10.0.2.0/24", "table": "SF1", "priority": 200},
+            {"from-net": "10.0.3.0/24", "table": "SF1"},
+        )
+    ]
+
+    routing_apply.AsyncApplier(entries, 4).apply()
+
+    assert [command.split()[4] for command in commands] == [
+        "10.0.0.0/24",
+        "10.0.1.0/24",
+        "10.0.2.0/24",
+        "10.0.3.0/24",
+    ]
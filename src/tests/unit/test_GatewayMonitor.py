@@ -0,0 +1,220 @@
+"""Gateway monitor unit testing module."""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import gateway_monitor
+
+import pytest
+
+ROUTE = "198.51.100.0/24"
+
+
+def replace_cmd(gateway):
+    """Return the command installing the test route through a gateway."""
+    return ["ip", "route", "replace", ROUTE, "via", gateway, "proto", "250"]
+
+
+@pytest.fixture
+def monitor(monkeypatch):
+    """Monitor of one route with a backup gateway, recording its commands."""
+    routes = [
+        {
+            "name": ROUTE,
+            "gateways": [
+                ["10.99.1.2", replace_cmd("10.99.1.2")],
+                ["10.99.2.2", replace_cmd("10.99.2.2")],
+            ],
+        }
+    ]
+    test_monitor = gateway_monitor.GatewayMonitor(routes, failures=2)
+    test_monitor.commands = []
+
+    def run(cmd):
+        test_monitor.commands.append(" ".join(cmd))
+        return True
+
+    monkeypatch.setattr(test_monitor, "run", run)
+    return test_monitor
+
+
+def probe(monitor, monkeypatch, **alive):
+    """Run one monitor step with the given gateway liveness."""
+    results = {"10.99.1.2": alive.get("primary"), "10.99.2.2": alive.get("backup")}
+    monkeypatch.setattr(monitor, "neigh_all", lambda: results)
+    monitor.step()
+
+
+def test_failover(monitor, monkeypatch):
+    """Test that a route moves to its backup and back, or is withdrawn."""
+    probe(monitor, monkeypatch, primary=True, backup=True)
+    assert monitor.commands == [" ".join(replace_cmd("10.99.1.2"))]
+
+    # a single failed probe is not enough
+    probe(monitor, monkeypatch, primary=False, backup=True)
+    assert len(monitor.commands) == 1
+    probe(monitor, monkeypatch, primary=False, backup=True)
+    assert monitor.commands[-1] == " ".join(replace_cmd("10.99.2.2"))
+
+    probe(monitor, monkeypatch, primary=False, backup=False)
+    probe(monitor, monkeypatch, primary=False, backup=False)
+    assert monitor.commands[-1] == "ip route del {} via 10.99.2.2 proto 250".format(
+        ROUTE
+    )
+    assert monitor.current[ROUTE] is None
+
+    probe(monitor, monkeypatch, primary=True, backup=False)
+    assert monitor.commands[-1] == " ".join(replace_cmd("10.99.1.2"))
+    assert len(monitor.commands) == 4
+
+
+def test_neigh_all(monitor, monkeypatch):
+    """Test that the neighbour states are read from the ip -json dump."""
+    dumps = {
+        "-4": [
+            {"dst": "10.99.1.2", "dev": "gmv1", "state": ["STALE"]},
+            {"dst": "10.99.2.2", "dev": "gmv2", "state": ["FAILED"]},
+        ],
+        "-6": [],
+    }
+    monkeypatch.setattr(
+        "gateway_monitor.subprocess.check_output",
+        lambda cmd: json.dumps(dumps[cmd[2]]).encode("utf8"),
+    )
+    monkeypatch.setattr("gateway_monitor.socket.socket.sendto", lambda *args: 0)
+
+    assert monitor.neigh_all() == {"10.99.1.2": True, "10.99.2.2": False}
+
+
+def netns_available():
+    """Return True if network namespaces and veth pairs can be created."""
+    if os.geteuid() != 0 or not shutil.which("ip"):
+        return False
+    ok = subprocess.call(["ip", "netns", "add", "gm-check"]) == 0
+    subprocess.call(["ip", "netns", "del", "gm-check"])
+    return ok
+
+
+@pytest.fixture
+def namespaces():
+    """Host namespace linked to two gateway namespaces by veth pairs."""
+
+    def ip(*args):
+        subprocess.check_call(["ip"] + list(args))
+
+    names = ["gm-host", "gm-gw1", "gm-gw2"]
+    for name in names:
+        ip("netns", "add", name)
+    try:
+        for index in (1, 2):
+            gateway = "gm-gw{}".format(index)
+            host_dev = "gmv{}".format(index)
+            ip("-n", "gm-host", "link", "add", host_dev, "type", "veth", "peer", "gmp")
+            ip("-n", "gm-host", "link", "set", "gmp", "netns", gateway)
+            ip(
+                "-n",
+                "gm-host",
+                "addr",
+                "add",
+                "10.99.{}.1/24".format(index),
+                "dev",
+                host_dev,
+            )
+            ip("-n", "gm-host", "link", "set", host_dev, "up")
+            ip(
+                "-n",
+                gateway,
+                "addr",
+                "add",
+                "10.99.{}.2/24".format(index),
+                "dev",
+                "gmp",
+            )
+            ip("-n", gateway, "link", "set", "gmp", "up")
+        yield ip
+    finally:
+        for name in names:
+            subprocess.call(["ip", "netns", "del", name])
+
+
+@pytest.mark.skipif(not netns_available(), reason="needs root and network namespaces")
+def test_failover_namespaces(namespaces, tmpdir):
+    """Test failover between two gateways reached through veth pairs."""
+    ip = namespaces
+    for index in (1, 2):
+        # fast neighbour timers, so that a dead gateway is noticed quickly
+        for name, value in (
+            ("base_reachable_time_ms", 200),
+            ("delay_first_probe_time", 1),
+            ("retrans_time_ms", 100),
+            ("ucast_solicit", 1),
+            ("mcast_solicit", 1),
+        ):
+            subprocess.check_call(
+                [
+                    "ip",
+                    "netns",
+                    "exec",
+                    "gm-host",
+                    "sysctl",
+                    "-qw",
+                    "net.ipv4.neigh.gmv{}.{}={}".format(index, name, value),
+                ]
+            )
+    config = tmpdir.join("gateway-monitor.json")
+    config.write(
+        json.dumps(
+            {
+                "probe": "neigh",
+                "interval": 0.2,
+                "failures": 3,
+                "routes": [
+                    {
+                        "name": ROUTE,
+                        "gateways": [
+                            ["10.99.1.2", replace_cmd("10.99.1.2")],
+                            ["10.99.2.2", replace_cmd("10.99.2.2")],
+                        ],
+                    }
+                ],
+            }
+        )
+    )
+    proc = subprocess.Popen(
+        [
+            "ip",
+            "netns",
+            "exec",
+            "gm-host",
+            sys.executable,
+            gateway_monitor.__file__,
+            "--config",
+            str(config),
+        ]
+    )
+
+    def wait_for_gateway(gateway, timeout=15):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            route = subprocess.check_output(
+                ["ip", "-n", "gm-host", "route", "show", ROUTE]
+            ).decode("utf8")
+            if (gateway and "via {} ".format(gateway) in route) or route == gateway:
+                return True
+            time.sleep(0.1)
+        return False
+
+    try:
+        assert wait_for_gateway("10.99.1.2")
+        ip("-n", "gm-gw1", "link", "set", "gmp", "down")
+        assert wait_for_gateway("10.99.2.2")
+        ip("-n", "gm-gw2", "link", "set", "gmp", "down")
+        assert wait_for_gateway("")
+        ip("-n", "gm-gw1", "link", "set", "gmp", "up")
+        assert wait_for_gateway("10.99.1.2")
+    finally:
+        proc.terminate()
+        proc.wait()
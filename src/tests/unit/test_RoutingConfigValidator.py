@@ -1,5 +1,8 @@
 """routing validator unit testing module."""
 
+import concurrent.futures
+import itertools
+
 import pytest
 
 import routing_validator
@@ -30,3 +33,332 @@ def test_routing_validate_rule_fwmark_failure(fwmark):
     with pytest.raises(routing_validator.RoutingConfigValidatorError) as ie:
         validator.verify_rule({"fwmark": fwmark})
     ie.match("fwmark {} is in the wrong format".format(fwmark))
+
+
+@pytest.mark.parametrize(
+    "attrs,error",
+    [
+        ({"initcwnd": 0}, "initcwnd expected to be a positive integer"),
+        ({"advmss": "big"}, "advmss expected to be a positive integer"),
+        ({"initrwnd": [32]}, "initrwnd expected to be a positive integer"),
+        ({"initcwnd": 10.5}, "initcwnd expected to be a positive integer"),
+        ({"initcwnd": "10.5"}, "initcwnd expected to be a positive integer"),
+        ({"advmss": True}, "advmss expected to be a positive integer"),
+        ({"congctl": "bbr; reboot"}, "congctl .* is not a valid algorithm"),
+        ({"quickack": "yes"}, "quickack expected to be bool"),
+        ({"src": "fe80::1"}, "src fe80::1 is not an IPv4 address"),
+    ],
+    ids=[
+        "initcwnd",
+        "advmss",
+        "initrwnd-list",
+        "initcwnd-float",
+        "initcwnd-float-str",
+        "advmss-bool",
+        "congctl",
+        "quickack",
+        "src-family",
+    ],
+)
+def test_routing_validate_route_tcp_attributes_failure(attrs, error):
+    """Test that bad per-route TCP attributes are rejected."""
+    validator = routing_validator.RoutingConfigValidator()
+    conf = dict({"net": "10.20.0.0/16", "gateway": "10.0.0.1"}, **attrs)
+    with pytest.raises(routing_validator.RoutingConfigValidatorError) as ie:
+        validator.verify_route(conf)
+    ie.match(error)
+
+
+def test_routing_validate_route_src_without_net():
+    """Test that a src on a route without a net is reported, not a KeyError."""
+    validator = routing_validator.RoutingConfigValidator()
+    conf = {"default_route": False, "gateway": "10.0.0.1", "src": "10.0.0.5"}
+    with pytest.raises(routing_validator.RoutingConfigValidatorError) as ie:
+        validator.verify_route_src(conf)
+    ie.match("src 10.0.0.5 needs the route 'net' def")
+
+
+def test_routing_validate_route_tcp_attributes():
+    """Test that per-route TCP attributes are rendered on the route line."""
+    validator = routing_validator.RoutingConfigValidator()
+    validator.verify_route(
+        {
+            "net": "10.20.0.0/16",
+            "gateway": "10.0.0.1",
+            "src": "10.0.0.5",
+            "advmss": 1400,
+            "initcwnd": 32,
+            "initrwnd": 32,
+            "congctl": "bbr",
+            "quickack": True,
+        }
+    )
+    (route,) = validator.model
+    assert route.addline == (
+        "ip route replace 10.20.0.0/16 via 10.0.0.1 src 10.0.0.5 advmss 1400"
+        " initcwnd 32 initrwnd 32 congctl bbr quickack 1 proto 250\n"
+    )
+
+
+def test_routing_validate_rule_selectors():
+    """Test that rule selectors are normalized as listed by ip rule."""
+    validator = routing_validator.RoutingConfigValidator()
+    conf = {
+        "not": True,
+        "ipproto": "6",
+        "sport": "1024-1024",
+        "dport": 443,
+        "uidrange": 1000,
+        "tos": 16,
+        "suppress_prefixlength": 0,
+    }
+    validator.verify_rule(conf)
+
+    assert conf["from-net"] == "all"
+    assert conf["ipproto"] == "tcp"
+    assert conf["sport"] == "1024"
+    assert conf["dport"] == "443"
+    assert conf["uidrange"] == "1000-1000"
+    assert conf["tos"] == "0x10"
+    (rule,) = validator.model
+    assert rule.addline == (
+        "ip rule add not from all tos 0x10 uidrange 1000-1000 ipproto tcp"
+        " sport 1024 dport 443 suppress_prefixlength 0 protocol 250\n"
+    )
+
+
+def test_routing_validate_rule_tos_ipv6():
+    """Test that IPv6 rules match the whole traffic class."""
+    validator = routing_validator.RoutingConfigValidator()
+    conf = {"from-net": "2001:db8::/64", "tos": 32}
+    validator.verify_rule(conf)
+    assert conf["tos"] == "0x20"
+
+
+@pytest.mark.parametrize(
+    "ipproto,expected",
+    [("tcp", "tcp"), ("TCP", "tcp"), (17, "udp"), ("IPv6-ICMP", "ipv6-icmp")],
+)
+def test_routing_validate_rule_ipproto_normalized(ipproto, expected):
+    """Test that protocol names and numbers are stored by canonical name."""
+    validator = routing_validator.RoutingConfigValidator()
+    conf = {"from-net": "all", "ipproto": ipproto}
+    validator.verify_rule(conf)
+    assert conf["ipproto"] == expected
+
+
+@pytest.mark.parametrize(
+    "attrs,error",
+    [
+        ({"dport": "80-20"}, "dport 80-20 is not a valid range"),
+        ({"sport": "70000"}, "sport 70000 is not a valid range"),
+        ({"uidrange": "a-b"}, "uidrange a-b is not a valid range"),
+        ({"ipproto": "nosuchproto"}, "ipproto nosuchproto"),
+        ({"tos": "0x100"}, "tos 0x100 invalid"),
+        ({"tos": "0x20"}, "tos 0x20 invalid"),
+        ({"not": "yes"}, "not should be bool"),
+        ({"suppress_prefixlength": -1}, "suppress_prefixlength -1 invalid"),
+    ],
+    ids=[
+        "dport",
+        "sport",
+        "uidrange",
+        "ipproto",
+        "tos",
+        "tos-ipv4-mask",
+        "not",
+        "suppress",
+    ],
+)
+def test_routing_validate_rule_selectors_failure(attrs, error):
+    """Test that bad rule selectors are rejected."""
+    validator = routing_validator.RoutingConfigValidator()
+    with pytest.raises(routing_validator.RoutingConfigValidatorError) as ie:
+        validator.verify_rule(dict({"from-net": "all"}, **attrs))
+    ie.match(error)
+
+
+def test_routing_validate_expand():
+    """Test that net lists and ranges expand to one entry per network."""
+    validator = routing_validator.RoutingConfigValidator()
+    validator.config = [
+        {
+            "type": "route",
+            "net-range": {"start": "10.0.0.0/24", "count": 3, "step": 2},
+            "gateway": "10.255.0.1",
+        },
+        {
+            "type": "rule",
+            "from-net": ["192.168.1.0/24", "192.168.2.0/24"],
+            "to-net-range": {"start": "172.16.0.0/16", "count": 2},
+        },
+    ]
+    validator.verify_config()
+
+    assert validator.model.configs() == [
+        {"type": "route", "net": "10.0.0.0/24", "gateway": "10.255.0.1"},
+        {"type": "route", "net": "10.0.2.0/24", "gateway": "10.255.0.1"},
+        {"type": "route", "net": "10.0.4.0/24", "gateway": "10.255.0.1"},
+        {"type": "rule", "from-net": "192.168.1.0/24", "to-net": "172.16.0.0/16"},
+        {"type": "rule", "from-net": "192.168.1.0/24", "to-net": "172.17.0.0/16"},
+        {"type": "rule", "from-net": "192.168.2.0/24", "to-net": "172.16.0.0/16"},
+        {"type": "rule", "from-net": "192.168.2.0/24", "to-net": "172.17.0.0/16"},
+    ]
+
+
+@pytest.mark.parametrize(
+    "spec,error",
+    [
+        ({"start": "255.255.255.0/24", "count": 2}, "invalid range"),
+        ({"start": "10.0.0.0/24", "count": 0}, "count and step must be positive"),
+        ({"count": 2}, "invalid range"),
+    ],
+    ids=["overflow", "count", "start"],
+)
+def test_routing_validate_expand_failure(spec, error):
+    """Test that bad ranges are rejected."""
+    validator = routing_validator.RoutingConfigValidator()
+    with pytest.raises(routing_validator.RoutingConfigValidatorError) as ie:
+        validator.net_range(spec)
+    ie.match(error)
+
+
+def test_routing_validate_expand_lazily():
+    """Test that a large expansion is generated one entry at a time."""
+    validator = routing_validator.RoutingConfigValidator()
+    conf = {
+        "type": "rule",
+        "from-net-range": {"start": "10.0.0.0/32", "count": 1 << 20},
+        "to-net-range": {"start": "172.16.0.0/32", "count": 1 << 20},
+    }
+    entries = validator.expand(conf)
+
+    assert [entry["to-net"] for entry in itertools.islice(entries, 3)] == [
+        "172.16.0.0/32",
+        "172.16.0.1/32",
+        "172.16.0.2/32",
+    ]
+    assert next(entries)["from-net"] == "10.0.0.0/32"
+
+
+def test_submit_bounded():
+    """Test that chunks are submitted under the in-flight limit, in order."""
+    submitted = []
+
+    class Executor:
+        def submit(self, fn, item):
+            submitted.append(item)
+            future = concurrent.futures.Future()
+            future.set_result(fn(item))
+            return future
+
+    results = routing_validator.submit_bounded(
+        Executor(), lambda item: item * 2, itertools.count(), 3
+    )
+
+    assert [next(results) for _ in range(4)] == [0, 2, 4, 6]
+    assert submitted == list(range(6))
+
+
+def test_routing_validate_backup_gateways_failure():
+    """Test that backup gateways must be of the gateway's family."""
+    validator = routing_validator.RoutingConfigValidator()
+    conf = {
+        "net": "10.20.0.0/16",
+        "gateway": "10.0.0.1",
+        "backup_gateways": ["10.0.0.2", "fe80::1"],
+    }
+    with pytest.raises(routing_validator.RoutingConfigValidatorError) as ie:
+        validator.verify_route(conf)
+    ie.match("backup gateway fe80::1 is not IPv4")
+
+
+def test_routing_validate_parallel(monkeypatch):
+    """Test that chunked validation gives the same entries as serial one."""
+    monkeypatch.setattr(routing_validator, "PARALLEL_CHUNK_SIZE", 3)
+    config = [
+        {"type": "table", "table": "SF1"},
+        {
+            "type": "route",
+            "net-range": {"start": "10.0.0.0/24", "count": 10},
+            "gateway": "10.255.0.1",
+            "table": "SF1",
+        },
+        # duplicate of the first route of the range
+        {
+            "type": "route",
+            "net": "10.0.0.0/24",
+            "gateway": "10.255.0.1",
+            "table": "SF1",
+        },
+        {"type": "rule", "from-net": "10.0.0.0/24", "fwmark": "16", "table": "SF1"},
+    ]
+    addlines = []
+    for threshold in (0, 4):
+        validator = routing_validator.RoutingConfigValidator()
+        validator.parallel_threshold = threshold
+        validator.config = [dict(conf) for conf in config]
+        validator.verify_config()
+        addlines.append([entry.addline for entry in validator.model])
+
+    assert len(addlines[0]) == 12
+    assert addlines[0] == addlines[1]
+
+
+def test_routing_validate_parallel_failure():
+    """Test that errors found by the workers are reported."""
+    validator = routing_validator.RoutingConfigValidator()
+    validator.parallel_threshold = 2
+    validator.config = [
+        {"type": "route", "net": "10.0.0.0/24", "gateway": "10.255.0.1"},
+        {"type": "route", "net": "10.0.1.0/24", "gateway": "10.255.0.1", "mtu": 1},
+        {"type": "route", "net": "10.0.2.0/24", "gateway": "10.255.0.1", "metric": "x"},
+    ]
+    with pytest.raises(routing_validator.RoutingConfigValidatorError) as ie:
+        validator.verify_config()
+    ie.match("metric expected to be integer")
+
+
+def test_routing_validate_models_are_independent():
+    """Test that each validation builds its own model of the entries."""
+    config = [
+        {"type": "table", "table": "SF1"},
+        {"type": "table", "table": "SF2"},
+        {"type": "route", "net": "10.0.0.0/24", "gateway": "10.255.0.1"},
+    ]
+    models = []
+    for _ in range(2):
+        validator = routing_validator.RoutingConfigValidator()
+        validator.config = [dict(conf) for conf in config]
+        models.append(validator.verify_config())
+
+    assert models[0] is not models[1]
+    assert len(models[0]) == len(models[1]) == 3
+    assert models[1].table_ids == {"SF1": 100, "SF2": 101}
+
+
+def test_routing_validate_missing_device(monkeypatch):
+    """Test that entries of absent devices are rejected, or deferred."""
+    monkeypatch.setattr(routing_validator.netifaces, "interfaces", lambda: ["eth0"])
+    config = [
+        {"type": "route", "net": "10.0.0.0/24", "device": "eth0"},
+        {"type": "route", "net": "10.0.1.0/24", "device": "bond1"},
+        {"type": "rule", "from-net": "10.0.1.0/24", "iif": "bond1"},
+        {"type": "rule", "from-net": "10.0.2.0/24", "oif": "vlan7"},
+    ]
+    validator = routing_validator.RoutingConfigValidator()
+    validator.config = [dict(conf) for conf in config]
+    with pytest.raises(routing_validator.RoutingConfigValidatorError) as ie:
+        validator.verify_config()
+    ie.match("Device bond1 does not exist")
+
+    validator = routing_validator.RoutingConfigValidator()
+    validator.defer_missing_devices = True
+    validator.config = [dict(conf) for conf in config]
+    model = validator.verify_config()
+
+    assert model.configs() == [config[0]]
+    assert model.deferred_configs() == {
+        "bond1": [config[1], config[2]],
+        "vlan7": [config[3]],
+    }
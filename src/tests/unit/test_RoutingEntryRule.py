@@ -1,4 +1,6 @@
 """RoutingEntryRule unit testing module."""
+import subprocess
+
 import pytest
 
 import routing_entry
@@ -26,13 +28,23 @@ import routing_entry
             },
             (
                 b"0:\tfrom all lookup local\n"
-                b"101:\tfrom 10.0.0.0/24 lookup SF1\n"
+                b"101:\tfrom 10.0.0.0/24 lookup SF1 proto juju-routing\n"
                 b"32766:\tfrom all lookup main\n"
                 b"32767:\tfrom all lookup default\n"
             ),
             True,
             id="From-ToAll-Table-Prio-Found=True",
         ),
+        pytest.param(
+            {"from-net": "10.0.0.0/24", "table": "SF1", "priority": 101},
+            (
+                b"0:\tfrom all lookup local\n"
+                b"101:\tfrom 10.0.0.0/24 lookup SF1\n"
+                b"32766:\tfrom all lookup main\n"
+            ),
+            False,
+            id="From-Table-Prio-Untagged=False",
+        ),
         pytest.param(
             {
                 "from-net": "all",
@@ -44,13 +56,50 @@ import routing_entry
             },
             (
                 b"0:\tfrom all lookup local\n"
-                b"100:\tfrom all to 10.0.0.0/24 fwmark 0x10/0xff iif lo lookup SF1\n"
+                b"100:\tfrom all to 10.0.0.0/24 fwmark 0x10/0xff iif lo lookup SF1 "
+                b"proto 250\n"
                 b"32766:\tfrom all lookup main\n"
                 b"32767:\tfrom all lookup default\n"
             ),
             True,
             id="FromAll-ToNet-Fwmark-Iif-Table-Prio-Found=True",
         ),
+        pytest.param(
+            {
+                "from-net": "all",
+                "ipproto": "tcp",
+                "dport": "8000-8080",
+                "uidrange": "1000-1999",
+                "table": "SF1",
+                "suppress_prefixlength": 0,
+                "priority": 102,
+            },
+            (
+                b"0:\tfrom all lookup local\n"
+                b"102:\tfrom all uidrange 1000-1999 ipproto tcp dport 8000-8080 "
+                b"lookup SF1 suppress_prefixlength 0 proto 250\n"
+                b"32766:\tfrom all lookup main\n"
+            ),
+            True,
+            id="FromAll-Uidrange-Ipproto-Dport-Suppress-Found=True",
+        ),
+        pytest.param(
+            {
+                "not": True,
+                "from-net": "10.0.0.0/24",
+                "ipproto": "tcp",
+                "dport": "8080",
+                "table": "SF1",
+                "priority": 103,
+            },
+            (
+                b"0:\tfrom all lookup local\n"
+                b"103:\tfrom 10.0.0.0/24 ipproto tcp dport 8080 lookup SF1\n"
+                b"32766:\tfrom all lookup main\n"
+            ),
+            False,
+            id="Not-From-Ipproto-Dport-NotInverted=False",
+        ),
     ],
 )
 def test_routing_entry_rule_is_duplicate(
@@ -61,3 +110,64 @@ def test_routing_entry_rule_is_duplicate(
     monkeypatch.setattr("subprocess.check_output", lambda L: check_output)
     r_entry_rule = routing_entry.RoutingEntryRule(config)
     assert r_entry_rule.is_duplicate() is expected_result
+
+
+def test_routing_entry_rule_apply_untagged(monkeypatch):
+    """Test that a rule installed without the charm's protocol is tagged."""
+    monkeypatch.setattr("routing_entry.hookenv.log", lambda msg, level: None)
+    monkeypatch.setattr(
+        "subprocess.check_output",
+        lambda cmd: b"101:\tfrom 10.0.0.0/24 lookup SF1\n",
+    )
+    commands = []
+    monkeypatch.setattr("subprocess.check_call", commands.append)
+
+    routing_entry.RoutingEntryRule(
+        {"from-net": "10.0.0.0/24", "table": "SF1", "priority": 101}
+    ).apply()
+
+    assert [" ".join(cmd) for cmd in commands] == [
+        "ip rule add from 10.0.0.0/24 table SF1 priority 101 protocol 250",
+        "ip rule del from 10.0.0.0/24 table SF1 priority 101 protocol unspec",
+    ]
+
+
+def test_routing_entry_rule_apply_untagged_failure(monkeypatch):
+    """Test that the untagged rule is kept if its tagged copy is not added."""
+    monkeypatch.setattr("routing_entry.hookenv.log", lambda msg, level: None)
+    monkeypatch.setattr(
+        "subprocess.check_output",
+        lambda cmd: b"32765:\tfrom 10.0.0.0/24 lookup SF1 proto boot\n",
+    )
+    rule = routing_entry.RoutingEntryRule({"from-net": "10.0.0.0/24", "table": "SF1"})
+    commands = []
+
+    def check_call(cmd):
+        commands.append(" ".join(cmd))
+        if cmd[2] == "add":
+            raise subprocess.CalledProcessError(2, cmd)
+
+    monkeypatch.setattr("subprocess.check_call", check_call)
+    rule.apply()
+    assert commands == ["ip rule add from 10.0.0.0/24 table SF1 protocol 250"]
+
+    monkeypatch.setattr("subprocess.check_call", commands.append)
+    rule.apply()
+    # the kernel picks the priority of the tagged copy
+    assert " ".join(commands[-1]) == (
+        "ip rule del from 10.0.0.0/24 table SF1 priority 32765 protocol boot"
+    )
+
+
+def test_routing_entry_rule_is_duplicate_tos_name(monkeypatch):
+    """Test that a tos listed by its rt_dsfield name is recognised."""
+    monkeypatch.setattr("routing_entry.hookenv.log", lambda msg, level: None)
+    monkeypatch.setattr(routing_entry.RoutingEntryRule, "dsfield_cache", {"CS1": 0x20})
+    rule = routing_entry.RoutingEntryRule(
+        {"from-net": "2001:db8::/64", "tos": "0x20", "table": "SF1", "priority": 104}
+    )
+
+    assert rule.is_duplicate(["104:\tfrom 2001:db8::/64 tos CS1 lookup SF1 proto 250"])
+    assert not rule.is_duplicate(
+        ["104:\tfrom 2001:db8::/64 tos AF11 lookup SF1 proto 250"]
+    )
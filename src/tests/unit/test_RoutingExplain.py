@@ -0,0 +1,131 @@
+"""Packet explainer unit testing module."""
+import routing_entry
+
+import routing_explain
+
+
+def model(confs):
+    """Return a model of the given route and rule configs."""
+    classes = {
+        "route": routing_entry.RoutingEntryRoute,
+        "rule": routing_entry.RoutingEntryRule,
+    }
+    return routing_entry.RoutingModel(classes[conf["type"]](conf) for conf in confs)
+
+
+EXPLAINER = routing_explain.PacketExplainer(
+    model(
+        [
+            {
+                "type": "route",
+                "default_route": True,
+                "gateway": "10.1.0.1",
+                "table": "SF1",
+            },
+            {
+                "type": "route",
+                "net": "8.8.0.0/16",
+                "gateway": "10.1.0.2",
+                "table": "SF1",
+            },
+            {
+                "type": "route",
+                "net": "8.8.8.0/24",
+                "gateway": "10.1.0.3",
+                "table": "SF1",
+            },
+            {
+                "type": "route",
+                "net": "8.8.8.0/24",
+                "gateway": "10.1.0.4",
+                "table": "SF1",
+                "metric": 10,
+            },
+            {"type": "route", "net": "9.9.9.0/24", "gateway": "10.0.0.1"},
+            {
+                "type": "route",
+                "default_route": True,
+                "gateway": "10.2.0.1",
+                "table": "WEB",
+            },
+            {
+                "type": "rule",
+                "from-net": "10.1.0.0/24",
+                "table": "SF1",
+                "priority": 100,
+            },
+            {
+                "type": "rule",
+                "from-net": "all",
+                "ipproto": "tcp",
+                "dport": "443",
+                "table": "WEB",
+            },
+            {
+                "type": "rule",
+                "from-net": "all",
+                "fwmark": "0x10/0xff",
+                "iif": "eth2",
+                "table": "WEB",
+            },
+            {
+                "type": "rule",
+                "not": True,
+                "from-net": "10.0.0.0/8",
+                "table": "main",
+                "suppress_prefixlength": 0,
+                "priority": 50,
+            },
+        ]
+    )
+)
+
+
+def test_explain_longest_prefix_match():
+    """Test that the most specific route, then the lowest metric, wins."""
+    result = EXPLAINER.explain({"src": "10.1.0.5", "dst": "8.8.8.8"})
+
+    assert result["result"] == "route"
+    assert result["table"] == "SF1"
+    assert result["rule"]["priority"] == 100
+    assert result["route"]["gateway"] == "10.1.0.3"
+
+    result = EXPLAINER.explain({"src": "10.1.0.5", "dst": "8.8.4.4"})
+    assert result["route"]["gateway"] == "10.1.0.2"
+    result = EXPLAINER.explain({"src": "10.1.0.5", "dst": "1.1.1.1"})
+    assert result["route"]["gateway"] == "10.1.0.1"
+
+
+def test_explain_selectors():
+    """Test the protocol, port, mark and interface selectors."""
+    https = {"src": "10.3.0.5", "dst": "1.1.1.1", "proto": "6", "dport": 443}
+    result = EXPLAINER.explain(https)
+    assert result["table"] == "WEB"
+    # the kernel inserts rules without priority before the first rule
+    assert result["rule"]["priority"] == 99
+
+    marked = {"src": "10.3.0.5", "dst": "1.1.1.1", "fwmark": "0x110", "iif": "eth2"}
+    result = EXPLAINER.explain(marked)
+    assert result["table"] == "WEB" and result["rule"]["priority"] == 98
+
+    result = EXPLAINER.explain(dict(marked, iif="eth1"))
+    assert result["result"] == "unresolved"
+    assert [rule["table"] for rule in result["rules"]] == ["local", "main", "default"]
+
+
+def test_explain_suppress_prefixlength():
+    """Test that a default route is ignored with suppress_prefixlength 0."""
+    result = EXPLAINER.explain({"src": "192.168.0.1", "dst": "9.9.9.9"})
+    assert result["rule"]["priority"] == 50 and result["table"] == "main"
+
+    result = EXPLAINER.explain({"src": "2001:db8::5", "dst": "2001:db8::1"})
+    assert result["result"] == "unresolved"
+
+
+def test_explain_all_reports_invalid_packets():
+    """Test that invalid packets do not stop a batch."""
+    results = EXPLAINER.explain_all(
+        [{"src": "10.1.0.5"}, {"dst": "8.8.8.8", "proto": "nosuch"}, {"dst": "9.9.9.9"}]
+    )
+
+    assert [result["result"] for result in results] == ["error", "error", "route"]
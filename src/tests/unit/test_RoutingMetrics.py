@@ -0,0 +1,104 @@
+"""RoutingMetrics unit testing module."""
+from unittest import mock
+
+import routing_metrics
+
+
+class FakeEntry:
+    """Minimal routing entry stand-in."""
+
+    def __init__(self, kind):
+        """Init function."""
+        self.kind = kind
+
+
+def test_render(monkeypatch):
+    """Test that the collected metrics are rendered in text format."""
+    monkeypatch.setattr("routing_metrics.hookenv.hook_name", lambda: "test-hook")
+    collector = routing_metrics.RoutingMetrics()
+    with collector.phase("apply"):
+        pass
+    collector.count_entries([FakeEntry("route"), FakeEntry("route"), FakeEntry("rule")])
+    collector.record("applied", "route")
+    collector.record("duplicate", "rule")
+    collector.finish_spawn(collector.record_spawn("ip route", 0.0), 0)
+    collector.finish_spawn(collector.record_spawn("ip route", 0.0), 2)
+    collector.set_fingerprint("[]")
+
+    text = collector.render()
+
+    assert 'juju_advanced_routing_phase_duration_seconds{phase="apply"}' in text
+    assert 'juju_advanced_routing_entries{type="route"} 2' in text
+    assert 'juju_advanced_routing_entries_applied{type="route"} 1' in text
+    assert 'juju_advanced_routing_entries_duplicate{type="rule"} 1' in text
+    assert "juju_advanced_routing_subprocesses 2" in text
+    assert 'juju_advanced_routing_subprocesses_by_command{command="ip route"} 2' in text
+    assert 'juju_advanced_routing_subprocess_failures{command="ip route"} 1' in text
+    assert 'juju_advanced_routing_config_info{fingerprint="' in text
+
+
+def test_write(tmpdir, monkeypatch):
+    """Test that metrics are only written when the collector dir exists."""
+    monkeypatch.setattr("routing_metrics.hookenv.hook_name", lambda: "test-hook")
+    monkeypatch.setattr("routing_metrics.hookenv.log", lambda msg, level: None)
+    collector = routing_metrics.RoutingMetrics()
+
+    path = tmpdir.join("routing.prom")
+    assert collector.write(str(path))
+    assert "juju_advanced_routing_subprocesses 0" in path.read()
+
+    assert not collector.write(str(tmpdir.join("missing", "routing.prom")))
+
+
+def test_history_is_bounded(monkeypatch):
+    """Test that the timing history keeps only the newest spans."""
+    monkeypatch.setattr("routing_metrics.hookenv.hook_name", lambda: "test-hook")
+    kv = {}
+    store = mock.Mock()
+    store.get.side_effect = lambda key, default=None: kv.get(key, default)
+    store.set.side_effect = kv.__setitem__
+
+    collector = routing_metrics.RoutingMetrics()
+    collector.history_size = 3
+    assert not collector.save_history(store)
+
+    for run in range(5):
+        collector.reset()
+        collector.phases["apply"] = float(run)
+        assert collector.save_history(store)
+
+    history = collector.load_history(store)
+    assert [span["phases"]["apply"] for span in history] == [4.0, 3.0, 2.0]
+    assert len(collector.load_history(store, limit=1)) == 1
+
+
+def test_keep_last_apply(monkeypatch):
+    """Test that runs without an apply report the metrics of the last one."""
+    monkeypatch.setattr("routing_metrics.hookenv.hook_name", lambda: "test-hook")
+    kv = {}
+    store = mock.Mock()
+    store.get.side_effect = lambda key, default=None: kv.get(key, default)
+    store.set.side_effect = kv.__setitem__
+
+    collector = routing_metrics.RoutingMetrics()
+    assert not collector.keep_last_apply(store)
+    collector.phases["apply"] = 1.5
+    collector.count_entries([FakeEntry("route"), FakeEntry("rule")])
+    collector.record("applied", "route")
+    collector.set_gauge("rules", 1)
+    collector.set_fingerprint("[]")
+    assert collector.keep_last_apply(store)
+
+    # e.g. update-status
+    collector.reset()
+    collector.set_gauge("deferred_entries", 0)
+    assert not collector.keep_last_apply(store)
+    text = collector.render()
+
+    assert 'juju_advanced_routing_phase_duration_seconds{phase="apply"} 1.5' in text
+    assert 'juju_advanced_routing_entries{type="route"} 1' in text
+    assert 'juju_advanced_routing_entries_applied{type="route"} 1' in text
+    assert "juju_advanced_routing_rules 1" in text
+    assert "juju_advanced_routing_deferred_entries 0" in text
+    assert "juju_advanced_routing_last_apply_timestamp_seconds " in text
+    assert 'juju_advanced_routing_config_info{fingerprint="' in text
@@ -0,0 +1,68 @@
+"""Networkd rendering unit testing module."""
+import pytest
+
+import routing_networkd
+
+TABLE_IDS = {"SF1": 100}
+CONFS = [
+    {"type": "table", "table": "SF1"},
+    {"type": "route", "default_route": True, "gateway": "10.0.0.1", "table": "SF1"},
+    {
+        "type": "route",
+        "net": "6.6.6.0/24",
+        "device": "eth1",
+        "mtu": 9000,
+        "mtu_lock": 1400,
+    },
+    {
+        "type": "rule",
+        "from-net": "192.170.2.0/24",
+        "to-net": "all",
+        "table": "SF1",
+        "priority": 101,
+    },
+    {
+        "type": "rule",
+        "not": True,
+        "from-net": "all",
+        "fwmark": "0x10/0xff",
+        "iif": "eth2",
+    },
+]
+
+
+def test_group_by_device():
+    """Test that rules follow the device of the routes of their table."""
+    groups = routing_networkd.group_by_device(CONFS, lambda gateway: "eth0")
+
+    assert groups == {
+        "eth0": [CONFS[1], CONFS[3]],
+        "eth1": [CONFS[2]],
+        "eth2": [CONFS[4]],
+    }
+
+
+def test_group_by_device_without_routes():
+    """Test that a rule without any device cannot be rendered."""
+    with pytest.raises(routing_networkd.NetworkdRenderError):
+        routing_networkd.group_by_device([CONFS[3]])
+
+
+def test_render_dropin():
+    """Test the networkd sections of routes and rules."""
+    dropin = routing_networkd.render_dropin(CONFS[1:], TABLE_IDS, 250)
+
+    assert dropin == (
+        "# This file is managed by Juju.\n"
+        "\n"
+        "[Route]\nGateway=10.0.0.1\nTable=100\nProtocol=250\n"
+        "\n"
+        "[Route]\nDestination=6.6.6.0/24\nMTUBytes=1400\nScope=link\n"
+        "Table=254\nProtocol=250\n"
+        "\n"
+        "[RoutingPolicyRule]\nFrom=192.170.2.0/24\nPriority=101\nTable=100\n"
+        "Protocol=250\n"
+        "\n"
+        "[RoutingPolicyRule]\nFirewallMark=0x10/0xff\nIncomingInterface=eth2\n"
+        "InvertRule=yes\nTable=254\nProtocol=250\n"
+    )
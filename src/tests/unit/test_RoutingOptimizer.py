@@ -0,0 +1,175 @@
+"""Routing optimizer unit testing module."""
+import pytest
+
+import routing_entry
+
+import routing_optimizer
+
+
+@pytest.fixture
+def quiet(monkeypatch):
+    """Silence hookenv logging."""
+    monkeypatch.setattr("routing_entry.hookenv.log", lambda *args, **kw: None)
+
+
+def routes(*confs):
+    """Return route entries for the given configs."""
+    return [routing_entry.RoutingEntryRoute(dict(conf, type="route")) for conf in confs]
+
+
+def test_aggregate_routes(quiet):
+    """Test that adjacent prefixes with the same attributes are merged."""
+    entries = routes(
+        {"net": "10.0.0.0/24", "gateway": "192.168.0.1"},
+        {"net": "10.0.1.0/24", "gateway": "192.168.0.1"},
+        {"net": "10.0.2.0/24", "gateway": "192.168.0.1"},
+        {"net": "10.0.3.0/24", "gateway": "192.168.0.1"},
+        {"net": "10.0.4.0/24", "gateway": "192.168.0.2"},
+        {"net": "10.0.5.0/24", "gateway": "192.168.0.1", "metric": 10},
+    )
+
+    result, before, after = routing_optimizer.aggregate_routes(entries)
+
+    assert (before, after) == (6, 3)
+    assert [entry.config["net"] for entry in result] == [
+        "10.0.0.0/22",
+        "10.0.4.0/24",
+        "10.0.5.0/24",
+    ]
+
+
+def test_aggregate_routes_conflict(quiet):
+    """Test that a merge that would change a packet path is skipped."""
+    entries = routes(
+        {"net": "10.0.0.0/25", "gateway": "192.168.0.1"},
+        {"net": "10.0.0.128/25", "gateway": "192.168.0.1"},
+        {"net": "10.0.0.128/25", "gateway": "192.168.0.2", "metric": 10},
+        {"net": "10.1.0.0/24", "gateway": "192.168.0.1", "table": "SF1"},
+        {"net": "10.1.1.0/24", "gateway": "192.168.0.1", "table": "SF1"},
+        # a route of another group at the supernet itself
+        {"net": "10.2.0.0/24", "gateway": "10.9.0.1", "table": "SF2"},
+        {"net": "10.2.1.0/24", "gateway": "10.9.0.1", "table": "SF2"},
+        {"net": "10.2.0.0/23", "gateway": "10.9.0.2", "table": "SF2"},
+    )
+
+    result, before, after = routing_optimizer.aggregate_routes(entries)
+
+    assert (before, after) == (8, 7)
+    assert [entry.config["net"] for entry in result] == [
+        "10.0.0.0/25",
+        "10.0.0.128/25",
+        "10.0.0.128/25",
+        "10.1.0.0/23",
+        "10.2.0.0/24",
+        "10.2.1.0/24",
+        "10.2.0.0/23",
+    ]
+
+
+def test_minimize_rules(quiet):
+    """Test that dead and shadowed rules are dropped and others merged."""
+    tables = [
+        routing_entry.RoutingEntryTable({"type": "table", "table": "SF1"}),
+        routing_entry.RoutingEntryTable({"type": "table", "table": "SF2"}),
+        routing_entry.RoutingEntryTable({"type": "table", "table": "EMPTY"}),
+    ]
+    default = routes(
+        {"default_route": True, "gateway": "10.0.0.1", "table": "SF1"},
+        {"net": "10.9.0.0/16", "gateway": "10.0.0.1", "table": "SF2"},
+    )
+    rules = [
+        routing_entry.RoutingEntryRule(dict(conf, type="rule"))
+        for conf in (
+            {"from-net": "10.1.0.0/16", "table": "SF1", "priority": 100},
+            # shadowed: SF1 has a default route, so lookups never fall through
+            {"from-net": "10.1.2.0/24", "table": "SF2", "priority": 101},
+            # not shadowed: the earlier rule only matches fwmark 0x1
+            {"fwmark": "0x1", "from-net": "all", "table": "SF2", "priority": 102},
+            {"from-net": "10.2.0.0/24", "table": "SF2", "priority": 103},
+            # dead: EMPTY has no route
+            {"from-net": "10.3.0.0/24", "table": "EMPTY", "priority": 104},
+            {"from-net": "10.4.0.0/24", "table": "SF2", "priority": 110},
+            {"from-net": "10.4.1.0/24", "table": "SF2", "priority": 110},
+            {"from-net": "10.2.0.0/25", "table": "SF2", "priority": 120},
+        )
+    ]
+
+    result, before, after = routing_optimizer.minimize_rules(tables + default + rules)
+
+    assert (before, after) == (8, 4)
+    assert [
+        (entry.config["from-net"], entry.config["priority"])
+        for entry in result
+        if entry.kind == "rule"
+    ] == [
+        ("10.1.0.0/16", 100),
+        ("all", 102),
+        ("10.2.0.0/24", 103),
+        ("10.4.0.0/23", 110),
+    ]
+
+
+def test_minimize_rules_inverted(quiet):
+    """Test that inverted rules are neither shadowed nor merged."""
+    rules = [
+        routing_entry.RoutingEntryRule(dict(conf, type="rule"))
+        for conf in (
+            {"from-net": "10.0.0.0/8", "priority": 100},
+            {"not": True, "from-net": "10.1.0.0/24", "priority": 101},
+            {"not": True, "from-net": "10.5.0.0/24", "priority": 110},
+            {"not": True, "from-net": "10.5.1.0/24", "priority": 110},
+        )
+    ]
+
+    _, before, after = routing_optimizer.minimize_rules(rules)
+
+    assert (before, after) == (4, 4)
+
+
+def test_minimize_rules_mixed_families(quiet):
+    """Test that IPv4 and IPv6 rules of the same priority are merged apart."""
+    entries = routes(
+        {"net": "10.9.0.0/16", "gateway": "10.0.0.1", "table": "SF1"},
+        {"net": "2001:db8:9::/48", "gateway": "2001:db8::1", "table": "SF1"},
+    ) + [
+        routing_entry.RoutingEntryRule(dict(conf, type="rule", table="SF1"))
+        for conf in (
+            {"from-net": "10.4.0.0/24", "priority": 110},
+            {"from-net": "2001:db8:4::/64", "priority": 110},
+            {"from-net": "10.4.1.0/24", "priority": 110},
+            {"from-net": "2001:db8:4:1::/64", "priority": 110},
+        )
+    ]
+
+    result, before, after = routing_optimizer.minimize_rules(entries)
+
+    assert (before, after) == (4, 2)
+    assert [
+        entry.config["from-net"] for entry in result if entry.kind == "rule"
+    ] == ["10.4.0.0/23", "2001:db8:4::/63"]
+
+
+def test_optimize_with_deferred_entries(quiet):
+    """Test that the routes waiting for their device are accounted for."""
+    tables = [routing_entry.RoutingEntryTable({"type": "table", "table": "SF2"})]
+    entries = routes(
+        {"net": "10.1.0.0/24", "gateway": "192.168.0.1"},
+        {"net": "10.1.1.0/24", "gateway": "192.168.0.1"},
+    )
+    rules = [
+        routing_entry.RoutingEntryRule(
+            {"type": "rule", "from-net": "10.5.0.0/24", "table": "SF2"}
+        )
+    ]
+    deferred = routes(
+        {"net": "10.1.1.0/24", "device": "eth9"},
+        {"net": "0.0.0.0/0", "device": "eth9", "table": "SF2"},
+    )
+
+    _, before, after = routing_optimizer.aggregate_routes(entries, deferred)
+    assert (before, after) == (2, 2)
+
+    _, before, after = routing_optimizer.minimize_rules(tables + rules, deferred)
+    assert (before, after) == (1, 1)
+    _, before, after = routing_optimizer.minimize_rules(tables + rules)
+    assert (before, after) == (1, 0)
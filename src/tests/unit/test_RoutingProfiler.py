@@ -0,0 +1,37 @@
+"""Routing profiler unit testing module."""
+import pathlib
+
+import routing_profiler
+
+
+def test_profile_disabled(tmpdir, monkeypatch):
+    """Test that nothing is written when profiling is not enabled."""
+    monkeypatch.delenv(routing_profiler.PROFILE_ENV, raising=False)
+    monkeypatch.setattr("routing_profiler.hookenv.config", lambda: {})
+    profile_dir = pathlib.Path(str(tmpdir)) / "profiles"
+
+    with routing_profiler.profile("test", profile_dir):
+        pass
+
+    assert not profile_dir.exists()
+
+
+def test_profile_enabled_rotates(tmpdir, monkeypatch):
+    """Test that profiles are written and only the newest are kept."""
+    monkeypatch.setenv(routing_profiler.PROFILE_ENV, "1")
+    monkeypatch.setattr("routing_profiler.hookenv.log", lambda msg, level: None)
+    monkeypatch.setattr("routing_profiler.PROFILE_KEEP", 2)
+    profile_dir = pathlib.Path(str(tmpdir)) / "profiles"
+    profile_dir.mkdir()
+    for stem in ("20000101T000000-1-old", "20000101T000001-1-old"):
+        (profile_dir / "{}.pstats".format(stem)).touch()
+        (profile_dir / "{}.alloc.txt".format(stem)).touch()
+
+    with routing_profiler.profile("test", profile_dir):
+        sorted(range(1000))
+
+    names = sorted(path.name for path in profile_dir.iterdir())
+    assert len(names) == 4
+    assert not any(name.startswith("20000101T000000") for name in names)
+    assert any(name.endswith("-test.pstats") for name in names)
+    assert any(name.endswith("-test.alloc.txt") for name in names)
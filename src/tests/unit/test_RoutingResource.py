@@ -0,0 +1,150 @@
+"""RoutingResource unit testing module."""
+import gzip
+import json
+import pathlib
+
+import pytest
+
+import routing_resource
+
+COMPACT = b"""# bulk routes
+table SF1
+route default via 10.191.86.2 table SF1 metric 101 dev eth0
+route 6.6.7.0/24 dev eth0 mtu lock 1400
+route 10.20.0.0/16 via 10.191.86.2 initcwnd 32 congctl bbr quickack 1
+
+rule fwmark 0x10/0xff iif eth0 table SF1 pref 100  # steer marked traffic
+"""
+
+EXPECTED = [
+    {"type": "table", "table": "SF1"},
+    {
+        "type": "route",
+        "default_route": True,
+        "gateway": "10.191.86.2",
+        "table": "SF1",
+        "metric": 101,
+        "device": "eth0",
+    },
+    {"type": "route", "net": "6.6.7.0/24", "device": "eth0", "mtu_lock": 1400},
+    {
+        "type": "route",
+        "net": "10.20.0.0/16",
+        "gateway": "10.191.86.2",
+        "initcwnd": 32,
+        "congctl": "bbr",
+        "quickack": 1,
+    },
+    {
+        "type": "rule",
+        "fwmark": "0x10/0xff",
+        "iif": "eth0",
+        "table": "SF1",
+        "priority": 100,
+    },
+]
+
+
+@pytest.fixture
+def resource_cache(tmpdir, monkeypatch):
+    """Keep the resource cache in a temporary directory."""
+    cache_dir = pathlib.Path(str(tmpdir)) / "cache"
+    monkeypatch.setattr(routing_resource.RoutingResource, "cache_dir", cache_dir)
+    monkeypatch.setattr("routing_resource.hookenv.log", lambda *args, **kw: None)
+    return cache_dir
+
+
+def test_compact_format(tmpdir, resource_cache):
+    """Test parsing the compact line format and caching the result."""
+    path = tmpdir.join("routes.txt")
+    path.write_binary(COMPACT)
+    resource = routing_resource.RoutingResource(str(path))
+
+    assert resource.load() == EXPECTED
+    cache_path = resource_cache / "{}.json".format(resource.cache_key)
+    assert json.loads(cache_path.read_text()) == EXPECTED
+
+    # a cached resource is not parsed again
+    resource.entries = None
+    assert resource.load() == EXPECTED
+
+
+def test_cache_key(tmpdir, resource_cache, monkeypatch):
+    """Test that the cache key changes with the charm revision."""
+    charm_dir = tmpdir.mkdir("charm")
+    charm_dir.join("revision").write("7\n")
+    monkeypatch.setattr("routing_resource.hookenv.charm_dir", lambda: str(charm_dir))
+    path = tmpdir.join("routes.txt")
+    path.write_binary(COMPACT)
+    resource = routing_resource.RoutingResource(str(path))
+
+    assert resource.cache_key == "{}-7-{}".format(
+        routing_resource.CACHE_SCHEMA, resource.digest
+    )
+    charm_dir.join("revision").write("8\n")
+    assert resource.cache_key == "{}-8-{}".format(
+        routing_resource.CACHE_SCHEMA, resource.digest
+    )
+
+
+def test_corrupt_cache(tmpdir, resource_cache):
+    """Test that a corrupt cache file is parsed again and rewritten."""
+    path = tmpdir.join("routes.txt")
+    path.write_binary(COMPACT)
+    resource = routing_resource.RoutingResource(str(path))
+    cache_path = resource_cache / "{}.json".format(resource.cache_key)
+    resource_cache.mkdir()
+    cache_path.write_text('[{"net": ')
+
+    assert resource.load() == EXPECTED
+    assert json.loads(cache_path.read_text()) == EXPECTED
+
+
+def test_gzipped_json(tmpdir, resource_cache):
+    """Test reading gzipped JSON."""
+    path = tmpdir.join("routes.json.gz")
+    path.write_binary(gzip.compress(json.dumps(EXPECTED).encode("utf8")))
+
+    assert list(routing_resource.RoutingResource(str(path)).entries()) == EXPECTED
+
+
+def test_gzipped_json_streamed(tmpdir, resource_cache, monkeypatch):
+    """Test that the entries are decoded across decompressed chunks."""
+    monkeypatch.setattr(routing_resource, "JSON_CHUNK_SIZE", 7)
+    path = tmpdir.join("routes.json.gz")
+    path.write_binary(gzip.compress(json.dumps(EXPECTED, indent=1).encode("utf8")))
+
+    assert list(routing_resource.RoutingResource(str(path)).entries()) == EXPECTED
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        gzip.compress(b'{"type": "table"}'),  # not a list
+        gzip.compress(b'[{"type": "table"}'),  # unterminated
+        gzip.compress(b'[{"type": "table"} {"type": "table"}]'),
+        gzip.compress(b'["\xff"]'),  # not UTF-8
+        gzip.compress(b"[]")[:-6],  # truncated
+        b"table SF1\nroute 10.0.0.0/24 dev \xff\n",  # not UTF-8
+    ],
+)
+def test_bad_content(tmpdir, resource_cache, content):
+    """Test that undecodable resources raise the resource error."""
+    path = tmpdir.join("routes")
+    path.write_binary(content)
+
+    with pytest.raises(routing_resource.RoutingResourceError):
+        routing_resource.RoutingResource(str(path)).load()
+
+
+@pytest.mark.parametrize(
+    "line",
+    ["route", "route 1.1.1.0/24 via", "rule from 1.1.1.0/24 lookup SF1", "table"],
+)
+def test_bad_line(tmpdir, resource_cache, line):
+    """Test that malformed lines are reported with their line number."""
+    path = tmpdir.join("routes.txt")
+    path.write("table SF1\n{}\n".format(line))
+
+    with pytest.raises(routing_resource.RoutingResourceError, match="line 2"):
+        routing_resource.RoutingResource(str(path)).load()
@@ -0,0 +1,59 @@
+"""Early-boot restore unit testing module."""
+import json
+import subprocess
+
+import routing_restore
+
+
+def test_device_ready(tmp_path):
+    """Test that only existing devices that are up are ready."""
+    for device, state in (("eth0", "up\n"), ("eth1", "down\n"), ("lo", "unknown\n")):
+        (tmp_path / device).mkdir()
+        (tmp_path / device / "operstate").write_text(state)
+
+    assert routing_restore.device_ready("eth0", str(tmp_path))
+    assert not routing_restore.device_ready("eth1", str(tmp_path))
+    assert routing_restore.device_ready("lo", str(tmp_path))
+    assert not routing_restore.device_ready("eth9", str(tmp_path))
+
+
+def test_restore(monkeypatch):
+    """Test that the batch is applied once the devices are up or timed out."""
+    polls = {"eth0": 0}
+
+    def ready(device):
+        if device == "eth0":
+            polls["eth0"] += 1
+            return polls["eth0"] > 2
+        return False
+
+    batches = []
+
+    def run(cmd, **kwargs):
+        batches.append((cmd, kwargs["input"]))
+        return subprocess.CompletedProcess(cmd, 1, stderr="Command failed -:2\n")
+
+    monkeypatch.setattr(routing_restore, "POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(routing_restore.subprocess, "run", run)
+    config = {
+        "devices": ["eth0", "eth1"],
+        "device_timeout": 0.1,
+        "batch": [
+            "route replace 10.0.0.0/24 dev eth0",
+            "route replace 10.1.0.0/24 dev eth1",
+        ],
+    }
+
+    stats = routing_restore.restore(config, ready)
+
+    assert polls["eth0"] == 3
+    assert stats["missing_devices"] == ["eth1"]
+    assert stats["wait_seconds"] >= 0.1
+    assert stats["entries"] == 2 and stats["failures"] == 1
+    assert batches == [
+        (
+            ["ip", "-force", "-batch", "-"],
+            "route replace 10.0.0.0/24 dev eth0\nroute replace 10.1.0.0/24 dev eth1\n",
+        )
+    ]
+    json.dumps(stats)
@@ -0,0 +1,63 @@
+"""Spawn ledger unit testing module."""
+import asyncio
+import subprocess
+import sys
+
+import pytest
+
+import routing_metrics
+
+import routing_spawns
+
+
+@pytest.mark.parametrize(
+    "args,expected",
+    [
+        (["ip", "-json", "-4", "route", "show"], "ip route"),
+        (["ip", "-n", "route", "rule", "add"], "ip rule"),
+        (["/sbin/ip", "-6", "rule"], "ip rule"),
+        (["systemctl", "daemon-reload"], "systemctl daemon-reload"),
+        (["sh", "-c", "/usr/local/bin/cleanup"], "sh"),
+        ("juju-log -l INFO hello", "juju-log"),
+        ([], "?"),
+    ],
+)
+def test_argv_class(args, expected):
+    """Test that commands are classified by their tool and subcommand."""
+    assert routing_spawns.argv_class(args) == expected
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    """Fresh metrics collector with the ledger installed."""
+    collector = routing_metrics.RoutingMetrics()
+    monkeypatch.setattr(routing_spawns, "metrics", collector)
+    routing_spawns.install()
+    yield collector
+    routing_spawns.uninstall()
+
+
+def test_ledger_records_spawns(ledger):
+    """Test that processes spawned by any means are recorded on exit."""
+    subprocess.call([sys.executable, "-c", "pass"])
+    with pytest.raises(subprocess.CalledProcessError):
+        subprocess.check_call([sys.executable, "-c", "raise SystemExit(3)"])
+
+    async def spawn():
+        proc = await asyncio.create_subprocess_exec(sys.executable, "-c", "pass")
+        await proc.wait()
+
+    asyncio.run(spawn())
+
+    assert [spawn["exit"] for spawn in ledger.spawns] == [0, 3, 0]
+    assert all(spawn["seconds"] > 0 for spawn in ledger.spawns)
+    assert ledger.spawn_summary().startswith("Spawned 3 processes")
+    assert "(1 failed)" in ledger.spawn_summary()
+
+
+def test_uninstall(ledger):
+    """Test that processes are no longer recorded once uninstalled."""
+    routing_spawns.uninstall()
+    subprocess.call([sys.executable, "-c", "pass"])
+    assert ledger.spawns == []
+    assert subprocess.Popen is routing_spawns.LedgerPopen.__bases__[0]
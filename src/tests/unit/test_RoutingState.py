@@ -0,0 +1,287 @@
+"""Routing state unit testing module."""
+import routing_state
+
+KERNEL_ROUTES = [
+    (4, dict(route, dev="eth0", protocol="juju-routing"))
+    for route in (
+        {"dst": "default", "gateway": "10.0.0.1", "table": "SF1"},
+        {"dst": "6.6.6.0/24", "gateway": "10.0.0.1"},
+        {"dst": "7.7.7.0/24", "gateway": "10.0.0.1"},
+        {"dst": "8.8.8.0/24", "gateway": "10.0.0.9"},
+    )
+]
+KERNEL_RULES = [
+    (4, {"priority": 0, "src": "all", "table": "local"}),
+    (4, {"priority": 100, "src": "10.0.0.0", "srclen": 24, "table": "SF1"}),
+    (
+        4,
+        {
+            "priority": 101,
+            "src": "all",
+            "fwmark": "0x10",
+            "fwmask": "0xff",
+            "table": "SF1",
+            "protocol": "juju-routing",
+        },
+    ),
+    (4, {"priority": 32766, "src": "all", "table": "main"}),
+]
+
+
+def test_rule_selector_matches_kernel():
+    """Test that config and kernel rules normalise to the same selector."""
+    conf = {"from-net": "all", "fwmark": "0x10/0xff", "priority": 101}
+    assert routing_state.rule_selector(conf) == routing_state.kernel_rule_selector(
+        KERNEL_RULES[2][1]
+    )
+
+
+def test_kernel_rule_del_cmd():
+    """Test that a dumped rule can be deleted exactly."""
+    assert routing_state.kernel_rule_del_cmd(*reversed(KERNEL_RULES[2])) == [
+        "ip",
+        "-4",
+        "rule",
+        "del",
+        "priority",
+        "101",
+        "from",
+        "all",
+        "fwmark",
+        "0x10/0xff",
+        "table",
+        "SF1",
+        "protocol",
+        "juju-routing",
+    ]
+
+
+def test_routing_plan():
+    """Test the plan between the desired entries and the kernel."""
+    state = routing_state.KernelState(KERNEL_ROUTES, KERNEL_RULES)
+    previous = [
+        {"type": "table", "table": "SF1"},
+        {"type": "route", "net": "6.6.6.0/24", "gateway": "10.0.0.1"},
+        {"type": "route", "net": "7.7.7.0/24", "gateway": "10.0.0.1"},
+        {"type": "route", "net": "8.8.8.0/24", "gateway": "10.0.0.1"},
+        {"type": "rule", "from-net": "10.0.0.0/24", "table": "SF1", "priority": 100},
+    ]
+    desired = [
+        {"type": "table", "table": "SF1"},
+        {
+            "type": "route",
+            "default_route": True,
+            "gateway": "10.0.0.1",
+            "table": "SF1",
+        },
+        {"type": "route", "net": "6.6.6.0/24", "gateway": "10.0.0.1"},
+        {"type": "route", "net": "8.8.8.0/24", "gateway": "10.0.0.1"},
+        {"type": "route", "net": "9.9.9.0/24", "gateway": "10.0.0.1"},
+        {"type": "rule", "from-net": "10.0.0.0/24", "table": "main", "priority": 100},
+    ]
+
+    plan = routing_state.RoutingPlan(desired, previous, state)
+
+    assert plan.counts() == {"add": 1, "replace": 2, "delete": 1, "unchanged": 3}
+    # 8.8.8.0/24 was applied by the charm but its gateway changed since
+    assert plan.drift == 1
+    ops = {(change["op"], change["entry"].get("net")) for change in plan.listing()}
+    assert ("add", "9.9.9.0/24") in ops
+    assert ("replace", "8.8.8.0/24") in ops
+    assert ("delete", "7.7.7.0/24") in ops
+    assert len(plan.listing(limit=2)) == 2
+
+
+def test_obsolete_cmds():
+    """Test that only the entries missing from the config are deleted."""
+    state = routing_state.KernelState(
+        [
+            (4, dict(route, protocol="250"))
+            for route in (
+                {"dst": "default", "gateway": "10.0.0.1", "table": "SF1"},
+                {"dst": "6.6.6.0/24", "gateway": "10.0.0.1", "metric": 10},
+                {"type": "blackhole", "dst": "7.7.7.0/24"},
+            )
+        ],
+        [
+            (4, dict(rule, protocol="juju-routing"))
+            for rule in (
+                {"priority": 100, "src": "10.0.0.0", "srclen": 24, "table": "SF1"},
+                {"priority": 101, "src": "10.0.0.0", "srclen": 24, "table": "SF1"},
+                {"priority": 200, "src": "all", "fwmark": "0x10", "table": "SF1"},
+            )
+        ],
+    )
+    desired = [
+        {"type": "table", "table": "SF1"},
+        {"type": "route", "default_route": True, "gateway": "10.0.0.1", "table": "SF1"},
+        {"type": "route", "net": "6.6.6.0/24", "gateway": "10.0.0.1"},
+        {"type": "rule", "from-net": "10.0.0.0/24", "table": "SF1", "priority": 101},
+        {"type": "rule", "from-net": "all", "fwmark": "0x10", "table": "SF1"},
+    ]
+
+    assert state.obsolete_cmds(desired) == [
+        "ip -4 rule del priority 100 from 10.0.0.0/24 table SF1 protocol "
+        "juju-routing".split(),
+        "ip -4 route del 6.6.6.0/24 table main metric 10 proto 250".split(),
+        "ip -4 route del blackhole 7.7.7.0/24 table main proto 250".split(),
+    ]
+
+
+def test_owned_snapshot_unfiltered_rules(monkeypatch):
+    """Test that the rules not tagged by the charm are never deleted.
+
+    ip rule show ignores a protocol filter and lists every rule.
+    """
+    dumps = {
+        "route": [{"dst": "6.6.6.0/24", "gateway": "10.0.0.1", "protocol": "250"}],
+        "rule": [
+            {"priority": 0, "src": "all", "table": "local"},
+            {"priority": 100, "src": "10.0.0.0", "srclen": 24, "table": "SF1"},
+            {
+                "priority": 101,
+                "src": "10.0.1.0",
+                "srclen": 24,
+                "table": "SF1",
+                "protocol": "juju-routing",
+            },
+            {"priority": 32766, "src": "all", "table": "main"},
+            {"priority": 32767, "src": "all", "table": "default"},
+        ],
+    }
+    monkeypatch.setattr(routing_state, "ip_json", lambda args: dumps[args[1]])
+
+    state = routing_state.KernelState.snapshot(owned=True)
+
+    assert [rule["priority"] for _, rule in state.rule_list] == [101]
+    unfiltered = routing_state.KernelState(
+        state.route_list, [(4, rule) for rule in dumps["rule"]]
+    )
+    assert unfiltered.obsolete_cmds([]) == [
+        "ip -4 rule del priority 101 from 10.0.1.0/24 table SF1 protocol "
+        "juju-routing".split(),
+        "ip -4 route del 6.6.6.0/24 table main proto 250".split(),
+    ]
+
+
+def test_route_tcp_attributes_state():
+    """Test that per-route TCP attributes are compared against the kernel."""
+    route = {
+        "dst": "10.20.0.0/16",
+        "gateway": "10.0.0.1",
+        "prefsrc": "10.0.0.5",
+        "metrics": [{"initcwnd": 32}, {"congctl": "bbr"}],
+        "protocol": "250",
+    }
+    state = routing_state.KernelState(routes=[(4, route)])
+    conf = {
+        "type": "route",
+        "net": "10.20.0.0/16",
+        "gateway": "10.0.0.1",
+        "src": "10.0.0.5",
+        "initcwnd": 32,
+        "congctl": "bbr",
+    }
+
+    assert state.route_state(conf) == "unchanged"
+    assert state.route_state(dict(conf, initcwnd=64)) == "replace"
+    assert state.route_state(dict(conf, src="10.0.0.6")) == "replace"
+    del route["protocol"]
+    # installed by hand or by a charm version not tagging its routes
+    untagged = routing_state.KernelState(routes=[(4, route)])
+    assert untagged.route_state(conf) == "replace"
+
+
+def test_rule_state_untagged():
+    """Test that a rule installed without the charm's protocol is replaced."""
+    conf = {"from-net": "10.0.0.0/24", "table": "SF1", "priority": 100}
+    state = routing_state.KernelState(rules=[KERNEL_RULES[1]])
+    assert state.rule_state(conf) == "replace"
+    assert state.has_rule(conf)
+    tagged = routing_state.KernelState(
+        rules=[(4, dict(KERNEL_RULES[1][1], protocol="250"))]
+    )
+    assert tagged.rule_state(conf) == "unchanged"
+
+
+def test_rule_selectors_match_kernel():
+    """Test that port, protocol and uid selectors match the kernel dump."""
+    conf = {
+        "from-net": "all",
+        "not": True,
+        "ipproto": "tcp",
+        "sport": "1024",
+        "dport": "8000-8080",
+        "uidrange": "1000-1999",
+        "tos": "0x10",
+        "suppress_prefixlength": 0,
+    }
+    kernel_rule = {
+        "priority": 102,
+        "not": None,
+        "src": "all",
+        "tos": "0x10",
+        "uid_start": 1000,
+        "uid_end": 1999,
+        "ipproto": "tcp",
+        "sport": 1024,
+        "dport_start": 8000,
+        "dport_end": 8080,
+        "table": "main",
+        "suppress_prefixlen": 0,
+    }
+    selector = routing_state.rule_selector(conf)
+    assert selector == routing_state.kernel_rule_selector(kernel_rule)
+    assert selector != routing_state.rule_selector(dict(conf, dport="8000"))
+    expected = (
+        "ip -4 rule del priority 102 not from all ipproto tcp tos 0x10"
+        " uidrange 1000-1999 sport 1024-1024 dport 8000-8080 table main"
+        " suppress_prefixlength 0"
+    )
+    assert routing_state.kernel_rule_del_cmd(kernel_rule, 4) == expected.split()
+
+
+def test_state_by_table():
+    """Test that the kernel state is grouped by table, filtered and bounded."""
+    state = routing_state.KernelState(
+        KERNEL_ROUTES + [(6, {"dst": "2001:db8::/64", "dev": "eth1", "metric": 1024})],
+        KERNEL_RULES,
+    )
+    groups, matches = state.by_table({"SF1": 100, "SF2": 101})
+    assert matches == 9
+    assert list(groups) == ["SF1", "SF2", "main", "local"]
+    assert groups["SF1"]["id"] == 100
+    assert groups["SF1"]["routes"] == [
+        {"dst": "default", "gateway": "10.0.0.1", "dev": "eth0"}
+    ]
+    assert groups["SF1"]["rules"][0] == {
+        "priority": 100,
+        "src": "10.0.0.0",
+        "srclen": 24,
+    }
+    assert groups["SF2"] == {"id": 101, "routes": [], "rules": []}
+
+    groups, matches = state.by_table(prefix="10.0.0.128/25")
+    assert matches == 2
+    assert groups["SF1"]["rules"] == [
+        {"priority": 100, "src": "10.0.0.0", "srclen": 24}
+    ]
+    assert groups["SF1"]["routes"][0]["dst"] == "default"
+
+    groups, matches = state.by_table(device="eth1")
+    assert matches == 1 and list(groups) == ["main"]
+
+    groups, matches = state.by_table(table="main", limit=2)
+    assert matches == 5
+    assert len(groups["main"]["routes"]) == 2 and groups["main"]["rules"] == []
+
+
+def test_rule_selector_tos_name(monkeypatch):
+    """Test that a tos dumped by its rt_dsfield name matches its value."""
+    monkeypatch.setattr(routing_state.RoutingEntryRule, "dsfield_cache", {"CS1": 0x20})
+    conf = {"from-net": "2001:db8::/64", "tos": "0x20"}
+    kernel_rule = {"src": "2001:db8::", "srclen": 64, "tos": "CS1"}
+
+    assert routing_state.rule_selector(conf) == routing_state.kernel_rule_selector(
+        kernel_rule
+    )
@@ -0,0 +1,144 @@
+"""Event watcher unit testing module."""
+import ipaddress
+import socket
+import struct
+import subprocess
+
+import pytest
+
+from routing_state import route_event_key, rule_event_key
+
+import routing_watcher
+
+ROUTE = {"type": "route", "net": "10.0.0.0/24", "gateway": "10.0.0.1", "table": "SF1"}
+RULE = {"type": "rule", "from-net": "10.0.0.0/24", "fwmark": "0x10", "table": "SF1"}
+
+
+def attr(attr_type, value):
+    """Return a padded rtattr."""
+    data = struct.pack("=HH", 4 + len(value), attr_type) + value
+    return data + b"\0" * (-len(data) % 4)
+
+
+def message(msg_type, header, attrs):
+    """Return a netlink message of a rtmsg header and its attributes."""
+    payload = struct.pack("=BBBBBBBBI", *header) + b"".join(attrs)
+    return struct.pack("=IHHII", 16 + len(payload), msg_type, 0, 0, 0) + payload
+
+
+def route_deleted(net, table, protocol=250, metric=None):
+    """Return the RTM_DELROUTE message of a route."""
+    network = ipaddress.ip_network(net)
+    attrs = [
+        attr(routing_watcher.RTA_TABLE, struct.pack("=I", table)),
+        attr(routing_watcher.RTA_DST, network.network_address.packed),
+    ]
+    if metric is not None:
+        attrs.append(attr(routing_watcher.RTA_PRIORITY, struct.pack("=I", metric)))
+    header = (socket.AF_INET, network.prefixlen, 0, 0, 252, protocol, 0, 1, 0)
+    return message(routing_watcher.RTM_DELROUTE, header, attrs)
+
+
+def rule_deleted(src, table, priority, fwmark=None):
+    """Return the RTM_DELRULE message of a rule."""
+    network = ipaddress.ip_network(src)
+    attrs = [
+        attr(routing_watcher.FRA_TABLE, struct.pack("=I", table)),
+        attr(routing_watcher.FRA_SRC, network.network_address.packed),
+        attr(routing_watcher.FRA_PRIORITY, struct.pack("=I", priority)),
+        attr(routing_watcher.FRA_PROTOCOL, b"\xfa"),
+    ]
+    if fwmark is not None:
+        attrs.append(attr(routing_watcher.FRA_FWMARK, struct.pack("=I", fwmark)))
+        attrs.append(attr(routing_watcher.FRA_FWMASK, b"\xff\xff\xff\xff"))
+    header = (socket.AF_INET, 0, network.prefixlen, 0, 252, 0, 0, 1, 0)
+    return message(routing_watcher.RTM_DELRULE, header, attrs)
+
+
+class Clock:
+    """Manually advanced clock."""
+
+    now = 1000.0
+
+    def __call__(self):
+        """Return the current time."""
+        return self.now
+
+
+@pytest.fixture
+def watcher():
+    """Watcher of a route and a rule of table 100, recording its commands."""
+    entries = [
+        {"name": "route", "kind": "route", "key": route_event_key(ROUTE, 100)},
+        {"name": "rule", "kind": "rule", "key": rule_event_key(RULE, 100)},
+    ]
+    for entry in entries:
+        entry["cmd"] = ["ip", entry["name"]]
+    commands = []
+
+    def run(cmd, **kwargs):
+        commands.append(cmd[1])
+        return subprocess.CompletedProcess(cmd, 0, stderr="")
+
+    test_watcher = routing_watcher.EventWatcher(
+        entries, rate=2.0, max_repairs=3, window=60.0, run=run, clock=Clock()
+    )
+    test_watcher.commands = commands
+    return test_watcher
+
+
+def handle(watcher, data):
+    """Handle the messages of a datagram, return the names repaired."""
+    repaired = [watcher.handle(*msg) for msg in routing_watcher.messages(data)]
+    return [entry["name"] for entry in repaired if entry]
+
+
+def test_keys_match_the_charm():
+    """Test that the kernel events give the keys computed by the charm."""
+    route = next(routing_watcher.messages(route_deleted("10.0.0.0/24", 100)))
+    rule = next(routing_watcher.messages(rule_deleted("10.0.0.0/24", 100, 99, 0x10)))
+
+    assert routing_watcher.route_key(route[1]) == tuple(route_event_key(ROUTE, 100))
+    # the rule was added without priority, the kernel picked 99
+    assert routing_watcher.rule_key(rule[1])[:-1] == tuple(
+        rule_event_key(RULE, 100)[:-1]
+    )
+
+
+def test_repairs_deleted_entries(watcher):
+    """Test that only the deleted entries of the model are installed again."""
+    data = (
+        route_deleted("10.0.0.0/24", 100)
+        + rule_deleted("10.0.0.0/24", 100, 99, 0x10)
+        # not the charm's, other table or metric, other selector
+        + route_deleted("10.0.0.0/24", 100, protocol=4)
+        + route_deleted("10.0.0.0/24", 101)
+        + route_deleted("10.0.0.0/24", 100, metric=10)
+        + rule_deleted("10.0.0.0/24", 100, 99)
+    )
+
+    assert handle(watcher, data) == ["route", "rule"]
+
+
+def test_rate_limits(watcher):
+    """Test the global rate and the repairs of an entry per window."""
+    deleted = route_deleted("10.0.0.0/24", 100)
+
+    assert handle(watcher, deleted * 3) == ["route", "route"]
+    watcher.clock.now += 1
+    assert handle(watcher, deleted * 2) == ["route"]
+    # fighting another agent, left alone until the window passes
+    watcher.clock.now += 10
+    assert handle(watcher, deleted) == []
+    watcher.clock.now += 60
+    assert handle(watcher, deleted) == ["route"]
+    assert watcher.commands == ["route"] * 4
+
+
+def test_failed_repair(watcher):
+    """Test that a failed command is not reported as a repair."""
+    watcher.run = lambda cmd, **kwargs: subprocess.CompletedProcess(
+        cmd, 2, stderr="Cannot find device"
+    )
+
+    assert handle(watcher, route_deleted("10.0.0.0/24", 100)) == []
@@ -1,7 +1,10 @@
 """Test suite for actions."""
+import json
 import pathlib
 from unittest import mock
 
+import routing_state
+
 import routing_validator
 
 
@@ -10,10 +13,14 @@ class TestActions:
 
     test_dir = pathlib.Path("/tmp/test/charm-advanced-routing")
     test_networkd_conf_path = test_dir / "networkd.conf.d" / "juju-networkd.conf"
+    test_protocol_name_path = test_dir / "rt_protos.d" / "juju-managed.conf"
     test_script = "test-script"
 
-    def test_action_apply_changes_apply_config(self, advanced_routing_helper):
+    def test_action_apply_changes_apply_config(
+        self, advanced_routing_helper, monkeypatch
+    ):
         """Test action apply changes."""
+        monkeypatch.setattr("routing_spawns.install", lambda: None)
         import actions.apply_changes
 
         def noop():
@@ -25,9 +32,98 @@ class TestActions:
         test_obj.common_ifup_path = self.test_dir / "if-up" / self.test_script
         test_obj.common_cleanup_path = self.test_dir / "cleanup" / self.test_script
         test_obj.networkd_conf_path = self.test_networkd_conf_path
+        test_obj.protocol_name_path = self.test_protocol_name_path
 
         test_obj.post_setup = noop
-        routing_validator.RoutingConfigValidator.__init__ = mock.Mock(return_value=None)
+        test_obj.setup_boot_restore = noop
+        monkeypatch.setattr(
+            routing_validator.RoutingConfigValidator,
+            "__init__",
+            mock.Mock(return_value=None),
+        )
+        monkeypatch.setattr(
+            routing_validator.RoutingConfigValidator,
+            "verify_config",
+            mock.Mock(return_value=routing_validator.RoutingModel()),
+        )
         test_obj.setup()
+        monkeypatch.setattr(
+            "routing_state.KernelState.snapshot",
+            mock.Mock(return_value=routing_state.KernelState()),
+        )
 
         assert actions.apply_changes.apply_config()
+
+    def test_action_show_state(self, advanced_routing_helper, monkeypatch):
+        """Test that the show-state action returns bounded compact JSON."""
+        monkeypatch.setattr("routing_spawns.install", lambda: None)
+        import actions.show_state
+
+        state = routing_state.KernelState(
+            [(4, {"dst": "10.1.0.0/24", "gateway": "10.0.0.1", "table": "SF1"})] * 3
+        )
+        test_obj = advanced_routing_helper
+        test_obj.table_name_path = self.test_dir / "rt_tables.d" / "juju-managed.conf"
+        monkeypatch.setattr(test_obj, "owned_state", lambda families: state)
+        params = {"table": "", "prefix": "", "device": "", "limit": 2}
+        monkeypatch.setattr("actions.show_state.action_get", params.get)
+        results = {}
+        monkeypatch.setattr("actions.show_state.action_set", results.update)
+        monkeypatch.setattr(test_obj, "record_run", lambda: None)
+
+        actions.show_state.action()
+
+        assert results["count"] == 2 and results["truncated"]
+        assert json.loads(results["state"]) == {
+            "SF1": {
+                "routes": [{"dst": "10.1.0.0/24", "gateway": "10.0.0.1"}] * 2,
+                "rules": [],
+            }
+        }
+
+    def test_action_show_state_failures(self, advanced_routing_helper, monkeypatch):
+        """Test that bad prefixes and kernel dump failures are told apart."""
+        monkeypatch.setattr("routing_spawns.install", lambda: None)
+        import actions.show_state
+
+        test_obj = advanced_routing_helper
+        monkeypatch.setattr(actions.show_state, "advanced_routing", test_obj)
+
+        def owned_state(families):
+            raise ValueError("Expecting value: line 1 column 1 (char 0)")
+
+        monkeypatch.setattr(test_obj, "owned_state", owned_state)
+        monkeypatch.setattr(test_obj, "record_run", lambda: None)
+        failures = []
+        monkeypatch.setattr("actions.show_state.action_fail", failures.append)
+        for prefix in ("10.0.0.300/24", "10.0.0.0/24"):
+            params = {"table": "", "prefix": prefix, "device": "", "limit": 2}
+            monkeypatch.setattr("actions.show_state.action_get", params.get)
+            actions.show_state.action()
+
+        assert failures == [
+            "Invalid prefix: '10.0.0.300/24' does not appear to be an IPv4 or IPv6 "
+            "network",
+            "Cannot dump the routing state: Expecting value: line 1 column 1 (char 0)",
+        ]
+
+    def test_action_plan_snapshot_failure(self, advanced_routing_helper, monkeypatch):
+        """Test that the plan action fails cleanly if the kernel dump fails."""
+        monkeypatch.setattr("routing_spawns.install", lambda: None)
+        import actions.plan
+
+        test_obj = advanced_routing_helper
+
+        def plan():
+            raise ValueError("Expecting value: line 1 column 1 (char 0)")
+
+        monkeypatch.setattr(test_obj, "plan", plan)
+        monkeypatch.setattr(test_obj, "record_run", lambda: None)
+        failures = []
+        monkeypatch.setattr("actions.plan.action_fail", failures.append)
+
+        actions.plan.action()
+
+        assert failures == [
+            "Cannot dump the routing state: Expecting value: line 1 column 1 (char 0)"
+        ]